@@ -1,4 +1,4 @@
-BEGIN TRANSACTION;
+--Baseline schema (migration 0). Idempotent: it also runs on databases created before schema_version existed
 CREATE TABLE IF NOT EXISTS "Instruments" (
 	"name"	TEXT NOT NULL,
 	"ticker"	TEXT NOT NULL CHECK(ticker GLOB '[A-Z][A-Z]*' AND LENGTH(ticker) >= 2 AND LENGTH(ticker) <= 10) UNIQUE,
@@ -49,14 +49,12 @@ CREATE TABLE IF NOT EXISTS "Users" (
 	PRIMARY KEY("id")
 );
 
-DELETE FROM Instruments WHERE ticker = 'RUB';
-INSERT INTO Instruments (name, ticker) VALUES ('Ruble', 'RUB');
-DELETE FROM Users WHERE api_key = 'key-27feaacf537015b8824942ad6f50789b';
-INSERT INTO Users (id, name, role, api_key, api_key_hashed)
+INSERT OR IGNORE INTO Instruments (name, ticker) VALUES ('Ruble', 'RUB');
+INSERT OR IGNORE INTO Users (id, name, role, api_key, api_key_hashed)
 VALUES ('641f541b-4fcc-4a5b-aa97-107b422ff5fd',
         'Adminito_dnito_durdilito', 1,
         'key-27feaacf537015b8824942ad6f50789b',
-        '9111818d82c7f4e94d3690da57542d0bf50c21d1497e0a7bff08dc5ed8dc5ed5365cd3');
+        '9111818d82c7f4e94d3690da57542d0bf50c21d1497e0a7bff08dc5ed5365cd3');
 
 CREATE TRIGGER IF NOT EXISTS order_status_on_fill AFTER UPDATE OF filled ON Orders
 BEGIN
@@ -71,4 +69,3 @@ BEGIN
 UPDATE Orders SET status = IIF(old.status != 3, IIF(new.filled > 0, IIF(new.filled == new.qty, 1, 2),0), old.status)
 WHERE id = new.id;
 END;
-COMMIT;
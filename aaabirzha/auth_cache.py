@@ -0,0 +1,55 @@
+from collections import OrderedDict
+import time
+
+
+#Bounded LRU cache of hashed API key -> authenticated user with a per-entry TTL.
+#Anything that deletes a user or changes their role must call invalidate_user, the TTL only bounds
+#how long a missed invalidation (e.g. a manual DB edit) can stay visible
+class AuthCache:
+    def __init__(self, maxsize: int = 10000, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.keys_by_user = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, hashed_key: str):
+        entry = self.entries.get(hashed_key)
+        if entry is None:
+            return None
+        expires_at, user_id, user = entry
+        if expires_at < time.monotonic():
+            self._drop(hashed_key)
+            return None
+        self.entries.move_to_end(hashed_key)
+        return user
+
+    def put(self, hashed_key: str, user_id, user):
+        user_id = str(user_id)
+        if hashed_key in self.entries:
+            self._drop(hashed_key)
+        self.entries[hashed_key] = (time.monotonic() + self.ttl, user_id, user)
+        self.keys_by_user.setdefault(user_id, set()).add(hashed_key)
+        while len(self.entries) > self.maxsize:
+            self._drop(next(iter(self.entries)))
+
+    def _drop(self, hashed_key: str):
+        _, user_id, _ = self.entries.pop(hashed_key)
+        keys = self.keys_by_user.get(user_id)
+        if keys is not None:
+            keys.discard(hashed_key)
+            if not keys:
+                del self.keys_by_user[user_id]
+
+    def invalidate_user(self, user_id):
+        for hashed_key in list(self.keys_by_user.get(str(user_id), ())):
+            self._drop(hashed_key)
+
+    def clear(self):
+        self.entries.clear()
+        self.keys_by_user.clear()
+
+
+auth_cache = AuthCache()
@@ -0,0 +1,6 @@
+#Benchmarks never touch the service database: every run gets its own temp SQLite file.
+#Set before aaabirzha.database is imported, which reads AAABIRZHA_DB on import and opens it in init_db
+import os
+import tempfile
+
+os.environ['AAABIRZHA_DB'] = os.path.join(tempfile.mkdtemp(prefix='aaabirzha-bench-'), 'bench.db')
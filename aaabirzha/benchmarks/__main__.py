@@ -0,0 +1,57 @@
+#Runs the benchmark suite with small default sizes, writes every result as one JSON line and optionally
+#compares the run against a stored baseline. Exits with 1 if any metric regressed beyond the threshold.
+#Usage: python -m aaabirzha.benchmarks [--suites engine db api matching startup candles] [--output run.jsonl]
+#                                      [--compare baseline.jsonl] [--threshold 0.2]
+import argparse
+import json
+import subprocess
+import sys
+
+from aaabirzha.benchmarks.report import regressions
+
+#Every suite runs in its own process, so each one gets a fresh temp database and its own event loop
+SUITES = {
+    'engine': ['--depths', '10', '100', '1000', '--sweeps', '0', '1', '10', '--orders', '200'],
+    'db': ['--rows', '100', '10000', '--runs', '200'],
+    'api': ['--requests', '1000', '--concurrency', '1', '16'],
+    'matching': ['--depths', '100', '1000', '--runs', '5'],
+    'indexes': ['--sizes', '100000', '--runs', '50'],
+    'startup': ['--runs', '10'],
+    'candles': ['--trades', '100000', '--fills', '100000'],
+}
+
+
+def run_suite(name: str) -> list:
+    output = subprocess.run([sys.executable, '-m', f'aaabirzha.benchmarks.bench_{name}', *SUITES[name]],
+                            check=True, stdout=subprocess.PIPE, text=True).stdout
+    return [json.loads(line) for line in output.splitlines() if line.startswith('{')]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suites', nargs='+', choices=list(SUITES), default=['engine', 'db', 'api', 'matching', 'startup', 'candles'])
+    parser.add_argument('--output')
+    parser.add_argument('--compare')
+    parser.add_argument('--threshold', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = []
+    for name in args.suites:
+        for record in run_suite(name):
+            print(json.dumps(record), flush=True)
+            results.append(record)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.writelines(json.dumps(record) + '\n' for record in results)
+
+    if args.compare:
+        with open(args.compare, 'r') as baseline:
+            found = regressions([json.loads(line) for line in baseline if line.strip()], results, args.threshold)
+        for case, metric, old, new in found:
+            print(f'REGRESSION {case} {metric}: {old} -> {new}', file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#End-to-end throughput and latency of the FastAPI app on a temp SQLite file. Requests go through the
+#full ASGI stack (routing, auth, validation, sequencer, DB pool) in process via httpx, without a socket.
+#concurrency clients send their share of requests back to back.
+#Usage: python -m aaabirzha.benchmarks.bench_api [--requests 2000] [--concurrency 1 16 64] [--traders 20]
+import argparse
+import asyncio
+import logging
+import random
+import time
+from uuid import uuid4
+
+import httpx
+
+import aaabirzha.database as db_fnc
+from aaabirzha.benchmarks.report import latency, emit
+from aaabirzha.main import app, hash_api_key
+
+TICKER = 'BAPI'
+FUNDS = 10 ** 9
+#Orders per POST /api/v1/order/batch request
+BATCH_SIZE = 50
+
+
+async def setup(client: httpx.AsyncClient, traders: int) -> list:
+    admin_key = f'key-{uuid4().hex}'
+    db_fnc.create_user(uuid4(), 'bench-admin', 1, hash_api_key(admin_key), admin_key)
+    admin = {'Authorization': f'TOKEN {admin_key}'}
+    (await client.post('/api/v1/admin/instrument', json={'name': TICKER, 'ticker': TICKER}, headers=admin)).raise_for_status()
+    headers = []
+    for number in range(traders):
+        user = (await client.post('/api/v1/public/register', json={'name': f'trader-{number}'})).json()
+        for ticker in (TICKER, 'RUB'):
+            (await client.post('/api/v1/admin/balance/deposit', headers=admin,
+                               json={'user_id': user['id'], 'ticker': ticker, 'amount': FUNDS})).raise_for_status()
+        headers.append({'Authorization': f'TOKEN {user["api_key"]}'})
+    return headers
+
+
+def limit_order(rnd: random.Random, headers: list) -> tuple:
+    body = {'direction': rnd.choice(('BUY', 'SELL')), 'ticker': TICKER, 'qty': rnd.randint(1, 5),
+            'price': rnd.randint(990, 1010)}
+    return 'POST', '/api/v1/order/', body, rnd.choice(headers)
+
+
+def limit_order_batch(rnd: random.Random, headers: list) -> tuple:
+    auth = rnd.choice(headers)
+    return 'POST', '/api/v1/order/batch', [limit_order(rnd, headers)[2] for _ in range(BATCH_SIZE)], auth
+
+
+def orderbook(rnd: random.Random, headers: list) -> tuple:
+    return 'GET', f'/api/v1/public/orderbook/{TICKER}', None, None
+
+
+def balance(rnd: random.Random, headers: list) -> tuple:
+    return 'GET', '/api/v1/balance', None, rnd.choice(headers)
+
+
+WORKLOADS = {'limit_order': limit_order, 'limit_order_batch': limit_order_batch, 'orderbook': orderbook,
+             'balance': balance}
+#Orders sent by one request of a workload, for orders_per_s
+ORDERS_PER_REQUEST = {'limit_order': 1, 'limit_order_batch': BATCH_SIZE}
+
+
+async def run_workload(client: httpx.AsyncClient, make_request, headers: list, requests: int,
+                       concurrency: int) -> dict:
+    samples = []
+    errors = 0
+
+    async def worker(seed: int, count: int):
+        nonlocal errors
+        rnd = random.Random(seed)
+        for _ in range(count):
+            method, url, body, auth = make_request(rnd, headers)
+            start = time.perf_counter()
+            response = await client.request(method, url, json=body, headers=auth)
+            samples.append(time.perf_counter() - start)
+            errors += response.status_code != 200
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(seed, requests // concurrency) for seed in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {**latency(samples, 1e3, 'ms'), 'requests_per_s': round(len(samples) / elapsed, 1), 'errors': errors}
+
+
+async def run(requests: int, concurrencies: list, traders: int):
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://bench') as client:
+            headers = await setup(client, traders)
+            for name, make_request in WORKLOADS.items():
+                for concurrency in concurrencies:
+                    result = await run_workload(client, make_request, headers, requests, concurrency)
+                    if name in ORDERS_PER_REQUEST:
+                        result['orders_per_s'] = round(result['requests_per_s'] * ORDERS_PER_REQUEST[name], 1)
+                    emit({'benchmark': 'api', 'endpoint': name, 'requests': requests,
+                          'concurrency': concurrency, **result})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--traders', type=int, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    asyncio.run(run(args.requests, args.concurrency, args.traders))
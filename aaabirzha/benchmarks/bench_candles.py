@@ -0,0 +1,71 @@
+#Cost of the candle aggregation: CandleAggregator.record per fill (all four intervals, in memory) and the
+#set-based backfill of every interval from a Transactions table of the given number of trades.
+#Usage: python -m aaabirzha.benchmarks.bench_candles [--trades 100000 1000000] [--fills 100000]
+import argparse
+import asyncio
+import logging
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import aaabirzha.database as db_fnc
+from aaabirzha.benchmarks.report import emit
+from aaabirzha.candles import CandleAggregator, INTERVALS
+
+START = datetime(2026, 1, 1)
+
+
+#One trade every 10ms on average, spread over three tickers
+def trades(count: int, seed: int = 0):
+    rnd = random.Random(seed)
+    timestamp = START
+    for _ in range(count):
+        timestamp += timedelta(microseconds=rnd.randint(0, 20000))
+        yield rnd.choice(('BCAA', 'BCAB', 'BCAC')), rnd.randint(900, 1100), rnd.randint(1, 100), timestamp
+
+
+def bench_record(fills: int):
+    async def run():
+        aggregator = CandleAggregator()
+        batch = list(trades(fills))
+        start = time.perf_counter()
+        for ticker, price, qty, timestamp in batch:
+            aggregator.record(ticker, price, qty, timestamp)
+        elapsed = time.perf_counter() - start
+        aggregator.task.cancel()
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    emit({'benchmark': 'candles', 'step': 'record', 'fills': fills,
+          'per_fill_us': round(elapsed / fills * 1e6, 2), 'fills_per_s': round(fills / elapsed)})
+
+
+def bench_backfill(count: int):
+    db_fnc.conn.execute('DELETE FROM Transactions')
+    db_fnc.conn.execute('DELETE FROM Candles')
+    db_fnc.conn.executemany('''
+INSERT INTO Transactions (user_id, ticker, direction, amount, price, timestamp) VALUES ('bench', ?, ?, ?, ?, ?)''',
+                            ((ticker, direction, qty, price, str(timestamp))
+                             for ticker, price, qty, timestamp in trades(count) for direction in (0, 1)))
+    db_fnc.conn.commit()
+    start = time.perf_counter()
+    bars = db_fnc.backfill_candles(INTERVALS.values())
+    elapsed = time.perf_counter() - start
+    emit({'benchmark': 'candles', 'step': 'backfill', 'trades': count, 'bars': bars,
+          'backfill_s': round(elapsed, 2), 'trades_per_s': round(count / elapsed)})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trades', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--fills', type=int, default=100000)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    bench_record(args.fills)
+    with tempfile.TemporaryDirectory() as directory:
+        db_fnc.init_db(os.path.join(directory, 'candles.db'))
+        for count in args.trades:
+            bench_backfill(count)
+        db_fnc.close_db()
@@ -0,0 +1,77 @@
+#Latency of the database functions on the order and balance paths, on a temp SQLite file.
+#rows is the number of open orders of the ticker that get_offers_by_ticker scans. settle_match fills one
+#lot of a maker SELL per call, the seller has every lot of it frozen
+#Usage: python -m aaabirzha.benchmarks.bench_db [--rows 100 10000 100000] [--runs 200]
+import argparse
+import logging
+import random
+import time
+from datetime import datetime
+from uuid import uuid4
+
+import aaabirzha.database as db_fnc
+from aaabirzha.benchmarks.report import latency, emit
+from aaabirzha.orderbook import SELL
+from aaabirzha.schemas import Direction
+
+FUNDS = 10 ** 15
+
+
+def populate(ticker: str, rows: int, seed: int = 0) -> tuple:
+    rnd = random.Random(seed)
+    db_fnc.create_instrument(ticker, ticker)
+    buyer, seller = str(uuid4()), str(uuid4())
+    for user_id in (buyer, seller):
+        db_fnc.create_user(user_id, user_id, 0, f'key-{user_id}')
+        for balance_ticker in (ticker, 'RUB'):
+            db_fnc.conn.execute('''
+INSERT INTO UserBalance (user_id, ticker, balance, frozen) VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id, ticker) DO UPDATE SET balance = excluded.balance, frozen = excluded.frozen''',
+                                (user_id, balance_ticker, FUNDS, FUNDS if (user_id, balance_ticker) == (seller, ticker) else 0))
+    maker = str(uuid4())
+    db_fnc.conn.execute('''
+INSERT INTO Orders (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+VALUES (?, 0, ?, ?, ?, ?, ?, 1000, 0, 1)''', (maker, seller, str(datetime.now()), SELL, ticker, FUNDS))
+    db_fnc.conn.executemany('''
+INSERT INTO Orders (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+VALUES (?, 0, ?, ?, ?, ?, ?, ?, 0, 1)''',
+                            ((str(uuid4()), seller, str(datetime.now()), rnd.randint(0, 1), ticker,
+                              rnd.randint(1, 100), rnd.randint(900, 1100)) for _ in range(rows)))
+    db_fnc.conn.commit()
+    return buyer, seller, maker
+
+
+def time_calls(fn, runs: int) -> list:
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def case_ticker(number: int) -> str:
+    return 'BD' + ''.join(chr(ord('A') + int(digit)) for digit in str(number))
+
+
+def run(row_counts, runs):
+    for number, rows in enumerate(row_counts):
+        ticker = case_ticker(number)
+        buyer, seller, maker = populate(ticker, rows)
+        cases = {
+            'get_offers_by_ticker': lambda: db_fnc.get_offers_by_ticker(ticker, Direction.SELL),
+            'update_balance': lambda: db_fnc.update_balance(buyer, 'RUB', 1),
+            'settle_match': lambda: db_fnc.settle_match(buyer, seller, ticker, 1000, 1, maker, SELL, 1000),
+        }
+        for name, fn in cases.items():
+            emit({'benchmark': 'db', 'function': name, 'rows': rows, 'runs': runs, **latency(time_calls(fn, runs))})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[100, 10000, 100000])
+    parser.add_argument('--runs', type=int, default=200)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    db_fnc.init_db()
+    run(args.rows, args.runs)
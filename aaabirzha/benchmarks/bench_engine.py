@@ -0,0 +1,133 @@
+#Latency of execute_limit_order/execute_market_order with settlement on a temp SQLite file.
+#depth is the number of resting price levels, sweep the number of levels one incoming order consumes
+#(0: a limit order that rests without trading). The book is topped up to depth between orders.
+#--ledger settles in the in-memory balance ledger instead of one SQLite transaction per fill.
+#Usage: python -m aaabirzha.benchmarks.bench_engine [--depths 10 100 1000] [--sweeps 0 1 10] [--orders 200] [--ledger]
+import argparse
+import asyncio
+import logging
+import time
+from datetime import datetime
+from uuid import uuid4
+
+import aaabirzha.database as db_fnc
+from aaabirzha.benchmarks.report import latency, emit
+from aaabirzha.schemas import MarketOrder, LimitOrder, OrderStatus, Direction, User, UserRole
+from aaabirzha.matching_engine import execute_limit_order, execute_market_order
+from aaabirzha.orderbook import BookOrder, get_book, SELL
+from aaabirzha.trade_tape import trade_tape
+from aaabirzha.ledger import ledger, Account
+
+LEVEL_QTY = 10
+BASE_PRICE = 1000
+FUNDS = 10 ** 15
+
+
+def make_user(name: str) -> User:
+    user = User(id=uuid4(), name=name, role=UserRole.USER, api_key=f'key-{name}')
+    db_fnc.create_user(user.id, user.name, 0, user.api_key)
+    return user
+
+
+def fund(user: User, ticker: str, frozen: int = 0):
+    db_fnc.conn.execute('''
+INSERT INTO UserBalance (user_id, ticker, balance, frozen) VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id, ticker) DO UPDATE SET balance = excluded.balance, frozen = excluded.frozen''',
+                        (str(user.id), ticker, FUNDS, frozen))
+    db_fnc.conn.commit()
+    if ledger.loaded:
+        ledger.accounts.setdefault(str(user.id), {})[ticker] = Account(FUNDS, frozen)
+
+
+#Sell orders resting at the next prices above the book, written straight to Orders and the book
+class Seller:
+    def __init__(self, user: User, ticker: str):
+        self.user = user
+        self.ticker = ticker
+        self.next_price = BASE_PRICE
+
+    def top_up(self, depth: int):
+        book = get_book(self.ticker)
+        missing = depth - len(book.keys[SELL])
+        rows = []
+        for _ in range(missing):
+            order = BookOrder(uuid4(), self.user.id, SELL, self.next_price, LEVEL_QTY, 0, str(datetime.now()))
+            rows.append((order.id, order.user_id, order.timestamp, self.ticker, order.price, order.qty))
+            book.add(order)
+            self.next_price += 1
+        db_fnc.conn.executemany('''
+INSERT INTO Orders (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+VALUES (?, 0, ?, ?, 1, ?, ?, ?, 0, 1)''', rows)
+        db_fnc.conn.commit()
+
+
+def limit_order(user: User, ticker: str, qty: int, price: int) -> LimitOrder:
+    order = LimitOrder(id=uuid4(), status=OrderStatus.NEW, user_id=user.id, timestamp=datetime.now(),
+                       body={'direction': Direction.BUY, 'ticker': ticker, 'qty': qty, 'price': price})
+    db_fnc.create_limit_order(order, str(user.id))
+    return order
+
+
+def market_order(user: User, ticker: str, qty: int) -> MarketOrder:
+    return MarketOrder(id=uuid4(), status=OrderStatus.NEW, user_id=user.id, timestamp=datetime.now(),
+                       body={'direction': Direction.BUY, 'ticker': ticker, 'qty': qty})
+
+
+async def run_case(kind: str, depth: int, sweep: int, orders: int, ticker: str) -> dict:
+    db_fnc.create_instrument(ticker, ticker)
+    seller, buyer = make_user(f'seller-{ticker}'), make_user(f'buyer-{ticker}')
+    fund(seller, ticker, frozen=FUNDS // 2)
+    fund(buyer, 'RUB')
+    book_seller = Seller(seller, ticker)
+    book = get_book(ticker)
+    samples = []
+    for _ in range(orders):
+        book_seller.top_up(depth)
+        if kind == 'market':
+            order = market_order(buyer, ticker, sweep * LEVEL_QTY)
+            start = time.perf_counter()
+            await execute_market_order(order, buyer)
+        else:
+            #A limit order that does not cross rests one tick below the best ask
+            price = book.best_price(SELL) + sweep - 1
+            order = limit_order(buyer, ticker, max(sweep, 1) * LEVEL_QTY, price)
+            start = time.perf_counter()
+            await execute_limit_order(order, buyer)
+        samples.append(time.perf_counter() - start)
+    await trade_tape.flush()
+    return {'benchmark': 'engine', 'ledger': ledger.loaded, 'order': kind, 'depth': depth, 'sweep': sweep, 'orders': orders,
+            **latency(samples), 'orders_per_s': round(len(samples) / sum(samples), 1)}
+
+
+def case_ticker(number: int) -> str:
+    return 'BE' + ''.join(chr(ord('A') + int(digit)) for digit in str(number))
+
+
+async def run(depths, sweeps, orders, use_ledger):
+    if use_ledger:
+        ledger.load()
+    number = 0
+    for depth in depths:
+        for sweep in sweeps:
+            if sweep > depth:
+                continue
+            for kind in ('limit', 'market'):
+                if kind == 'market' and sweep == 0:
+                    continue
+                number += 1
+                emit(await run_case(kind, depth, sweep, orders, case_ticker(number)))
+    await trade_tape.stop()
+    await ledger.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depths', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--sweeps', type=int, nargs='+', default=[0, 1, 10])
+    parser.add_argument('--orders', type=int, default=200)
+    parser.add_argument('--ledger', action='store_true')
+    args = parser.parse_args()
+    #Per-fill INFO logging would be most of what is measured
+    logging.disable(logging.INFO)
+    db_fnc.init_db()
+    asyncio.run(run(args.depths, args.sweeps, args.orders, args.ledger))
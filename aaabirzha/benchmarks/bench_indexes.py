@@ -0,0 +1,135 @@
+#Query latency of the hot read paths before and after the index migration.
+#Usage: python -m aaabirzha.benchmarks.bench_indexes [--sizes 100000 1000000 10000000] [--runs 50]
+#Prints one JSON object per (size, query) to stdout
+import argparse
+import json
+import os
+import random
+import sqlite3 as sql
+import statistics
+import tempfile
+import time
+import uuid
+
+from aaabirzha.migrations import apply_migrations, BASELINE_PATH
+
+TICKERS = [''.join(random.Random(i).choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ', k=4)) for i in range(50)]
+USERS = 1000
+OPEN_SHARE = 0.05
+
+QUERIES = {
+    'get_offers_by_ticker': ('''
+SELECT * FROM Orders
+WHERE ticker = ? AND direction = ?
+AND price <= ?
+AND status IN (0, 2)
+ORDER BY price ASC, timestamp ASC''', lambda rnd: (rnd.choice(TICKERS), rnd.randint(0, 1), 10000000000000000)),
+    'get_offers_by_ticker_sum': ('''
+SELECT sum(qty) - sum(filled) FROM Orders
+WHERE ticker =? AND direction = ?
+AND price <= ? AND status IN (0, 2)''', lambda rnd: (rnd.choice(TICKERS), rnd.randint(0, 1), 10000000000000000)),
+    'get_orders_for_ticker': ('''
+SELECT * FROM Orders
+WHERE ticker = ?
+AND status IN (0, 2)''', lambda rnd: (rnd.choice(TICKERS),)),
+    'get_orders_for_user': ('''
+SELECT * FROM Orders
+WHERE user_id = ?''', lambda rnd: (f'user-{rnd.randrange(USERS)}',)),
+    'get_orders_for_user_page': ('''
+SELECT * FROM Orders
+WHERE user_id = ?
+ORDER BY timestamp, id
+LIMIT 100''', lambda rnd: (f'user-{rnd.randrange(USERS)}',)),
+    'get_user_by_api_key': ('''
+SELECT id, name, role, api_key_hashed
+FROM Users
+WHERE api_key_hashed = ?''', lambda rnd: (f'hash-{rnd.randrange(USERS)}',)),
+    'get_transactions_by_user': ('''
+SELECT * FROM Transactions
+WHERE user_id = ? AND ticker = ?''', lambda rnd: (f'user-{rnd.randrange(USERS)}', rnd.choice(TICKERS))),
+    'get_transactions_by_user_page': ('''
+SELECT * FROM Transactions
+WHERE user_id = ? AND timestamp > ?
+ORDER BY timestamp, id
+LIMIT 10''', lambda rnd: (f'user-{rnd.randrange(USERS)}', '2025-01-01 00:00:00.100000')),
+}
+
+
+def populate(conn: sql.Connection, orders: int, seed: int = 0):
+    rnd = random.Random(seed)
+    conn.executescript(BASELINE_PATH.read_text())
+    conn.executemany('INSERT INTO Instruments (name, ticker) VALUES (?, ?)', ((t, t) for t in TICKERS))
+    conn.executemany('INSERT INTO Users (id, name, role, api_key_hashed) VALUES (?, ?, 0, ?)',
+                     ((f'user-{i}', f'user-{i}', f'hash-{i}') for i in range(USERS)))
+
+    def order_rows():
+        for i in range(orders):
+            is_open = rnd.random() < OPEN_SHARE
+            qty = rnd.randint(1, 100)
+            yield (str(uuid.UUID(int=rnd.getrandbits(128))), rnd.choice((0, 2)) if is_open else rnd.choice((1, 3)),
+                   f'user-{rnd.randrange(USERS)}', f'2025-01-01 00:00:{i / 1000000:09.6f}', rnd.randint(0, 1),
+                   rnd.choice(TICKERS), qty, rnd.randint(90, 110), 0, 1)
+
+    def transaction_rows():
+        for i in range(orders // 2):
+            yield (f'user-{rnd.randrange(USERS)}', rnd.choice(TICKERS), rnd.randint(0, 1),
+                   rnd.randint(1, 100), rnd.randint(90, 110), f'2025-01-01 00:00:{i / 1000000:09.6f}')
+
+    conn.executemany('''
+INSERT INTO Orders (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', order_rows())
+    conn.executemany('''
+INSERT INTO Transactions (user_id, ticker, direction, amount, price, timestamp)
+VALUES (?, ?, ?, ?, ?, ?)''', transaction_rows())
+    conn.commit()
+
+
+def time_queries(conn: sql.Connection, runs: int, seed: int = 1) -> dict:
+    results = {}
+    for name, (query, make_params) in QUERIES.items():
+        rnd = random.Random(seed)
+        samples = []
+        for _ in range(runs):
+            params = make_params(rnd)
+            start = time.perf_counter()
+            conn.execute(query, params).fetchall()
+            samples.append((time.perf_counter() - start) * 1e6)
+        samples.sort()
+        results[name] = {'median_us': statistics.median(samples),
+                         'p99_us': samples[min(len(samples) - 1, int(len(samples) * 0.99))]}
+    return results
+
+
+def run(sizes, runs):
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            conn = sql.connect(os.path.join(tmp, 'bench.db'))
+            conn.execute('PRAGMA journal_mode=WAL;')
+            populate(conn, size)
+            before = time_queries(conn, runs)
+            start = time.perf_counter()
+            apply_migrations(conn)
+            conn.execute('ANALYZE')
+            migration_s = time.perf_counter() - start
+            after = time_queries(conn, runs)
+            conn.close()
+        for name in QUERIES:
+            print(json.dumps({
+                'benchmark': 'indexes',
+                'orders': size,
+                'query': name,
+                'before_median_us': round(before[name]['median_us'], 1),
+                'after_median_us': round(after[name]['median_us'], 1),
+                'before_p99_us': round(before[name]['p99_us'], 1),
+                'after_p99_us': round(after[name]['p99_us'], 1),
+                'speedup': round(before[name]['median_us'] / max(after[name]['median_us'], 1e-9), 1),
+                'migration_s': round(migration_s, 2)
+            }), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument('--runs', type=int, default=50)
+    args = parser.parse_args()
+    run(args.sizes, args.runs)
@@ -0,0 +1,89 @@
+#In-memory cost of sweeping a deep book with the per-fill Pydantic Transaction the engine used to build
+#and with the engine's __slots__ Fill record. Settlement I/O is left out: it is the same for both.
+#Usage: python -m aaabirzha.benchmarks.bench_matching [--depths 100 1000 10000] [--runs 5]
+#Prints one JSON object per (depth, record) to stdout
+import argparse
+import json
+import statistics
+import time
+import uuid
+from datetime import datetime
+
+from aaabirzha.schemas import Direction, Transaction
+from aaabirzha.orderbook import OrderBook, BookOrder, SELL
+from aaabirzha.matching_engine import Fill
+
+ORDERS_PER_LEVEL = 4
+TAKER_ID = str(uuid.uuid4())
+TAKER_ORDER_ID = str(uuid.uuid4())
+
+
+#As before: validated models and a clock read per fill
+def pydantic_record(offer, amount, ticker, timestamp):
+    return Transaction(
+        user_id=TAKER_ID,
+        init_order=TAKER_ORDER_ID,
+        target_order=offer.id,
+        direction=Direction.BUY,
+        body={'ticker': ticker, 'qty': amount, 'price': offer.price, 'timestamp': datetime.now()}
+    )
+
+
+def slots_record(offer, amount, ticker, timestamp):
+    return Fill(offer.price, amount, Direction.BUY, timestamp, offer.id)
+
+
+RECORDS = {'pydantic': pydantic_record, 'slots': slots_record}
+
+
+def make_book(depth: int) -> OrderBook:
+    book = OrderBook('BENCH')
+    for level in range(depth):
+        for _ in range(ORDERS_PER_LEVEL):
+            book.add(BookOrder(uuid.uuid4(), uuid.uuid4(), SELL, 100 + level, 10))
+    return book
+
+
+#The book walk of match_against_book without the settlement call
+def sweep(book: OrderBook, qty, make_record) -> list:
+    fills = []
+    timestamp = datetime.now()
+    while qty > 0:
+        offer = book.best(SELL)
+        if offer is None:
+            break
+        amount = min(offer.remaining, qty)
+        fills.append(make_record(offer, amount, book.ticker, timestamp))
+        book.fill(offer, amount)
+        qty -= amount
+    return fills
+
+
+def run(depths, runs):
+    for depth in depths:
+        results = {}
+        for name, make_record in RECORDS.items():
+            samples = []
+            for _ in range(runs):
+                book = make_book(depth)
+                start = time.perf_counter()
+                fills = sweep(book, book.volume[SELL], make_record)
+                samples.append(time.perf_counter() - start)
+            results[name] = statistics.median(samples) / len(fills) * 1e6
+        for name, per_fill_us in results.items():
+            print(json.dumps({
+                'benchmark': 'matching',
+                'depth': depth,
+                'fills': depth * ORDERS_PER_LEVEL,
+                'record': name,
+                'per_fill_us': round(per_fill_us, 2),
+                'speedup': round(results['pydantic'] / per_fill_us, 1)
+            }), flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depths', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+    run(args.depths, args.runs)
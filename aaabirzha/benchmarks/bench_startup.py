@@ -0,0 +1,55 @@
+#Worker startup cost: importing the app, which must not touch the database, and init_db on a new
+#database (every migration) and on one whose schema is already current (one version query).
+#Every sample runs in a fresh interpreter, so nothing is cached between runs.
+#Usage: python -m aaabirzha.benchmarks.bench_startup [--runs 20]
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+from aaabirzha.benchmarks.report import latency, emit
+
+#Prints the seconds spent in the measured step
+IMPORT_APP = '''
+import time
+start = time.perf_counter()
+import aaabirzha.main
+print(time.perf_counter() - start)
+'''
+
+INIT_DB = '''
+import logging, time
+logging.disable(logging.INFO)
+import aaabirzha.database as db_fnc
+start = time.perf_counter()
+db_fnc.init_db()
+print(time.perf_counter() - start)
+'''
+
+
+def time_in_subprocess(code: str, db_path: str) -> float:
+    env = {**os.environ, 'AAABIRZHA_DB': db_path}
+    output = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE, text=True, env=env).stdout
+    return float(output.split()[-1])
+
+
+def run(runs: int):
+    directory = tempfile.mkdtemp(prefix='aaabirzha-startup-')
+    current = os.path.join(directory, 'current.db')
+    time_in_subprocess(INIT_DB, current)
+    cases = {
+        'import_app': lambda number: time_in_subprocess(IMPORT_APP, current),
+        'init_db_new': lambda number: time_in_subprocess(INIT_DB, os.path.join(directory, f'new-{number}.db')),
+        'init_db_current': lambda number: time_in_subprocess(INIT_DB, current),
+    }
+    for name, measure in cases.items():
+        samples = [measure(number) for number in range(runs)]
+        emit({'benchmark': 'startup', 'step': name, 'runs': runs, **latency(samples, 1e3, 'ms')})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+    run(args.runs)
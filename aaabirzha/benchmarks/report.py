@@ -0,0 +1,53 @@
+#Shared output of the benchmark suite: one JSON object per result on stdout, so runs can be stored
+#as .jsonl and compared against a baseline with python -m aaabirzha.benchmarks --compare
+import json
+import statistics
+
+#Result fields that are measurements; every other field identifies the case
+LOWER_IS_BETTER = ('_us', '_ms', '_s', 'errors')
+HIGHER_IS_BETTER = ('per_s', 'speedup')
+
+
+def latency(samples: list, scale: float = 1e6, unit: str = 'us') -> dict:
+    samples = sorted(samples)
+    last = len(samples) - 1
+
+    def percentile(p):
+        return round(samples[min(last, int(len(samples) * p))] * scale, 1)
+
+    return {f'p50_{unit}': round(statistics.median(samples) * scale, 1), f'p99_{unit}': percentile(0.99),
+            f'p999_{unit}': percentile(0.999)}
+
+
+def emit(record: dict):
+    print(json.dumps(record), flush=True)
+
+
+def is_metric(field: str) -> bool:
+    return field.endswith(HIGHER_IS_BETTER) or field.endswith(LOWER_IS_BETTER)
+
+
+def case_key(record: dict) -> tuple:
+    return tuple(sorted((k, v) for k, v in record.items() if not is_metric(k)))
+
+
+#Changes of every metric against the baseline worse than threshold (0.2 = 20% slower),
+#as (case, metric, baseline value, current value) tuples
+def regressions(baseline: list, current: list, threshold: float = 0.2) -> list:
+    base = {case_key(record): record for record in baseline}
+    found = []
+    for record in current:
+        previous = base.get(case_key(record))
+        if previous is None:
+            continue
+        for field, value in record.items():
+            old = previous.get(field)
+            if not is_metric(field) or not old or not isinstance(value, (int, float)):
+                continue
+            if field.endswith(HIGHER_IS_BETTER):
+                worse = value < old * (1 - threshold)
+            else:
+                worse = value > old * (1 + threshold)
+            if worse:
+                found.append((dict(case_key(record)), field, old, value))
+    return found
@@ -0,0 +1,172 @@
+import asyncio
+import calendar
+import logging
+import os
+from collections import deque
+from datetime import datetime, timedelta
+
+import aaabirzha.database as db_fnc
+import aaabirzha.db_pool as db_pool
+
+logger = logging.getLogger(__name__)
+
+#Bar lengths in seconds, by the name the candles endpoint takes
+INTERVALS = {'1s': 1, '1m': 60, '1h': 3600, '1d': 86400}
+#Closed bars kept in memory per ticker and interval, also the most the endpoint returns
+CANDLE_HISTORY = int(os.environ.get('AAABIRZHA_CANDLE_HISTORY', 1000))
+#Seconds between writes of the closed bars
+FLUSH_INTERVAL = 1.0
+
+EPOCH = datetime(1970, 1, 1)
+
+
+#Trades carry naive wall-clock timestamps. Bars bucket them read as UTC, exactly like strftime('%s') in the
+#backfill query, so live and backfilled bars of a window get the same start
+def epoch_seconds(timestamp: datetime) -> int:
+    return calendar.timegm(timestamp.timetuple())
+
+
+def bar_time(start: int) -> str:
+    return str(EPOCH + timedelta(seconds=start))
+
+
+#One OHLCV bar in ticks and lots
+class Bar:
+    __slots__ = ('start', 'open', 'high', 'low', 'close', 'volume', 'trades')
+
+    def __init__(self, start: int, open: int, high: int, low: int, close: int, volume: int, trades: int = 1):
+        self.start = start
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume
+        self.trades = trades
+
+    def add(self, price: int, qty: int):
+        if price > self.high:
+            self.high = price
+        elif price < self.low:
+            self.low = price
+        self.close = price
+        self.volume += qty
+        self.trades += 1
+
+    def row(self, ticker: str, seconds: int) -> tuple:
+        return ticker, seconds, self.start, self.open, self.high, self.low, self.close, self.volume, self.trades
+
+    def __repr__(self):
+        return f'Bar({bar_time(self.start)} O{self.open} H{self.high} L{self.low} C{self.close} V{self.volume})'
+
+
+#Incremental OHLCV bars of every ticker and interval, updated by the engine on each fill. The open bar and
+#the last `history` closed bars of each ticker and interval stay in memory and serve the candles endpoint.
+#A bar closes when a trade of a later window arrives or once its window has passed. Closed bars are written
+#to Candles by a background task every flush_interval seconds, never on the matching path
+class CandleAggregator:
+    def __init__(self, history: int = CANDLE_HISTORY, flush_interval: float = FLUSH_INTERVAL):
+        self.history = history
+        self.flush_interval = flush_interval
+        self.open_bars = {}
+        self.closed = {}
+        self.pending = []
+        self.task = None
+
+    def record(self, ticker: str, price: int, qty: int, timestamp: datetime):
+        second = epoch_seconds(timestamp)
+        for seconds in INTERVALS.values():
+            key = (ticker, seconds)
+            start = second - second % seconds
+            bar = self.open_bars.get(key)
+            #An earlier window only shows up if the clock was stepped back, the trade joins the open bar
+            if bar is not None and bar.start >= start:
+                bar.add(price, qty)
+                continue
+            if bar is not None:
+                self._close(key, bar)
+            self.open_bars[key] = Bar(start, price, price, price, price, qty)
+        if self.task is None:
+            self.start()
+
+    def _close(self, key: tuple, bar: Bar):
+        closed = self.closed.get(key)
+        if closed is None:
+            closed = self.closed[key] = deque(maxlen=self.history)
+        closed.append(bar)
+        self.pending.append(bar.row(*key))
+
+    #Closes the open bars whose window ended before now (epoch seconds)
+    def close_expired(self, now: int):
+        for key, bar in list(self.open_bars.items()):
+            if bar.start + key[1] <= now:
+                self._close(key, bar)
+                del self.open_bars[key]
+
+    #Up to limit bars of the ticker, oldest first. The last one is still open when the window is current
+    def bars(self, ticker: str, interval: str, limit: int) -> list:
+        if interval not in INTERVALS:
+            raise ValueError(f'Unknown interval {interval}, expected one of {", ".join(INTERVALS)}')
+        key = (ticker, INTERVALS[interval])
+        bars = list(self.closed.get(key, ()))
+        if key in self.open_bars:
+            bars.append(self.open_bars[key])
+        return bars[-limit:] if limit > 0 else []
+
+    async def flush(self):
+        self.close_expired(epoch_seconds(datetime.now()))
+        if not self.pending:
+            return 0
+        rows, self.pending = self.pending, []
+        try:
+            await db_pool.write(db_fnc.save_candles, rows)
+        except Exception as e:
+            #Kept for the next attempt, the bars would otherwise only come back with a backfill
+            self.pending[:0] = rows
+            logger.error('Failed to write %s candles\n%s', len(rows), e)
+            return 0
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(), name='candles')
+
+    #Also writes the open bars, so a restart continues them
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.pending.extend(bar.row(*key) for key, bar in self.open_bars.items())
+        await self.flush()
+
+    #Startup: catches Candles up with Transactions, then loads the recent bars of the tickers (all of them,
+    #or the given ones) into memory. A daily bar is only stored once its day closed or at shutdown, and the
+    #shorter bars of that day were written with it or before, so bars lost in a crash all lie after the day
+    #before the latest stored daily bar: the catch-up rebuilds every interval from there. A database without
+    #any bar is backfilled from the whole trade history
+    def load(self, tickers: list = None):
+        now = epoch_seconds(datetime.now())
+        if tickers is None:
+            tickers = [row['ticker'] for row in db_fnc.get_all_instruments()]
+        self.open_bars.clear()
+        self.closed.clear()
+        longest = max(INTERVALS.values())
+        last = db_fnc.get_last_candle_start(longest)
+        since = bar_time(last - longest) if last is not None else None
+        written = db_fnc.backfill_candles(INTERVALS.values(), since, tickers)
+        logger.info('%s candles backfilled since %s', written, since or 'the first trade')
+        for seconds in INTERVALS.values():
+            for ticker in tickers:
+                for row in db_fnc.get_recent_candles(ticker, seconds, self.history + 1):
+                    bar = Bar(*row)
+                    if bar.start + seconds > now:
+                        self.open_bars[(ticker, seconds)] = bar
+                    else:
+                        self.closed.setdefault((ticker, seconds), deque(maxlen=self.history)).append(bar)
+
+candles = CandleAggregator()
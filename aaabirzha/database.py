@@ -1,23 +1,86 @@
 import sqlite3 as sql
 import logging
+import os
+import threading
+from pathlib import Path
 
 from aaabirzha.schemas import Direction, MarketOrder, LimitOrder, OrderType, OrderStatus, UserRole
+from aaabirzha.migrations import apply_migrations, current_version
+from aaabirzha.metrics import db_commits
 from typing import Union
 
 
-conn = sql.connect('database.db')
+#Defaults to the database next to this module, so the working directory does not matter
+DB_PATH = os.environ.get('AAABIRZHA_DB', str(Path(__file__).with_name('database.db')))
 
-conn.execute('PRAGMA journal_mode=WAL;')
+#Prepared statements kept per connection. Queries below are fixed strings with bound parameters,
+#so every call after the first reuses the compiled statement
+CACHED_STATEMENTS = 256
 
-with open('Fresh_create_DB.sql', 'r') as freshstart_sql:
-    freshstart_script = freshstart_sql.read()
+#Seconds a write waits for the lock while another process writes: with matching shards the API workers
+#and the shard processes all write to the same file
+BUSY_TIMEOUT = float(os.environ.get('AAABIRZHA_DB_BUSY_TIMEOUT', 30))
 
-main_cursor = conn.cursor()
+#Explicit projections: rows are sqlite3.Row, read by column name, so they no longer depend on the table column order
+ORDER_COLUMNS = 'id, status, user_id, timestamp, direction, ticker, qty, price, filled, type'
+TRANSACTION_COLUMNS = 'id, user_id, ticker, direction, amount, price, timestamp, order_id, counter_order_id'
+
+class WriterConnection(sql.Connection):
+    def commit(self):
+        super().commit()
+        db_commits.inc()
 
-main_cursor.executescript(freshstart_script)
 
 logger = logging.getLogger(__name__)
 
+#The single writer connection, opened by init_db and used from the db_pool writer thread
+conn = None
+#Database the connections are opened on
+db_path = DB_PATH
+
+reader_local = threading.local()
+
+
+#Opens the writer connection and brings the schema up to date. Importing this module touches no file:
+#the app calls this from its startup, scripts and benchmarks before their first query. Calling it again
+#for an open database is a no-op; on a current schema it costs one connect and one version query
+def init_db(path: str = None) -> int:
+    global conn, db_path
+    if conn is not None:
+        return current_version(conn)
+    db_path = path or DB_PATH
+    conn = sql.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False, cached_statements=CACHED_STATEMENTS,
+                       factory=WriterConnection)
+    conn.row_factory = sql.Row
+    conn.execute('PRAGMA journal_mode=WAL;')
+    version = apply_migrations(conn)
+    logger.info('Database %s at schema version %s', db_path, version)
+    return version
+
+
+def close_db():
+    global conn
+    if conn is not None:
+        conn.close()
+        conn = None
+
+
+def connect_reader() -> sql.Connection:
+    reader = sql.connect(Path(db_path).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False,
+                         cached_statements=CACHED_STATEMENTS)
+    reader.row_factory = sql.Row
+    return reader
+
+
+#Initializer of the db_pool reader threads: every reader thread gets its own read-only connection
+def open_reader():
+    reader_local.conn = connect_reader()
+
+
+#Connection for read-only queries: the thread's reader connection inside the reader pool, the writer otherwise
+def read_conn() -> sql.Connection:
+    return getattr(reader_local, 'conn', conn)
+
 
 def create_user(id, name, role, api_key_hashed, api_key=None):
     cursor = conn.cursor()
@@ -32,56 +95,72 @@ VALUES (?, 'RUB')'''
         cursor.execute(users_query, (str(id), name, int(role), api_key_hashed, api_key))
         cursor.execute(userbalance_query, (str(id),))
     except Exception as e:
-        logger.error(e)
-    logger.info(f'User {name} created successfully')
+        logger.error('Failed to create user %s\n%s', name, e)
+    logger.info('User %s created successfully', name)
     conn.commit()
     cursor.close()
 
 
-def create_instrument(name, ticker):
+def create_instrument(name, ticker, tick_size=1, lot_size=1):
     cursor = conn.cursor()
-    logger.debug(f'name: {name}, ticker: {ticker}')
+    logger.debug('name: %s, ticker: %s, tick size: %s, lot size: %s', name, ticker, tick_size, lot_size)
     query = '''
-    INSERT INTO Instruments (name, ticker)
-    VALUES (?, ?);
+    INSERT INTO Instruments (name, ticker, tick_size, lot_size)
+    VALUES (?, ?, ?, ?);
     '''
     try:
-        cursor.execute(query, (name, ticker,))
-        logger.info(f'Instrument {name}:{ticker} created successfully')
+        cursor.execute(query, (name, ticker, str(tick_size), str(lot_size)))
+        logger.info('Instrument %s:%s created successfully', name, ticker)
         conn.commit()
     except Exception as e:
-        logger.error(f'Failed to create instrument\n{e}')
+        logger.error('Failed to create instrument %s\n%s', ticker, e)
     cursor.close()
 
 
 def delete_instrument(ticker):
     cursor = conn.cursor()
-    logger.info(f'Trying to delete instrument with ticker "{ticker}"')
+    logger.info('Trying to delete instrument with ticker "%s"', ticker)
     query = '''
     DELETE FROM Instruments
     WHERE ticker = ?'''
-    logger.debug(f'Delete query:{query}')
     try:
         cursor.execute(query, (ticker,))
-        logger.info(f'Instrument {ticker} deleted')
+        logger.info('Instrument %s deleted', ticker)
         conn.commit()
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to delete instrument {ticker}\n{e}')
+        logger.error('DBError: Failed to delete instrument %s\n%s', ticker, e)
     cursor.close()
 
 
 def get_all_instruments():
-    cursor = conn.cursor()
+    cursor = read_conn().cursor()
     query = '''
-    SELECT DISTINCT name, ticker
+    SELECT DISTINCT name, ticker, tick_size, lot_size
     FROM Instruments'''
     try:
         cursor.execute(query)
-        response = [jsonify(['name', 'ticker'], row) for row in cursor.fetchall()]
+        response = cursor.fetchall()
         cursor.close()
         return response
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to get all instruments\n{e}')
+        logger.error('DBError: Failed to get all instruments\n%s', e)
+
+
+def get_instrument(ticker):
+    cursor = read_conn().cursor()
+    query = '''
+    SELECT name, ticker, tick_size, lot_size
+    FROM Instruments
+    WHERE ticker = ?'''
+    try:
+        cursor.execute(query, (ticker,))
+        response = cursor.fetchone()
+        cursor.close()
+        return response
+    except sql.DatabaseError as e:
+        logger.error('DBError: Failed to get instrument %s\n%s', ticker, e)
+        cursor.close()
+        raise e
 
 
 def new_ticker(user_id, ticker):
@@ -91,37 +170,32 @@ def new_ticker(user_id, ticker):
     VALUES (?, ?)
     '''
 
-    logger.info(f'Trying to add {ticker} balance for user {user_id} ')
+    logger.info('Trying to add %s balance for user %s', ticker, user_id)
 
     try:
         cursor.execute(query, (user_id, ticker))
-        logger.info(f'{ticker} balance added to user {user_id}')
+        logger.info('%s balance added to user %s', ticker, user_id)
         conn.commit()
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to add ticker {ticker} to user {user_id}\n{e}')
+        logger.error('DBError: Failed to add ticker %s to user %s\n%s', ticker, user_id, e)
     cursor.close()
 
 
-def update_balance(user_id, ticker, amount: float, is_freeze=False):
+#amount is in lots of the ticker
+def update_balance(user_id, ticker, amount: int, is_freeze=False):
     cursor = conn.cursor()
     user_id = str(user_id)
 
-    logger.debug(f'''user_id:{user_id}
-ticker: {ticker}
-amount: {amount}
-type: {'deposit' if amount >= 0 else 'withdraw'}
-is freeze: {is_freeze}''')
+    logger.debug('Updating %s %s of user %s by %s', ticker, 'frozen' if is_freeze else 'balance', user_id, amount)
 
     balance = lookup_balance(user_id, ticker)
 
-    logger.debug(f'Balance: {balance}')
-
     if balance is None:
-        logger.info(f'User {user_id} does not have a {ticker} balance')
+        logger.info('User %s does not have a %s balance', user_id, ticker)
         if amount >= 0:
             new_ticker(user_id, ticker)
             balance = 0
-            logger.info(f'{ticker} balance created')
+            logger.info('%s balance created', ticker)
     else:
         balance = balance['balance']
     if amount < 0:
@@ -136,73 +210,53 @@ is freeze: {is_freeze}''')
     '''
     try:
         cursor.execute(query, (amount, user_id, ticker))
-        logger.info(f'''Transaction made. Type is deposit: {amount >= 0}
-        User: {user_id}
-        {f'Ticker {ticker} balance updated from {balance} to {balance + amount}'
-        if not is_freeze else
-        f'Ticker {ticker} frozen value changed by {amount}'}''')
+        if is_freeze:
+            logger.info('User %s: %s frozen value changed by %s', user_id, ticker, amount)
+        else:
+            logger.info('User %s: %s balance updated from %s to %s', user_id, ticker, balance, balance + amount)
         conn.commit()
     except sql.DatabaseError as e:
-        logger.error(f'Failed to add ticker {ticker} to user {user_id}\n{e}')
+        logger.error('Failed to update %s balance of user %s\n%s', ticker, user_id, e)
         raise e
     cursor.close()
 
 
-def exchange_balance(buyer_id, seller_id, ticker, price: float, amount: float):
-    try:
-        update_balance(buyer_id, ticker, amount, False)
-        update_balance(seller_id, 'RUB', amount * price, False)
-        update_balance(seller_id, ticker, -amount, False)
-        update_balance(buyer_id, 'RUB', -amount * price, False)
-
-    except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to exchange balances\n{e}')
-
-
 def lookup(table, key, val):
-    cursor = conn.cursor()
+    cursor = read_conn().cursor()
     query = f'''
     SELECT * FROM {table} WHERE {key} = ?
     '''
-    logger.debug(f'db_fnc.lookup query:{query}')
-    data = cursor.execute(query, (val,))
-    columns = data.description
-    result = jsonify([column[0] for column in columns], cursor.fetchone())
-    logger.debug(f'db_fnc.lookup result:{result}')
+    result = cursor.execute(query, (val,)).fetchone()
     cursor.close()
     return result
 
 
 def lookup_balance(user_id, ticker=None, available_only=False) -> dict:
-    cursor = conn.cursor()
+    cursor = read_conn().cursor()
 
     #If no ticker is specified, returns all tickers for the user
     if not ticker:
         query = f'''
-SELECT ticker, balance{'- frozen' if available_only else ''} 
+SELECT ticker, balance{' - frozen' if available_only else ''} AS balance
 FROM UserBalance
 WHERE user_id = ?'''
-        logger.info(f'Trying to look up balance of all instruments for user {user_id}')
+        logger.debug('Looking up balance of all instruments for user %s', user_id)
 
         cursor.execute(query, (user_id,))
-        response = [jsonify(['ticker', 'balance'], row) for row in cursor.fetchall()]
+        response = cursor.fetchall()
         cursor.close()
         return response
 
     query = f'''
-    SELECT balance{'- frozen' if available_only else ''} 
+    SELECT balance{' - frozen' if available_only else ''} AS balance
     FROM UserBalance 
     WHERE user_id = ? AND ticker = ?
     '''
 
-    logger.info(f'Trying to look up {ticker} balance for {user_id}\nQuery:\n{query}')
+    logger.debug('Looking up %s balance for %s', ticker, user_id)
 
     cursor.execute(query, (user_id, ticker))
     response = cursor.fetchone()
-    if response:
-        response = jsonify(['balance'], response)
-
-    logger.debug(f'Response: {response}')
 
     cursor.close()
     return response
@@ -212,7 +266,7 @@ def delete_user(user_id):
     cursor = conn.cursor()
 
     query = f'''
-SELECT * FROM Users
+SELECT id, name, role, api_key FROM Users
 WHERE id = ?'''
 
     query1 = f'''
@@ -221,156 +275,168 @@ WHERE id = ?'''
 
     try:
         cursor.execute(query, (user_id,))
-        user = jsonify(['id', 'name', 'role', 'api_key'], cursor.fetchone())
+        user = cursor.fetchone()
         if not user:
             logger.error('User not found')
             raise Exception(f"Cannot delete a non-existent user:\nUser {user_id} not found in the database")
 
-        logger.info(f'Trying to delete user {user_id}\nQuery:\n{query1}')
+        logger.info('Trying to delete user %s', user_id)
         cursor.execute(query1, (user_id,))
         conn.commit()
         cursor.close()
         return user
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to delete user {user_id}\n{e}')
+        logger.error('DBError: Failed to delete user %s\n%s', user_id, e)
         cursor.close()
         raise e
 
 
 def get_user_by_api_key(api_key, hashed=True):
     api_key_column = 'api_key_hashed' if hashed else 'api_key'
-    cursor = conn.cursor()
+    cursor = read_conn().cursor()
     query = f'''
-SELECT id, name, role, {api_key_column}
+SELECT id, name, role, {api_key_column} AS api_key
 FROM Users
 WHERE {api_key_column} = ?'''
-    logger.debug(query)
-    logger.debug(api_key)
-    logger.debug(cursor.execute("SELECT * FROM Users").fetchall())
     try:
         cursor.execute(query, (api_key,))
         user = cursor.fetchone()
+        cursor.close()
         if not user:
-            logger.error(f'User with api key "{api_key}" not found')
-            raise Exception(f"User not found")
-        else:
-            user = jsonify(['id', 'name', 'role', 'api_key'], user)
+            logger.info('User with the given api key not found')
+            return None
         return user
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to get user by api_key = {api_key}\n{e}')
+        logger.error('DBError: Failed to get user by api_key\n%s', e)
         cursor.close()
         raise e
 
 
-def trim_order(order, keep_type=False):
-    if OrderType.from_int(order['type']) == OrderType.MARKET:
-        order.pop('price', None)
-        order.pop('filled', None)
-    if not keep_type:
-        order.pop('type', None)
-
-    return order
-
-order_fields = ['id', 'status', 'user_id', 'timestamp', 'direction',
-                        'ticker', 'qty', 'price', 'filled', 'type']
-
-
 def quotify_ticker(ticker: str):
     ticker = ticker.replace('"', '').replace("'", '')
     return f'"{ticker}"'
 
 
-def get_orders_for_user(user_id, ticker=None, make_body=False):
-    cursor = conn.cursor()
+#WHERE, ORDER BY and LIMIT of one keyset page in (timestamp, id) order. after is the (timestamp, id) of the
+#last row of the previous page, so a page is an index range scan of at most limit rows however long the
+#history is. limit None reads to the end
+def page_clause(conditions: list, params: list, after=None, limit=None) -> str:
+    if after is not None:
+        conditions.append('(timestamp, id) > (?, ?)')
+        params.extend(after)
+    params.append(-1 if limit is None else limit)
+    return f"WHERE {' AND '.join(conditions)}\nORDER BY timestamp, id\nLIMIT ?"
+
+
+#One page of the user's orders, optionally of one ticker and/or one status (int encoding)
+def get_orders_for_user(user_id, ticker=None, make_body=False, status=None, after=None, limit=None):
+    cursor = read_conn().cursor()
+    conditions, params = ['user_id = ?'], [str(user_id)]
     if ticker:
-        ticker = quotify_ticker(ticker)
+        conditions.append('ticker = ?')
+        params.append(ticker)
+    if status is not None:
+        conditions.append('status = ?')
+        params.append(status)
     query = f'''
-SELECT * FROM Orders
-WHERE user_id = ?{f' AND ticker = {ticker}' if ticker else ''}'''
-    logger.debug(f'Trying to get orders for user {user_id}. Query:{query}')
+SELECT {ORDER_COLUMNS} FROM Orders
+{page_clause(conditions, params, after, limit)}'''
+    logger.debug('Getting orders for user %s', user_id)
     try:
-        cursor.execute(query, (str(user_id),))
-        response = [trim_order(jsonify(order_fields, order)) for order in cursor.fetchall()]
+        cursor.execute(query, params)
+        response = cursor.fetchall()
         cursor.close()
         return response
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to get order list for user {user_id}\n{e}')
+        logger.error('DBError: Failed to get order list for user %s\n%s', user_id, e)
         cursor.close()
         raise e
 
 
-def get_orders_for_ticker(ticker: str):
-    cursor = conn.cursor()
+#Open limit orders in time priority, used to build the in-memory order books
+def get_open_orders(ticker: str = None):
+    cursor = read_conn().cursor()
     query = f'''
-    SELECT * FROM Orders
-    WHERE ticker = ?
-    AND status IN (0, 2)'''
-    logger.debug(f'Trying to get orders for ticker {ticker}. Query:{query}')
+SELECT {ORDER_COLUMNS} FROM Orders
+WHERE status IN (0, 2) AND type = {OrderType.to_int(OrderType.LIMIT)}{' AND ticker = ?' if ticker else ''}
+ORDER BY timestamp ASC'''
     try:
-        cursor.execute(query, (ticker,))
-        response = [trim_order(jsonify(order_fields, order)) for order in cursor.fetchall()]
-        logger.debug(f'Operation response:\n{response}')
+        cursor.execute(query, (ticker,) if ticker else ())
+        response = cursor.fetchall()
+        cursor.close()
+        return response
+    except sql.DatabaseError as e:
+        logger.error('DBError: Failed to get open orders for ticker %s\n%s', ticker, e)
+        cursor.close()
+        raise e
+
+
+#Open order count, remaining volume and notional per ticker and side, for checking recovered books.
+#Walks the partial idx_orders_open_book index and aggregates in SQLite, no order rows reach Python
+def get_open_book_totals():
+    cursor = read_conn().cursor()
+    query = '''
+SELECT ticker, direction, count(*) AS orders, sum(qty - filled) AS volume, sum(price * (qty - filled)) AS notional
+FROM Orders
+WHERE status IN (0, 2)
+GROUP BY ticker, direction'''
+    try:
+        cursor.execute(query)
+        response = cursor.fetchall()
         cursor.close()
         return response
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to get order list for ticker {ticker}\n{e}')
+        logger.error('DBError: Failed to get open order totals\n%s', e)
         cursor.close()
         raise e
 
 
 def get_order_by_id(order_id):
-    cursor = conn.cursor()
-    logger.info(f'Trying to get order by ID: {order_id}')
+    cursor = read_conn().cursor()
+    logger.debug('Getting order by ID: %s', order_id)
     query = f'''
-SELECT * FROM Orders
+SELECT {ORDER_COLUMNS} FROM Orders
 WHERE id = ?'''
     try:
         cursor.execute(query, (order_id,))
         response = cursor.fetchone()
-        logger.debug(f'Order fetched 1:{response}')
-        if response:
-            response = trim_order(jsonify(order_fields, response))
-        else:
-            return None
-        logger.debug(f'Order fetched 2:{response}')
         cursor.close()
         return response
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to fetch order {order_id}\n{e}')
+        logger.error('DBError: Failed to fetch order %s\n%s', order_id, e)
         cursor.close()
         raise e
 
 
 def get_offers_by_ticker(ticker: str, direction: Direction, price: float = 10000000000000000):
-    cursor = conn.cursor()
+    cursor = read_conn().cursor()
     query = f'''
-SELECT * FROM Orders
+SELECT {ORDER_COLUMNS} FROM Orders
 WHERE ticker = ? AND direction = ?
 AND price <= ?
 AND status IN (0, 2)
 ORDER BY price ASC, timestamp ASC'''
     sum_query = f'''
-SELECT sum(qty) - sum(filled) FROM Orders
+SELECT coalesce(sum(qty) - sum(filled), 0) AS value FROM Orders
 WHERE ticker =? AND direction = ?
 AND price <= ? AND status IN (0, 2)'''
     try:
         cursor.execute(query, (ticker, Direction.to_int(direction), price))
-        offers = [trim_order(jsonify(order_fields, order)) for order in cursor.fetchall()]
+        offers = cursor.fetchall()
         cursor.execute(sum_query, (ticker, Direction.to_int(direction), price))
-        total_qty = jsonify(['value'], cursor.fetchone())
-        total_qty = total_qty if total_qty['value'] is not None else {'value': 0}
+        total_qty = cursor.fetchone()
         cursor.close()
-        logger.debug(offers)
         return offers, total_qty
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to get offers for ticker {ticker} and direction {direction}\n{e}')
+        logger.error('DBError: Failed to get offers for ticker %s and direction %s\n%s', ticker, direction, e)
         cursor.close()
         raise e
 
 
-def cancel_order(order_id: str, user):
+#cash_per_lot_tick of the order's instrument converts the frozen lots times ticks of a BUY order to RUB lots
+def cancel_order(order_id: str, user, cash_per_lot_tick: int = 1):
     cursor = conn.cursor()
-    logger.info(f'Trying to delete order ID {order_id}')
+    logger.info('Trying to cancel order ID %s', order_id)
     query = f'''
 UPDATE Orders
 SET status = 3
@@ -378,58 +444,117 @@ WHERE id = ?'''
     try:
         order = get_order_by_id(order_id)
         if order['user_id'] != str(user.id):
-            logger.error(f"You can only cancel your own orders!\nExpected:{order['user_id']}\nReceived:{user.id}")
+            logger.error('You can only cancel your own orders!\nExpected:%s\nReceived:%s', order['user_id'], user.id)
             raise ValueError('You can only cancel your own orders!')
         frozen = order['qty'] - order['filled']
         frozen_ticker = order['ticker']
         if order['direction'] == Direction.to_int(Direction.BUY):
-            frozen *= order['price']
+            frozen *= order['price'] * cash_per_lot_tick
             frozen_ticker = 'RUB'
 
         cursor.execute(query, (order_id,))
 
         update_balance(str(user.id), frozen_ticker, -frozen, True)
         cursor.close()
-        return True
+        return order
+    except sql.DatabaseError as e:
+        logger.error('DBError: Failed to cancel order %s\n%s', order_id, e)
+        cursor.close()
+        raise e
+
+
+#Tickers in which the user has open limit orders
+def get_open_order_tickers(user_id) -> list:
+    cursor = read_conn().cursor()
+    query = f'''
+SELECT DISTINCT ticker FROM Orders
+WHERE user_id = ? AND status IN (0, 2) AND type = {OrderType.to_int(OrderType.LIMIT)}'''
+    try:
+        cursor.execute(query, (str(user_id),))
+        response = [row['ticker'] for row in cursor.fetchall()]
+        cursor.close()
+        return response
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to cancel order {order_id}\n{e}')
+        logger.error('DBError: Failed to get open order tickers of user %s\n%s', user_id, e)
+        cursor.close()
+        raise e
+
+
+#Cancels every open order of the user in one ticker (optionally one side) in a single transaction: one
+#set-based UPDATE of the orders and one aggregated unfreeze per frozen ticker (RUB for buys, the ticker
+#for sells). Returns the ids of the cancelled orders
+def cancel_orders(user_id, ticker: str, direction: int = None, cash_per_lot_tick: int = 1) -> list:
+    user_id = str(user_id)
+    side_filter = ' AND direction = ?' if direction is not None else ''
+    params = (user_id, ticker, direction) if direction is not None else (user_id, ticker)
+    open_filter = f'''
+WHERE user_id = ? AND ticker = ? AND status IN (0, 2) AND type = {OrderType.to_int(OrderType.LIMIT)}{side_filter}'''
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f'SELECT id, direction, qty - filled AS remaining, price FROM Orders{open_filter}', params)
+        orders = cursor.fetchall()
+        if not orders:
+            cursor.close()
+            return []
+        cursor.execute(f'UPDATE Orders SET status = 3{open_filter}', params)
+        buy = Direction.to_int(Direction.BUY)
+        frozen = {
+            'RUB': sum(row['remaining'] * row['price'] for row in orders if row['direction'] == buy) * cash_per_lot_tick,
+            ticker: sum(row['remaining'] for row in orders if row['direction'] != buy)
+        }
+        for frozen_ticker, amount in frozen.items():
+            if amount:
+                cursor.execute(settle_unfreeze_query, (amount, user_id, frozen_ticker, amount))
+                if cursor.rowcount != 1:
+                    raise ValueError(f'User {user_id} does not have {amount} {frozen_ticker} frozen')
+        conn.commit()
+        cursor.close()
+        logger.info('Cancelled %s %s orders of user %s', len(orders), ticker, user_id)
+        return [row['id'] for row in orders]
+    except (ValueError, sql.DatabaseError) as e:
+        conn.rollback()
+        logger.error('Failed to cancel %s orders of user %s\n%s', ticker, user_id, e)
         cursor.close()
         raise e
 
 
-def create_market_order(order: MarketOrder, user_id: str):
+def create_limit_order(order: LimitOrder, user_id: str):
     cursor = conn.cursor()
     query = f'''
 INSERT INTO Orders
-(id, status, user_id, timestamp, direction, ticker, qty, type)
-VALUES (?, ?, ?, ?, ?, ?, ?, {OrderType.MARKET.value})'''
+(id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {OrderType.to_int(OrderType.LIMIT)})'''
     try:
         cursor.execute(query, (str(order.id), OrderStatus.to_int(order.status), str(user_id), order.timestamp,
-                               Direction.to_int(order.body.direction), order.body.ticker, order.body.qty))
+                               Direction.to_int(order.body.direction), order.body.ticker, order.body.qty,
+                               order.body.price, order.filled))
         conn.commit()
         cursor.close()
         return True
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to create order: {order.model_dump()}\n{e}')
+        logger.error('DBError: Failed to create order %s\n%s', order.id, e)
         cursor.close()
         raise e
 
 
-def create_limit_order(order: LimitOrder, user_id: str):
+#Inserts the limit orders of one batch with a single executemany and commit
+def create_limit_orders(orders: list, user_id: str):
     cursor = conn.cursor()
     query = f'''
 INSERT INTO Orders
 (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
-VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {OrderType.LIMIT.value})'''
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, {OrderType.to_int(OrderType.LIMIT)})'''
+    user_id = str(user_id)
     try:
-        cursor.execute(query, (str(order.id), OrderStatus.to_int(order.status), str(user_id), order.timestamp,
-                               Direction.to_int(order.body.direction), order.body.ticker, order.body.qty,
-                               order.body.price, order.filled))
+        cursor.executemany(query, [(str(order.id), OrderStatus.to_int(order.status), user_id, order.timestamp,
+                                    Direction.to_int(order.body.direction), order.body.ticker, order.body.qty,
+                                    order.body.price, order.filled) for order in orders])
         conn.commit()
         cursor.close()
         return True
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to create order: {order.model_dump()}\n{e}')
+        conn.rollback()
+        logger.error('DBError: Failed to create %s orders of user %s\n%s', len(orders), user_id, e)
         cursor.close()
         raise e
 
@@ -446,74 +571,374 @@ WHERE id = ?'''
         cursor.close()
         return True
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to update order {order.id} status to {new_status}\n{e}')
+        logger.error('DBError: Failed to update order %s status to %s\n%s', order.id, new_status, e)
         cursor.close()
         raise e
 
 
-def fill_order(order: Union[MarketOrder, LimitOrder], amount: int):
-    cursor = conn.cursor()
-    fill_query = f'''
+settle_fill_query = '''
 UPDATE Orders
 SET filled = filled + ?
-WHERE id = ?'''
-    unfreeze_query = f'''
+WHERE id = ? AND status IN (0, 2) AND filled + ? <= qty'''
+
+settle_unfreeze_query = '''
 UPDATE UserBalance
 SET frozen = frozen - ?
-WHERE user_id = ?
-AND ticker = ?'''
-    update_balance(order.user_id, order.body.ticker, -amount, True)
+WHERE user_id = ? AND ticker = ? AND frozen >= ?'''
+
+settle_credit_query = '''
+INSERT INTO UserBalance (user_id, ticker, balance)
+VALUES (?, ?, ?)
+ON CONFLICT (user_id, ticker) DO UPDATE SET balance = balance + excluded.balance'''
+
+settle_debit_query = '''
+UPDATE UserBalance
+SET balance = balance - ?
+WHERE user_id = ? AND ticker = ? AND balance - frozen >= ?'''
+
+
+#Applies one whole match in a single transaction: the fills of both orders (the trigger updates their
+#statuses), the release of the maker's frozen funds and the four balance legs. Every statement is a
+#guarded set-based UPDATE, so if any guard fails nothing of the match is applied.
+#price and maker_price are ticks, qty is lots, cash_per_lot_tick converts their product to RUB lots
+def settle_match(buyer_id, seller_id, ticker: str, price: int, qty: int,
+                 maker_order_id, maker_direction: int, maker_price: int, taker_order_id=None,
+                 cash_per_lot_tick: int = 1):
+    buyer_id, seller_id = str(buyer_id), str(seller_id)
+    cash = qty * price * cash_per_lot_tick
+    if maker_direction == Direction.to_int(Direction.BUY):
+        unfreeze = (qty * maker_price * cash_per_lot_tick, buyer_id, 'RUB')
+    else:
+        unfreeze = (qty, seller_id, ticker)
+    cursor = conn.cursor()
     try:
-        cursor.execute(fill_query, (amount, str(order.id)))
-        # cursor.execute(unfreeze_query, (amount*order.body.price, str(order.user_id), order.body.ticker))
+        cursor.execute(settle_fill_query, (qty, str(maker_order_id), qty))
+        if cursor.rowcount != 1:
+            raise ValueError(f'Order {maker_order_id} cannot be filled by {qty}')
+        if taker_order_id is not None:
+            cursor.execute(settle_fill_query, (qty, str(taker_order_id), qty))
+            if cursor.rowcount != 1:
+                raise ValueError(f'Order {taker_order_id} cannot be filled by {qty}')
+        cursor.execute(settle_unfreeze_query, (unfreeze[0], unfreeze[1], unfreeze[2], unfreeze[0]))
+        if cursor.rowcount != 1:
+            raise ValueError(f'User {unfreeze[1]} does not have {unfreeze[0]} {unfreeze[2]} frozen')
+        cursor.execute(settle_debit_query, (qty, seller_id, ticker, qty))
+        if cursor.rowcount != 1:
+            raise ValueError(f'User {seller_id} does not have {qty} {ticker} available')
+        cursor.execute(settle_debit_query, (cash, buyer_id, 'RUB', cash))
+        if cursor.rowcount != 1:
+            raise ValueError(f'User {buyer_id} does not have {cash} RUB available')
+        cursor.execute(settle_credit_query, (buyer_id, ticker, qty))
+        cursor.execute(settle_credit_query, (seller_id, 'RUB', cash))
         conn.commit()
         cursor.close()
         return True
+    except (ValueError, sql.DatabaseError) as e:
+        conn.rollback()
+        logger.error('Failed to settle %s %s at %s between buyer %s and seller %s\n%s',
+                     qty, ticker, price, buyer_id, seller_id, e)
+        cursor.close()
+        raise e
+
+#One page of the user's trades, optionally of one ticker. Trade ids are integers, so after is (timestamp, int)
+def get_transactions_by_user(user_id, ticker=None, after=None, limit=None):
+    cursor = read_conn().cursor()
+    conditions, params = ['user_id = ?'], [str(user_id)]
+    if ticker:
+        conditions.append('ticker = ?')
+        params.append(ticker)
+    query = f'''
+SELECT {TRANSACTION_COLUMNS} FROM Transactions
+{page_clause(conditions, params, after, limit)}'''
+    try:
+        cursor.execute(query, params)
+        response = cursor.fetchall()
+        cursor.close()
+        return response
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to increase order {order.id} filled field by {amount}\n{e}')
+        logger.error('DBError: Failed to get transactions for user %s and ticker %s\n%s', user_id, ticker, e)
         cursor.close()
         raise e
 
-transaction_fields = ['id', 'user_id', 'ticker', 'direction',
-                      'amount', 'price', 'timestamp']
 
-def get_transactions_by_user(user_id, ticker=None):
+#Bulk insert of trade rows: (user_id, ticker, direction, amount, price, timestamp, order_id, counter_order_id)
+def insert_transactions(rows: list):
     cursor = conn.cursor()
-    if ticker:
-        ticker = quotify_ticker(ticker)
-    query = f'''
-SELECT * FROM Transactions
-WHERE user_id = ?{f' AND ticker = {ticker}'}'''
+    query = '''
+INSERT INTO Transactions (user_id, ticker, direction, amount, price, timestamp, order_id, counter_order_id)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
     try:
-        cursor.execute(query, (str(user_id),))
-        response = [jsonify(transaction_fields, transaction) for transaction in cursor.fetchall()]
+        cursor.executemany(query, rows)
+        conn.commit()
+        cursor.close()
+        return True
+    except sql.DatabaseError as e:
+        conn.rollback()
+        logger.error('DBError: Failed to insert %s transactions\n%s', len(rows), e)
+        cursor.close()
+        raise e
+
+
+#Every balance, read once by the ledger at startup
+def get_all_balances():
+    cursor = read_conn().cursor()
+    query = '''
+SELECT user_id, ticker, balance, frozen FROM UserBalance'''
+    try:
+        cursor.execute(query)
+        response = cursor.fetchall()
         cursor.close()
         return response
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to get transactions for user {user_id} {'and ticker ' +ticker if ticker else ''}\n{e}')
+        logger.error('DBError: Failed to get all balances\n%s', e)
         cursor.close()
         raise e
 
 
-def temp():
+#Remaining volume and notional (lots times ticks) of the open limit orders per user, ticker and side:
+#what those orders keep frozen. Orders of deleted instruments are left out
+def get_open_frozen():
+    cursor = read_conn().cursor()
+    query = f'''
+SELECT user_id, ticker, direction, sum(qty - filled) AS remaining, sum((qty - filled) * price) AS notional
+FROM Orders
+JOIN Instruments USING (ticker)
+WHERE status IN (0, 2) AND type = {OrderType.to_int(OrderType.LIMIT)}
+GROUP BY user_id, ticker, direction'''
     try:
-        pass
+        cursor.execute(query)
+        response = cursor.fetchall()
+        cursor.close()
+        return response
     except sql.DatabaseError as e:
-        logger.error(f'DBError: Failed to AAAAAA\n{e}')
+        logger.error('DBError: Failed to get the frozen amounts of open orders\n%s', e)
+        cursor.close()
         raise e
 
 
-def jsonify(fields: [str], values: Union[list, tuple]) -> {}:
-    if len(fields) < 1 or len(values) < 1:
-        return None
-    count = min(len(fields), len(values))
-    result = {}
-    for i in range(count):
-        result[fields[i]] = values[i]
+#Order changes queued by the balance ledger. The book already checked them, so they carry no guards
+ledger_fill_query = '''
+UPDATE Orders
+SET filled = filled + ?
+WHERE id = ?'''
 
-    return result
+ledger_cancel_query = '''
+UPDATE Orders
+SET status = 3
+WHERE id = ?'''
+
+ledger_balance_query = '''
+INSERT INTO UserBalance (user_id, ticker, balance, frozen)
+VALUES (?, ?, ?, ?)
+ON CONFLICT (user_id, ticker) DO UPDATE SET balance = excluded.balance, frozen = excluded.frozen'''
+
+
+#Writes one batch of the balance ledger in a single transaction: the queued (query, params) order changes
+#in the order they happened, then the current (user_id, ticker, balance, frozen) of every changed balance
+def write_ledger(order_updates: list, balances: list):
+    cursor = conn.cursor()
+    try:
+        for query, params in order_updates:
+            cursor.execute(query, params)
+        cursor.executemany(ledger_balance_query, balances)
+        conn.commit()
+        cursor.close()
+        return True
+    except sql.DatabaseError as e:
+        conn.rollback()
+        logger.error('DBError: Failed to write %s order changes and %s balances\n%s',
+                     len(order_updates), len(balances), e)
+        cursor.close()
+        raise e
+
+
+#Fallback of write_ledger for a batch that broke a constraint: every change is written in its own
+#transaction, so the bad change is logged and skipped instead of holding back everything after it.
+#Returns the number of skipped changes and, if another error stopped it, the order changes it did not
+#write (None when it got through the batch)
+def write_ledger_apart(order_updates: list, balances: list):
+    cursor = conn.cursor()
+    skipped = 0
+    changes = order_updates + [(ledger_balance_query, params) for params in balances]
+    for index, (query, params) in enumerate(changes):
+        try:
+            cursor.execute(query, params)
+            conn.commit()
+        except sql.IntegrityError as e:
+            conn.rollback()
+            skipped += 1
+            logger.error('DBError: Skipped ledger change %s\n%s', params, e)
+        except sql.DatabaseError as e:
+            conn.rollback()
+            logger.error('DBError: Failed to write ledger change %s\n%s', params, e)
+            cursor.close()
+            return skipped, [change for change in changes[index:] if change[0] is not ledger_balance_query]
+    cursor.close()
+    return skipped, None
 
 
 # print(
 #     'sanya loh'
 # )
+
+
+#Tables the admin export dumps: table, columns, and whether its rows can be filtered by timestamp
+EXPORT_TABLES = {
+    'orders': ('Orders', ORDER_COLUMNS, True),
+    'transactions': ('Transactions', TRANSACTION_COLUMNS, True),
+    'balances': ('UserBalance', 'user_id, ticker, balance, frozen', False),
+}
+#Rows fetched (and held in memory) at a time by an export
+EXPORT_BATCH = 1000
+
+
+#Rows of an export table as stored (ticks, lots, int encodings), optionally only those with
+#since <= timestamp < until, in rowid (insertion) order. Arguments are checked right away, the rows are
+#read lazily by the returned generator
+def export_rows(name: str, since: str = None, until: str = None, batch: int = EXPORT_BATCH):
+    if name not in EXPORT_TABLES:
+        raise ValueError(f'Unknown export {name}, expected one of {", ".join(EXPORT_TABLES)}')
+    table, columns, timed = EXPORT_TABLES[name]
+    if (since or until) and not timed:
+        raise ValueError(f'{name} has no timestamp to filter on')
+    conditions, params = [], []
+    if since:
+        conditions.append('timestamp >= ?')
+        params.append(since)
+    if until:
+        conditions.append('timestamp < ?')
+        params.append(until)
+    query = f"SELECT {columns} FROM {table}{' WHERE ' + ' AND '.join(conditions) if conditions else ''}"
+    return fetch_batches(query, params, batch)
+
+
+#Runs one query on its own read-only connection and yields its rows fetchmany(batch) at a time. A single
+#statement reads one WAL snapshot, so the dump is consistent while the writer keeps committing, and memory
+#holds one batch however large the table is. The connection is closed when the generator is
+def fetch_batches(query: str, params, batch: int):
+    reader = connect_reader()
+    try:
+        cursor = reader.execute(query, params)
+        while rows := cursor.fetchmany(batch):
+            yield rows
+    except sql.DatabaseError as e:
+        logger.error('DBError: Export query failed\n%s', e)
+        raise e
+    finally:
+        reader.close()
+
+
+def save_candles(rows: list):
+    cursor = conn.cursor()
+    query = '''
+INSERT OR REPLACE INTO Candles (ticker, interval, start, open, high, low, close, volume, trades)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+    try:
+        cursor.executemany(query, rows)
+        conn.commit()
+        cursor.close()
+    except sql.DatabaseError as e:
+        logger.error('DBError: Failed to save %s candles\n%s', len(rows), e)
+        conn.rollback()
+        cursor.close()
+        raise e
+
+
+#Rebuilds the bars of the given intervals (seconds) from the trades since a timestamp aligned to the longest
+#of them (None for the whole history), with set-based statements. The 1 second bars come from one GROUP BY
+#pass over the trades: trades of a ticker are inserted in time order by its single matching worker, so the
+#lowest and highest id of a bucket are its open and close, read back by rowid. Each longer interval is
+#rolled up from those 1 second bars. A trade is stored as a BUY and a SELL row, only the BUY rows count.
+#Returns the number of bars written
+def backfill_candles(intervals, since: str = None, tickers: list = None) -> int:
+    cursor = conn.cursor()
+    conditions, params = ['direction = 0'], []
+    bar_conditions, bar_params = ['interval = 1'], []
+    if since is not None:
+        conditions.append('timestamp >= ?')
+        params.append(since)
+        bar_conditions.append("start >= CAST(strftime('%s', ?) AS INTEGER)")
+        bar_params.append(since)
+    if tickers is not None:
+        placeholders = ', '.join('?' * len(tickers))
+        conditions.append(f'ticker IN ({placeholders})')
+        params.extend(tickers)
+        bar_conditions.append(f'ticker IN ({placeholders})')
+        bar_params.extend(tickers)
+    trades_query = f'''
+INSERT OR REPLACE INTO Candles (ticker, interval, start, open, high, low, close, volume, trades)
+SELECT bucket.ticker, 1, bucket.start, first.price, bucket.high, bucket.low, last.price, bucket.volume, bucket.trades
+FROM (
+    SELECT ticker, CAST(strftime('%s', timestamp) AS INTEGER) AS start, min(id) AS first_id, max(id) AS last_id,
+           max(price) AS high, min(price) AS low, sum(amount) AS volume, count(*) AS trades
+    FROM Transactions
+    WHERE {' AND '.join(conditions)}
+    GROUP BY ticker, start
+) AS bucket
+JOIN Transactions AS first ON first.id = bucket.first_id
+JOIN Transactions AS last ON last.id = bucket.last_id'''
+    rollup_query = f'''
+INSERT OR REPLACE INTO Candles (ticker, interval, start, open, high, low, close, volume, trades)
+SELECT bucket.ticker, ?, bucket.bucket_start, first.open, bucket.high, bucket.low, last.close, bucket.volume, bucket.trades
+FROM (
+    SELECT ticker, start / ? * ? AS bucket_start, min(start) AS first_start, max(start) AS last_start,
+           max(high) AS high, min(low) AS low, sum(volume) AS volume, sum(trades) AS trades
+    FROM Candles
+    WHERE {' AND '.join(bar_conditions)}
+    GROUP BY ticker, bucket_start
+) AS bucket
+JOIN Candles AS first ON first.ticker = bucket.ticker AND first.interval = 1 AND first.start = bucket.first_start
+JOIN Candles AS last ON last.ticker = bucket.ticker AND last.interval = 1 AND last.start = bucket.last_start'''
+    try:
+        cursor.execute(trades_query, params)
+        count = cursor.rowcount
+        for seconds in intervals:
+            if seconds != 1:
+                cursor.execute(rollup_query, [seconds, seconds, seconds, *bar_params])
+                count += cursor.rowcount
+        conn.commit()
+        cursor.close()
+        return count
+    except sql.DatabaseError as e:
+        logger.error('DBError: Failed to backfill the candles since %s\n%s', since, e)
+        conn.rollback()
+        cursor.close()
+        raise e
+
+
+#Start of the latest stored bar of the interval over all tickers (one primary key seek per instrument)
+def get_last_candle_start(seconds: int):
+    cursor = read_conn().cursor()
+    query = '''
+SELECT max((SELECT max(start) FROM Candles WHERE ticker = Instruments.ticker AND interval = ?)) FROM Instruments'''
+    try:
+        cursor.execute(query, (seconds,))
+        response = cursor.fetchone()[0]
+        cursor.close()
+        return response
+    except sql.DatabaseError as e:
+        logger.error('DBError: Failed to get the last %ss candle\n%s', seconds, e)
+        cursor.close()
+        raise e
+
+
+#Latest limit bars of one ticker and interval, oldest first
+def get_recent_candles(ticker: str, seconds: int, limit: int):
+    cursor = read_conn().cursor()
+    query = '''
+SELECT start, open, high, low, close, volume, trades FROM (
+    SELECT start, open, high, low, close, volume, trades FROM Candles
+    WHERE ticker = ? AND interval = ?
+    ORDER BY start DESC
+    LIMIT ?
+)
+ORDER BY start ASC'''
+    try:
+        cursor.execute(query, (ticker, seconds, limit))
+        response = cursor.fetchall()
+        cursor.close()
+        return response
+    except sql.DatabaseError as e:
+        logger.error('DBError: Failed to get %ss candles of %s\n%s', seconds, ticker, e)
+        cursor.close()
+        raise e
@@ -0,0 +1,37 @@
+import asyncio
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aaabirzha.database as db_fnc
+from aaabirzha.metrics import db_latency
+
+#Number of read-only connections (one per reader thread)
+READ_POOL_SIZE = int(os.environ.get('AAABIRZHA_DB_READERS', min(8, (os.cpu_count() or 1) + 2)))
+
+#All writes go through one thread owning the writer connection, so they stay serialized exactly as
+#before while the event loop is free. Reads run on a bounded pool of read-only connections that WAL
+#lets proceed concurrently with the writer
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+readers = ThreadPoolExecutor(max_workers=READ_POOL_SIZE, thread_name_prefix='db-reader',
+                             initializer=db_fnc.open_reader)
+
+
+#Runs fn on the executor and records the call on the event loop thread, so metrics need no locking
+async def run(executor, pool: str, fn, args, kwargs):
+    start = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+    finally:
+        db_latency.labels(getattr(fn, '__name__', 'other'), pool).observe(time.perf_counter() - start)
+
+
+#Runs a db_fnc function that modifies the database on the writer thread
+async def write(fn, *args, **kwargs):
+    return await run(writer, 'write', fn, args, kwargs)
+
+
+#Runs a read-only db_fnc function on one of the reader connections
+async def read(fn, *args, **kwargs):
+    return await run(readers, 'read', fn, args, kwargs)
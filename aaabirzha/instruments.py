@@ -0,0 +1,113 @@
+from decimal import Decimal
+import logging
+
+import aaabirzha.database as db_fnc
+
+logger = logging.getLogger(__name__)
+
+#Ticker every instrument is priced in
+CASH_TICKER = 'RUB'
+
+
+#Converts a decimal API amount to a whole number of size units
+def to_units(value, size: Decimal, what: str) -> int:
+    units = Decimal(str(value)) / size
+    if units != units.to_integral_value():
+        raise ValueError(f'{what} {value} is not a multiple of {size}')
+    return int(units)
+
+
+#Decimal amount as a JSON number: int when whole, so tick and lot sizes of 1 keep the API unchanged
+def to_number(value: Decimal):
+    return int(value) if value == value.to_integral_value() else float(value)
+
+
+#Fixed-point units of one instrument. Past the API every price is an integer number of ticks (tick_size
+#of cash per unit) and every quantity or balance an integer number of lots (lot_size units), so the engine,
+#the book and the DB only compare and multiply ints. Decimal amounts exist only at the API edge
+class InstrumentSpec:
+    __slots__ = ('ticker', 'tick_size', 'lot_size', 'cash_per_lot_tick')
+
+    def __init__(self, ticker: str, tick_size=1, lot_size=1, cash_lot_size=1):
+        self.ticker = ticker
+        self.tick_size = Decimal(str(tick_size))
+        self.lot_size = Decimal(str(lot_size))
+        if self.tick_size <= 0 or self.lot_size <= 0:
+            raise ValueError(f'Tick and lot size of {ticker} must be positive')
+        #Cash lots paid for one lot at one tick. It has to be whole, so the cash leg of a trade is exact
+        cash = self.tick_size * self.lot_size / Decimal(str(cash_lot_size))
+        if cash != cash.to_integral_value():
+            raise ValueError(f'Tick size {tick_size} times lot size {lot_size} of {ticker} '
+                             f'is not a multiple of the {CASH_TICKER} lot size {cash_lot_size}')
+        self.cash_per_lot_tick = int(cash)
+
+    def ticks(self, price) -> int:
+        return to_units(price, self.tick_size, f'{self.ticker} price')
+
+    def lots(self, qty) -> int:
+        return to_units(qty, self.lot_size, f'{self.ticker} quantity')
+
+    def price(self, ticks: int):
+        return to_number(ticks * self.tick_size)
+
+    def qty(self, lots: int):
+        return to_number(lots * self.lot_size)
+
+    #Cash lots moved by trading lots at ticks
+    def cash(self, lots: int, ticks: int) -> int:
+        return lots * ticks * self.cash_per_lot_tick
+
+    def __repr__(self):
+        return f'InstrumentSpec({self.ticker}, tick {self.tick_size}, lot {self.lot_size})'
+
+
+specs = {}
+#Set by load_specs: from then on specs holds every instrument, kept current by set_spec and drop_spec, so a
+#missing spec means a missing instrument and get_spec never reads the DB on the caller's thread.
+#Before that, e.g. in tools, a missing spec is read from the DB
+specs_loaded = False
+
+
+def spec_from_row(row, cash_lot_size) -> InstrumentSpec:
+    return InstrumentSpec(row['ticker'], row['tick_size'], row['lot_size'], cash_lot_size)
+
+
+def get_spec(ticker: str) -> InstrumentSpec:
+    spec = specs.get(ticker)
+    if spec is None:
+        row = None if specs_loaded else db_fnc.get_instrument(ticker)
+        if row is None:
+            raise ValueError(f'Instrument {ticker} not found')
+        cash_lot_size = row['lot_size'] if ticker == CASH_TICKER else get_spec(CASH_TICKER).lot_size
+        spec = specs[ticker] = spec_from_row(row, cash_lot_size)
+    return spec
+
+
+#Spec for showing stored rows: balances and history of an instrument deleted since stay readable, in
+#lots and ticks of unit size
+def spec_or_units(ticker: str) -> InstrumentSpec:
+    try:
+        return get_spec(ticker)
+    except ValueError:
+        return InstrumentSpec(ticker)
+
+
+#Adds the spec of an instrument just created
+def set_spec(spec: InstrumentSpec):
+    specs[spec.ticker] = spec
+
+
+#Forgets the spec of an instrument just deleted
+def drop_spec(ticker: str):
+    specs.pop(ticker, None)
+
+
+def load_specs():
+    global specs_loaded
+    specs.clear()
+    rows = db_fnc.get_all_instruments()
+    cash_lot_size = next((row['lot_size'] for row in rows if row['ticker'] == CASH_TICKER), 1)
+    for row in rows:
+        specs[row['ticker']] = spec_from_row(row, cash_lot_size)
+    specs_loaded = True
+    logger.info('Tick and lot sizes loaded for %s instruments', len(specs))
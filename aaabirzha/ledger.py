@@ -0,0 +1,286 @@
+import asyncio
+import logging
+import sqlite3 as sql
+
+import aaabirzha.database as db_fnc
+import aaabirzha.db_pool as db_pool
+from aaabirzha.instruments import CASH_TICKER, get_spec
+from aaabirzha.orderbook import BUY
+
+logger = logging.getLogger(__name__)
+
+#Longest a balance change waits in memory before it is written (seconds)
+FLUSH_INTERVAL = 0.05
+
+
+#Balance and frozen part of one user's holding of one ticker, in lots of the ticker
+class Account:
+    __slots__ = ('balance', 'frozen')
+
+    def __init__(self, balance: int = 0, frozen: int = 0):
+        self.balance = balance
+        self.frozen = frozen
+
+    @property
+    def available(self):
+        return self.balance - self.frozen
+
+    def __repr__(self):
+        return f'Account({self.balance}, frozen {self.frozen})'
+
+
+#UserBalance held in memory as user_id -> ticker -> Account, so the engine checks and moves funds with dict
+#lookups instead of a SELECT, an UPDATE and a commit per leg. Every change is queued together with the
+#order fills and cancellations that caused it, and a background task writes the queue every
+#flush_interval seconds as one transaction, in the order it happened: the DB never holds a fill without
+#its balance legs or the other way round. The trade tape flushes the ledger before its own rows.
+#Only a process that owns every balance may load it: with matching shards the balances of a user are
+#moved by several processes, so they are settled in SQLite as before and these methods fall back to it
+class BalanceLedger:
+    def __init__(self, flush_interval: float = FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.accounts = {}
+        self.loaded = False
+        self.dirty = set()
+        self.order_updates = []
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def _get(self, user_id: str, ticker: str) -> Account:
+        accounts = self.accounts.get(user_id)
+        return accounts.get(ticker) if accounts else None
+
+    def _open(self, user_id: str, ticker: str) -> Account:
+        accounts = self.accounts.get(user_id)
+        if accounts is None:
+            accounts = self.accounts[user_id] = {}
+        account = accounts.get(ticker)
+        if account is None:
+            account = accounts[ticker] = Account()
+        return account
+
+    def _changed(self, *keys):
+        self.dirty.update(keys)
+        if self.task is None:
+            self.start()
+
+    #Startup: reads every balance. Frozen amounts are whatever the open limit orders hold, and a limit order
+    #is committed before it is matched while its freeze is written behind, so they are rebuilt from Orders
+    #and the balances that disagree, e.g. after a crash, are written back right away. This is also why the
+    #book snapshot leaves balances out, see recovery.BookJournal
+    def load(self):
+        self.accounts.clear()
+        self.dirty.clear()
+        self.order_updates.clear()
+        stored = {}
+        for row in db_fnc.get_all_balances():
+            self._open(row['user_id'], row['ticker']).balance = row['balance']
+            stored[(row['user_id'], row['ticker'])] = row['frozen']
+        frozen = {}
+        for row in db_fnc.get_open_frozen():
+            if row['direction'] == BUY:
+                key, amount = (row['user_id'], CASH_TICKER), row['notional'] * get_spec(row['ticker']).cash_per_lot_tick
+            else:
+                key, amount = (row['user_id'], row['ticker']), row['remaining']
+            frozen[key] = frozen.get(key, 0) + amount
+        repaired = []
+        for key in stored.keys() | frozen.keys():
+            account = self._open(*key)
+            account.frozen = frozen.get(key, 0)
+            if stored.get(key) != account.frozen:
+                repaired.append((*key, account.balance, account.frozen))
+        if repaired:
+            logger.warning('Frozen amounts of %s balances rebuilt from the open orders', len(repaired))
+            db_fnc.write_ledger([], repaired)
+        self.loaded = True
+        logger.info('Balance ledger loaded with %s users', len(self.accounts))
+
+    #A missing balance is opened by a credit. A withdrawal or a freeze may only take what is available
+    #(balance minus frozen) and an unfreeze only what is frozen: the UserBalance CHECK would refuse the
+    #flush of anything else, long after the change was accepted
+    async def update(self, user_id, ticker: str, amount: int, is_freeze=False):
+        if not self.loaded:
+            return await db_pool.write(db_fnc.update_balance, user_id, ticker, amount, is_freeze=is_freeze)
+        user_id = str(user_id)
+        account = self._get(user_id, ticker)
+        available = account.available if account is not None else 0
+        frozen = account.frozen if account is not None else 0
+        if is_freeze and amount > available:
+            raise ValueError(f'Cannot freeze {amount} {ticker}, only {available} available')
+        if is_freeze and frozen + amount < 0:
+            raise ValueError(f'Cannot unfreeze {-amount} {ticker}, only {frozen} frozen')
+        if not is_freeze and available + amount < 0:
+            raise ValueError(f'Cannot withdraw {-amount} {ticker}, only {available} available')
+        if account is None:
+            account = self._open(user_id, ticker)
+        if is_freeze:
+            account.frozen += amount
+        else:
+            account.balance += amount
+        self._changed((user_id, ticker))
+        return True
+
+    #One match, with the arguments and guards of db_fnc.settle_match: the maker's frozen funds are released,
+    #then the seller must have the lots and the buyer the cash available. taker_price is the price the
+    #taker's funds were reserved at by the pre-trade checks, its share of them is released as well.
+    #A failed guard changes nothing
+    async def settle(self, buyer_id, seller_id, ticker: str, price: int, qty: int,
+                     maker_order_id, maker_direction: int, maker_price: int, taker_order_id=None,
+                     cash_per_lot_tick: int = 1, taker_price: int = None):
+        if not self.loaded:
+            return await db_pool.write(db_fnc.settle_match, buyer_id, seller_id, ticker, price, qty, maker_order_id,
+                                       maker_direction, maker_price, taker_order_id, cash_per_lot_tick)
+        buyer_id, seller_id = str(buyer_id), str(seller_id)
+        cash = qty * price * cash_per_lot_tick
+        buyer_frozen = (buyer_id, CASH_TICKER)
+        seller_frozen = (seller_id, ticker)
+        if maker_direction == BUY:
+            unfreeze = [(buyer_frozen, qty * maker_price * cash_per_lot_tick)]
+            if taker_price is not None:
+                unfreeze.append((seller_frozen, qty))
+        else:
+            unfreeze = [(seller_frozen, qty)]
+            if taker_price is not None:
+                unfreeze.append((buyer_frozen, qty * taker_price * cash_per_lot_tick))
+        released = []
+        try:
+            for (user_id, frozen_ticker), amount in unfreeze:
+                account = self._get(user_id, frozen_ticker)
+                if account is None or account.frozen < amount:
+                    raise ValueError(f'User {user_id} does not have {amount} {frozen_ticker} frozen')
+                account.frozen -= amount
+                released.append((account, amount))
+            lots = self._get(seller_id, ticker)
+            if lots is None or lots.available < qty:
+                raise ValueError(f'User {seller_id} does not have {qty} {ticker} available')
+            money = self._get(buyer_id, CASH_TICKER)
+            if money is None or money.available < cash:
+                raise ValueError(f'User {buyer_id} does not have {cash} {CASH_TICKER} available')
+        except ValueError:
+            for account, amount in released:
+                account.frozen += amount
+            raise
+        lots.balance -= qty
+        money.balance -= cash
+        self._open(buyer_id, ticker).balance += qty
+        self._open(seller_id, CASH_TICKER).balance += cash
+        self.order_updates.append((db_fnc.ledger_fill_query, (qty, str(maker_order_id))))
+        if taker_order_id is not None:
+            self.order_updates.append((db_fnc.ledger_fill_query, (qty, str(taker_order_id))))
+        self._changed(seller_frozen, buyer_frozen, (buyer_id, ticker), (seller_id, CASH_TICKER))
+        return True
+
+    #Freezes amount of the user's available balance for an order that has not reached the engine yet
+    def reserve(self, user_id, ticker: str, amount: int):
+        user_id = str(user_id)
+        account = self._get(user_id, ticker)
+        available = account.available if account is not None else 0
+        if available < amount:
+            raise ValueError(f'Not enough {ticker} available: {amount} needed, {available} available')
+        account.frozen += amount
+        self._changed((user_id, ticker))
+
+    #Gives back the part of a reservation an order did not use
+    def release(self, user_id, ticker: str, amount: int):
+        user_id = str(user_id)
+        account = self._get(user_id, ticker)
+        if account is None or account.frozen < amount:
+            raise ValueError(f'User {user_id} does not have {amount} {ticker} frozen')
+        account.frozen -= amount
+        self._changed((user_id, ticker))
+
+    #Cancels resting orders of one user in one ticker: releases what they still keep frozen and queues their
+    #status change. orders are BookOrders, whose remaining quantity already counts fills not written yet
+    def cancel(self, user_id, ticker: str, orders: list, cash_per_lot_tick: int = 1):
+        user_id = str(user_id)
+        frozen = {
+            CASH_TICKER: sum(order.remaining * order.price for order in orders if order.direction == BUY) * cash_per_lot_tick,
+            ticker: sum(order.remaining for order in orders if order.direction != BUY)
+        }
+        for frozen_ticker, amount in frozen.items():
+            account = self._get(user_id, frozen_ticker)
+            if amount and (account is None or account.frozen < amount):
+                raise ValueError(f'User {user_id} does not have {amount} {frozen_ticker} frozen')
+        changed = []
+        for frozen_ticker, amount in frozen.items():
+            if amount:
+                self._get(user_id, frozen_ticker).frozen -= amount
+                changed.append((user_id, frozen_ticker))
+        self.order_updates.extend((db_fnc.ledger_cancel_query, (order.id,)) for order in orders)
+        self._changed(*changed)
+
+    #Queues the cancellation of an order that never reached the book, behind the fills it already got
+    def close(self, order_id):
+        self.order_updates.append((db_fnc.ledger_cancel_query, (str(order_id),)))
+        self._changed()
+
+    #ticker -> balance of every holding of the user, in lots
+    async def balances(self, user_id) -> dict:
+        if not self.loaded:
+            return {row['ticker']: row['balance'] for row in await db_pool.read(db_fnc.lookup_balance, str(user_id))}
+        return {ticker: account.balance for ticker, account in self.accounts.get(str(user_id), {}).items()}
+
+    #A registered user starts with the empty RUB balance create_user inserted
+    def add_user(self, user_id):
+        if self.loaded:
+            self._open(str(user_id), CASH_TICKER)
+
+    #Called before the user is deleted, so no later flush writes their balances back
+    def drop_user(self, user_id):
+        user_id = str(user_id)
+        if self.accounts.pop(user_id, None) is not None:
+            self.dirty = {key for key in self.dirty if key[0] != user_id}
+
+    #Writes everything queued since the last flush. On failure it stays queued for the next one and the
+    #error is raised, so the trade tape keeps its rows as well. A batch that breaks a constraint would fail
+    #the same way every time, so it is written change by change instead and the bad changes are dropped
+    async def flush(self) -> int:
+        async with self.lock:
+            if not self.dirty and not self.order_updates:
+                return 0
+            order_updates, self.order_updates = self.order_updates, []
+            keys, self.dirty = self.dirty, set()
+            balances = [(user_id, ticker, account.balance, account.frozen)
+                        for user_id, ticker in keys if (account := self._get(user_id, ticker)) is not None]
+            try:
+                await db_pool.write(db_fnc.write_ledger, order_updates, balances)
+            except sql.IntegrityError:
+                skipped, unwritten = await db_pool.write(db_fnc.write_ledger_apart, order_updates, balances)
+                logger.error('Ledger batch broke a constraint, %s of its changes were dropped', skipped)
+                if unwritten is not None:
+                    self.order_updates[:0] = unwritten
+                    self.dirty |= keys
+                    raise sql.DatabaseError(f'{len(unwritten)} order changes and {len(balances)} balances not written')
+            except Exception as e:
+                self.order_updates[:0] = order_updates
+                self.dirty |= keys
+                logger.error('Failed to write %s balances\n%s', len(balances), e)
+                raise e
+            return len(balances)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                #Logged by flush, retried on the next round
+                pass
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(), name='balance-ledger')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        try:
+            await self.flush()
+        except Exception:
+            #Logged by flush, the app is going down either way
+            pass
+
+
+ledger = BalanceLedger()
@@ -0,0 +1,85 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import date, datetime
+from decimal import Decimal
+from uuid import UUID
+
+#Root level, e.g. DEBUG, INFO, WARNING
+LOG_LEVEL = os.environ.get('AAABIRZHA_LOG_LEVEL', 'INFO').upper()
+#Hot-path loggers pass 1 of every LOG_SAMPLE records of the same message below WARNING (1 keeps all)
+LOG_SAMPLE = int(os.environ.get('AAABIRZHA_LOG_SAMPLE', 100))
+LOG_FORMAT = '[%(levelname)s] %(name)s: %(message)s'
+
+#Loggers that log per order or per fill. Admin and audit messages go to other loggers and are all kept
+SAMPLED_LOGGERS = ('aaabirzha.matching_engine.fills',)
+
+#%-args that cannot change after the call, passed to the listener as they are
+IMMUTABLE_ARGS = (str, bytes, int, float, bool, type(None), Decimal, UUID, date, datetime)
+
+
+def freeze_arg(arg):
+    return arg if isinstance(arg, IMMUTABLE_ARGS) else str(arg)
+
+
+#Enqueues the record unformatted. The stock QueueHandler formats the message in the calling thread, here the
+#%-args are only merged by the listener thread, so a request never pays for formatting or stderr writes.
+#Mutable args (books, orders, lists) are turned into strings right away, so they are logged as they were
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        if isinstance(record.args, dict):
+            record.args = {key: freeze_arg(arg) for key, arg in record.args.items()}
+        elif record.args:
+            record.args = tuple(map(freeze_arg, record.args))
+        return record
+
+
+#Keeps 1 of every `every` records per message template. Messages use %-args, so record.msg is the
+#constant template and the counters stay bounded by the number of log statements
+class SamplingFilter(logging.Filter):
+    def __init__(self, every: int):
+        super().__init__()
+        self.every = every
+        self.seen = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        seen = self.seen.get(record.msg, 0)
+        self.seen[record.msg] = seen + 1
+        return seen % self.every == 0
+
+
+listener = None
+
+
+def setup_logging(level: str = LOG_LEVEL, sample: int = LOG_SAMPLE):
+    global listener
+    if listener is not None:
+        return
+    records = queue.SimpleQueue()
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+    root.setLevel(level)
+    if sample > 1:
+        for name in SAMPLED_LOGGERS:
+            logging.getLogger(name).addFilter(SamplingFilter(sample))
+    listener.start()
+    atexit.register(stop_logging)
+
+
+#Writes out the queued records and stops the listener thread
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
@@ -1,5 +1,6 @@
 import uvicorn
-from fastapi import FastAPI, Depends, HTTPException, Body, APIRouter
+from fastapi import FastAPI, Depends, HTTPException, Body, APIRouter, Query, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.security import APIKeyHeader
 from typing import Optional, Union, List
 from uuid import UUID, uuid4
@@ -8,14 +9,36 @@ import secrets
 import hashlib
 import hmac
 import logging
+import asyncio
+import os
+import base64
+import json
+import csv
+import io
+from itertools import repeat
 
 #DB operations stored as functions
 import aaabirzha.database as db_fnc
+import aaabirzha.db_pool as db_pool
 from aaabirzha.matching_engine import execute_market_order, execute_limit_order
-from aaabirzha.schemas import OrderStatus, Direction, L2OrderBook, Level
+import aaabirzha.matching_engine as engine
+from aaabirzha.orderbook import books
+from aaabirzha.recovery import journal
+from aaabirzha.instruments import InstrumentSpec, CASH_TICKER, get_spec, spec_or_units, set_spec, drop_spec, load_specs
+from aaabirzha.sequencer import sequencer
+from aaabirzha.auth_cache import auth_cache
+from aaabirzha.market_data import market_data, orderbook_json, MAX_DEPTH
+from aaabirzha.shards import SHARD_COUNT, shard_client
+from aaabirzha.trade_tape import trade_tape
+from aaabirzha.ledger import ledger
+from aaabirzha.risk import risk
+from aaabirzha.candles import candles, bar_time, CANDLE_HISTORY
+from aaabirzha.metrics import registry, open_orders, lag_probe, MetricsMiddleware
+from aaabirzha.logging_config import setup_logging
+from aaabirzha.schemas import OrderStatus, OrderType, Direction, L2OrderBook, Candle
 
 # Pydantic models
-from schemas import (
+from aaabirzha.schemas import (
     User, UserCreate, Instrument, InstrumentCreate, UserRole,
     MarketOrder, MarketOrderBody, LimitOrder, LimitOrderBody,
     Ok, AlterBalanceRequest, Transaction
@@ -23,12 +46,8 @@ from schemas import (
 
 #Config
 app = FastAPI(title="Stock Exchange API", version="0.3.1")
-db = db_fnc.main_cursor
+app.add_middleware(MetricsMiddleware)
 
-logging.basicConfig(
-    level=logging.DEBUG,       # show debug and above
-    format="[%(levelname)s] %(name)s: %(message)s"
-)
 logger = logging.getLogger(__name__)
 
 #A toggle to (dis)allow the use of unhashed api keys
@@ -37,6 +56,12 @@ logger = logging.getLogger(__name__)
 #такой функционал бы пригодился
 USE_HASHED_API_KEYS = False
 
+#Largest number of orders accepted by one POST /api/v1/order/batch
+MAX_BATCH_ORDERS = int(os.environ.get('AAABIRZHA_MAX_BATCH_ORDERS', 500))
+#Rows per page of the order and transaction history: default for GET /api/v1/order/ and the cap of any limit
+ORDER_PAGE_SIZE = 100
+MAX_PAGE_SIZE = int(os.environ.get('AAABIRZHA_MAX_PAGE_SIZE', 1000))
+
 auth_header = APIKeyHeader(name="Authorization", auto_error=False)
 
 def hash_api_key(raw_key: str) -> str:
@@ -56,20 +81,26 @@ def parse_token_header(header: str) -> str:
         raise HTTPException(status_code=401, detail="Invalid auth scheme (use 'TOKEN')")
     return token
 
-#Get the user whose api key corresponds to the one in the header. Uses SHA256 regardless of the toggle
+#Get the user whose api key corresponds to the one in the header. Uses SHA256 regardless of the toggle.
+#Resolved users are kept in auth_cache, so only the first request with a key (or the first after the TTL) hits the DB.
+#FastAPI caches the dependency per request, so the router-level and handler-level Depends resolve it once
 async def get_current_user(header_value: Optional[str] = Depends(auth_header)) -> User:
     raw_key = parse_token_header(header_value)
     hashed_key = hash_api_key(raw_key)
-    logger.debug(raw_key + '\n' + hashed_key)
 
-    rec = db_fnc.get_user_by_api_key(hashed_key)
-    logger.debug(rec)
+    user = auth_cache.get(hashed_key)
+    if user is not None:
+        return user
+
+    rec = await db_pool.read(db_fnc.get_user_by_api_key, hashed_key)
     if not rec:
         raise HTTPException(status_code=401, detail="Invalid API key")
     if not secure_compare(rec["api_key"], hashed_key):
         raise HTTPException(status_code=401, detail="Invalid API key")
 
-    return User(id=rec["id"], name=rec["name"], role=UserRole.from_int(rec["role"]), api_key = hashed_key if USE_HASHED_API_KEYS else raw_key)
+    user = User(id=rec["id"], name=rec["name"], role=UserRole.from_int(rec["role"]), api_key = hashed_key if USE_HASHED_API_KEYS else raw_key)
+    auth_cache.put(hashed_key, user.id, user)
+    return user
 
 # Role-checking dependency factory
 def require_role(required_role: UserRole):
@@ -85,7 +116,9 @@ def quotify_param(param: str) -> str:
     param = param.replace('"', '').replace("'", '')
     return f'"{param}"'
 
+#data is an Orders row (sqlite3.Row) in ticks and lots; price and filled are only part of a limit order
 def db_response_to_order_dict(data: {}) -> {}:
+    spec = spec_or_units(data['ticker'])
     response = {
         'id': data['id'],
         'status': OrderStatus.from_int(data['status']),
@@ -94,16 +127,73 @@ def db_response_to_order_dict(data: {}) -> {}:
         'body': {
             'direction': Direction.from_int(data['direction']),
             'ticker': data['ticker'],
-            'qty': data['qty']
+            'qty': spec.qty(data['qty'])
         }
     }
-    if 'price' in data.keys():
-        response['body']['price'] = data['price']
-    if 'filled' in data.keys():
-        response['filled'] = data['filled']
+    if OrderType.from_int(data['type']) == OrderType.LIMIT:
+        response['body']['price'] = spec.price(data['price'])
+        response['filled'] = spec.qty(data['filled'])
     return response
 
 
+#With AAABIRZHA_SHARDS set, matching runs in the shard processes owning the tickers (python -m aaabirzha.shards):
+#this worker forwards the matching jobs and relays the market data of the shards
+matcher = shard_client if SHARD_COUNT else sequencer
+feed = shard_client.market_data if SHARD_COUNT else market_data
+
+
+#History pages are keyset paginated. A full page sets the X-Next-Cursor header, an opaque token of its last
+#(timestamp, id) that is passed back as after to get the next page
+def encode_cursor(row) -> str:
+    return base64.urlsafe_b64encode(json.dumps([row['timestamp'], row['id']]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    timestamp, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return timestamp, row_id
+
+
+def page_size(limit: int) -> int:
+    return max(0, min(limit, MAX_PAGE_SIZE))
+
+
+def set_next_cursor(response: Response, rows: list, limit: int):
+    if rows and len(rows) == limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(rows[-1])
+
+
+#The database is opened and migrated here, not on import. Resting order books are recovered once
+#(snapshot, journal tail, DB for whatever disagrees), matching works on them afterwards. Balances are
+#held in memory by the ledger unless they are settled by matching shards
+@app.on_event("startup")
+async def build_order_books():
+    #Records are queued and written by a listener thread, level from AAABIRZHA_LOG_LEVEL. Set up here
+    #rather than on import, so importing the app leaves the logging of its host alone
+    setup_logging()
+    db_fnc.init_db()
+    load_specs()
+    if SHARD_COUNT:
+        await shard_client.connect()
+    else:
+        journal.recover()
+        journal.start()
+        ledger.load()
+        candles.load()
+    lag_probe.start()
+
+
+@app.on_event("shutdown")
+async def stop_matching_workers():
+    await shard_client.close()
+    await sequencer.shutdown()
+    await journal.stop()
+    await trade_tape.stop()
+    await ledger.stop()
+    await candles.stop()
+    await lag_probe.stop()
+    db_fnc.close_db()
+
+
 # Basic routes
 @app.get("/")
 async def root():
@@ -114,6 +204,21 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+
+#Resting order counts are read from the books at scrape time instead of being maintained on every change.
+#With shards this worker has no books, the gauge stays empty
+def collect_open_orders():
+    for ticker, book in books.items():
+        open_orders.labels(ticker).set(len(book))
+
+registry.collectors.append(collect_open_orders)
+
+
+#Prometheus scrape target
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 ###
 
 #Public endpoints, no API token required
@@ -129,7 +234,8 @@ async def create_user(data: UserCreate):
             name=data.name,
             api_key=hashed_key if USE_HASHED_API_KEYS else raw_key
         )
-        db_fnc.create_user(user.id, user.name, UserRole.to_int(user.role), hashed_key, None if USE_HASHED_API_KEYS else raw_key)
+        await db_pool.write(db_fnc.create_user, user.id, user.name, UserRole.to_int(user.role), hashed_key, None if USE_HASHED_API_KEYS else raw_key)
+        ledger.add_user(user.id)
         return user
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
@@ -142,51 +248,109 @@ async def get_instruments():
             name = instrument['name'],
             ticker = instrument['ticker']
             )
-            for instrument in db_fnc.get_all_instruments()
+            for instrument in await db_pool.read(db_fnc.get_all_instruments)
         ]
         return instruments
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
 
 
+#Served from the in-memory L2 aggregate of the resting book (on the owning shard), SQLite is not touched
 @public_router.get("/orderbook/{ticker}", response_model=L2OrderBook)
-async def get_orderbook(ticker: str, limit: int = 10):
+async def get_orderbook(ticker: str, limit: int = Query(10, ge=1, le=MAX_DEPTH)):
     try:
-        orders = db_fnc.get_orders_for_ticker(ticker)
-        orderbook = L2OrderBook(ask_levels=[], bid_levels=[])
-        for order in orders:
-            data = {'price': order['price'], 'qty': order['qty'] - order['filled']}
-            if order['direction'] == 0 and len(orderbook.ask_levels) < limit:
-                orderbook.ask_levels.append(Level(**data))
-            elif len(orderbook.bid_levels) < limit:
-                orderbook.bid_levels.append(Level(**data))
-        return orderbook
+        content = await shard_client.request(ticker, 'orderbook', limit) if SHARD_COUNT else orderbook_json(ticker, limit)
+        return Response(content=content, media_type="application/json")
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
+
+
+#OHLCV bars (1s, 1m, 1h or 1d) of the ticker, oldest first, the last one still open while its window lasts.
+#Served from the aggregator memory (of the owning shard), at most CANDLE_HISTORY bars
+@public_router.get("/candles/{ticker}", response_model=List[Candle])
+async def get_candles(ticker: str, interval: str = '1m', limit: int = 100):
+    try:
+        spec = get_spec(ticker)
+        limit = min(limit, CANDLE_HISTORY + 1)
+        bars = await shard_client.request(ticker, 'candles', interval, limit) if SHARD_COUNT else candles.bars(ticker, interval, limit)
+        return [Candle(
+            timestamp=bar_time(bar.start),
+            open=spec.price(bar.open),
+            high=spec.price(bar.high),
+            low=spec.price(bar.low),
+            close=spec.price(bar.close),
+            volume=spec.qty(bar.volume),
+            trades=bar.trades
+        )
+            for bar in bars
+        ]
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
 
 
+#Market data stream: a snapshot of the book followed by sequenced L2 deltas and trade prints, as Server-Sent Events
+@public_router.get("/stream/{ticker}")
+async def stream_market_data(ticker: str):
+    subscription = feed.subscribe(ticker)
+
+    async def events():
+        try:
+            while True:
+                yield f'data: {await subscription.get()}\n\n'
+        finally:
+            feed.unsubscribe(subscription)
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+#Same stream over a WebSocket, one JSON message per frame
+@app.websocket("/api/v1/public/ws/{ticker}")
+async def stream_market_data_ws(websocket: WebSocket, ticker: str):
+    await websocket.accept()
+    subscription = feed.subscribe(ticker)
+    try:
+        while True:
+            await websocket.send_text(await subscription.get())
+    except WebSocketDisconnect:
+        pass
+    finally:
+        feed.unsubscribe(subscription)
+
+
 @public_router.get("/transactions/{ticker}")
-async def get_transactions(ticker: str, limit: int = 10, current_user: User = Depends(get_current_user)):
+async def get_transactions(ticker: str, response: Response, limit: int = 10, after: Optional[str] = None,
+                           current_user: User = Depends(get_current_user)):
     try:
-        transactions = db_fnc.get_transactions_by_user(current_user.id, ticker=quotify_param(ticker))
+        limit = page_size(limit)
+        transactions = await db_pool.read(db_fnc.get_transactions_by_user, current_user.id, ticker=ticker,
+                                          after=decode_cursor(after) if after else None, limit=limit)
+        set_next_cursor(response, transactions, limit)
+        spec = spec_or_units(ticker)
         transactions = [Transaction(
-            ticker = trans['ticker'],
-            amount = trans['amount'],
-            price = trans['price'],
-            timestamp = trans['timestamp']
+            user_id = trans['user_id'],
+            init_order = trans['order_id'],
+            target_order = trans['counter_order_id'],
+            direction = Direction.from_int(trans['direction']),
+            body = {
+                'ticker': trans['ticker'],
+                'qty': spec.qty(trans['amount']),
+                'price': spec.price(trans['price']),
+                'timestamp': trans['timestamp']
+            }
         )
             for trans in transactions
         ]
-        limit = min(limit, len(transactions))
-        return transactions[:limit]
+        return transactions
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
 
 
+#Served from the balance ledger when it is loaded
 @app.get("/api/v1/balance", tags=["balance"])
 async def get_balance(current_user: User = Depends(get_current_user)):
     try:
-        return db_fnc.lookup_balance(current_user.id, ticker=None)
+        balances = await ledger.balances(current_user.id)
+        return [{'ticker': ticker, 'balance': spec_or_units(ticker).qty(balance)} for ticker, balance in balances.items()]
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
 
@@ -197,52 +361,125 @@ app.include_router(public_router)
 order_router = APIRouter(prefix="/api/v1/order", tags=["order"], dependencies=[Depends(get_current_user)])
 
 
+#The user's orders oldest first, one page at a time, optionally of one ticker and/or one status.
+#Fills and cancellations still queued in the ledger are written first, so a client sees its own
 @order_router.get('/')
-async def get_orders(current_user: User = Depends(get_current_user)):
+async def get_orders(response: Response, ticker: Optional[str] = None, status: Optional[OrderStatus] = None,
+                     after: Optional[str] = None, limit: int = ORDER_PAGE_SIZE, current_user: User = Depends(get_current_user)):
     try:
-        return list(map(db_response_to_order_dict, db_fnc.get_orders_for_user(str(current_user.id))))
+        limit = page_size(limit)
+        await ledger.flush()
+        orders = await db_pool.read(db_fnc.get_orders_for_user, str(current_user.id), ticker=ticker,
+                                    status=OrderStatus.to_int(status) if status else None,
+                                    after=decode_cursor(after) if after else None, limit=limit)
+        set_next_cursor(response, orders, limit)
+        return list(map(db_response_to_order_dict, orders))
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
 
+#Past this point the order carries lots and ticks of its instrument
+def build_order(create_request: Union[LimitOrderBody, MarketOrderBody], user: User) -> Union[MarketOrder, LimitOrder]:
+    spec = get_spec(create_request.ticker)
+    if isinstance(create_request, MarketOrderBody):
+        return MarketOrder(
+            id=uuid4(),
+            status=OrderStatus.NEW,
+            user_id=user.id,
+            body = {
+                'direction': create_request.direction,
+                'ticker': create_request.ticker,
+                'qty': spec.lots(create_request.qty)
+            },
+            timestamp=datetime.now()
+        )
+    return LimitOrder(
+        id=uuid4(),
+        status=OrderStatus.NEW,
+        user_id=user.id,
+        body={
+            'direction': create_request.direction,
+            'ticker': create_request.ticker,
+            'qty': spec.lots(create_request.qty),
+            'price': spec.ticks(create_request.price)
+        },
+        timestamp=datetime.now()
+    )
+
+
+#The pre-trade checks reserve the order's funds before it is stored or queued, a rejected order goes no further
 @order_router.post('/')
 async def create_order(create_request: Union[LimitOrderBody, MarketOrderBody], current_user: User = Depends(get_current_user)):
+    order = None
     try:
-        if isinstance(create_request, MarketOrderBody):
-            order = MarketOrder(
-                id=uuid4(),
-                status=OrderStatus.NEW,
-                user_id=current_user.id,
-                body = {
-                    'direction': create_request.direction,
-                    'ticker': create_request.ticker,
-                    'qty': create_request.qty
-                },
-                timestamp=datetime.now()
-            )
-            await execute_market_order(order, current_user)
+        order = build_order(create_request, current_user)
+        risk.check(order, current_user)
+        if isinstance(order, MarketOrder):
+            await matcher.submit(order.body.ticker, execute_market_order, order, current_user)
         else:
-            order = LimitOrder(
-                id=uuid4(),
-                status=OrderStatus.NEW,
-                user_id=current_user.id,
-                body={
-                    'direction': create_request.direction,
-                    'ticker': create_request.ticker,
-                    'qty': create_request.qty,
-                    'price': create_request.price
-                },
-                timestamp=datetime.now()
-            )
-            db_fnc.create_limit_order(order, str(current_user.id))
-            await execute_limit_order(order, current_user)
+            await db_pool.write(db_fnc.create_limit_order, order, str(current_user.id))
+            await matcher.submit(order.body.ticker, execute_limit_order, order, current_user)
     except Exception as e:
+        if order is not None:
+            risk.discard(order, current_user)
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
     return {"success": True, "order_id": order.id}
 
+
+#Auth and body validation run once for the whole batch. Orders are grouped by ticker, every group is one
+#sequencer job that inserts its limit orders together and matches the group in submission order, and the
+#groups of different tickers run concurrently. Each order gets its own result, a failed one does not fail the rest.
+#The pre-trade checks run per order, in submission order, so every order is checked against the funds the
+#ones before it reserved
+@order_router.post('/batch')
+async def create_orders(create_requests: List[Union[LimitOrderBody, MarketOrderBody]], current_user: User = Depends(get_current_user)):
+    if len(create_requests) > MAX_BATCH_ORDERS:
+        raise HTTPException(status_code=422, detail=f"Validation Error: at most {MAX_BATCH_ORDERS} orders per batch")
+    results = [None] * len(create_requests)
+    groups = {}
+    for index, create_request in enumerate(create_requests):
+        try:
+            order = build_order(create_request, current_user)
+            risk.check(order, current_user)
+        except Exception as e:
+            results[index] = {"success": False, "detail": f"Validation Error: {e}"}
+            continue
+        positions, orders = groups.setdefault(order.body.ticker, ([], []))
+        positions.append(index)
+        orders.append(order)
+
+    outcomes = await asyncio.gather(*(matcher.submit(ticker, engine.execute_batch, orders, current_user)
+                                      for ticker, (positions, orders) in groups.items()), return_exceptions=True)
+    #Reservations the engine did not take, e.g. when inserting the group failed
+    for positions, orders in groups.values():
+        for order in orders:
+            risk.discard(order, current_user)
+    for (positions, orders), outcome in zip(groups.values(), outcomes):
+        for position, order, result in zip(positions, orders, outcome if isinstance(outcome, list) else repeat(outcome)):
+            if isinstance(result, Exception):
+                results[position] = {"success": False, "order_id": order.id, "detail": f"Validation Error: {result}"}
+            else:
+                results[position] = {"success": True, "order_id": order.id}
+    return results
+
+#Cancels the user's open orders: all of them, or only those of one ticker and/or one side. Each ticker is
+#cancelled by one job on its matching worker (one DB transaction, one bulk book update), tickers run concurrently
+@order_router.delete('')
+async def cancel_orders(ticker: Optional[str] = None, direction: Optional[Direction] = None,
+                        current_user: User = Depends(get_current_user)):
+    try:
+        tickers = [ticker] if ticker else await db_pool.read(db_fnc.get_open_order_tickers, str(current_user.id))
+        side = int(Direction.to_int(direction)) if direction else None
+        cancelled = await asyncio.gather(*(matcher.submit(ticker, engine.cancel_orders, current_user, ticker, side)
+                                           for ticker in tickers))
+        return {"success": True, "cancelled": [order_id for order_ids in cancelled for order_id in order_ids]}
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
+
 @order_router.get('/{order_id}', response_model=Union[MarketOrder, LimitOrder])
 async def get_order_details(order_id: str):
     try:
-        response = db_response_to_order_dict(db_fnc.get_order_by_id(order_id))
+        await ledger.flush()
+        response = db_response_to_order_dict(await db_pool.read(db_fnc.get_order_by_id, order_id))
         # body = {
         #     'direction': Direction.from_int(response.pop('direction')),
         #     'ticker': response.pop('ticker'),
@@ -258,7 +495,10 @@ async def get_order_details(order_id: str):
 @order_router.delete('/{order_id}', response_model=Ok)
 async def cancel_order(order_id: str, current_user: User = Depends(get_current_user)):
     try:
-        db_fnc.cancel_order(str(order_id), current_user)
+        order = await db_pool.read(db_fnc.get_order_by_id, str(order_id))
+        if not order:
+            raise ValueError(f'Order {order_id} not found')
+        await matcher.submit(order['ticker'], engine.cancel_order, str(order_id), current_user, order['ticker'])
         return Ok
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
@@ -269,10 +509,22 @@ app.include_router(order_router)
 #Admin endpoints, ADMIN user role dependency check included
 admin_router = APIRouter(prefix="/api/v1/admin", tags=["admin"], dependencies=[Depends(require_role(UserRole.ADMIN))])
 
+#The user's resting orders are cancelled first, one job per ticker on its matching worker: left in the
+#book they would match against funds that no longer exist
 @admin_router.delete("/user/{user_id}", response_model=User, tags=["admin", "user"])
 async def delete_user(user_id: UUID):
     try:
-        user_data = db_fnc.delete_user(str(user_id))
+        user_data = await db_pool.read(db_fnc.lookup, 'Users', 'id', str(user_id))
+        if user_data:
+            user = User(id=user_data['id'], name=user_data['name'], role=UserRole.from_int(user_data['role']),
+                        api_key=user_data['api_key'])
+            tickers = await db_pool.read(db_fnc.get_open_order_tickers, str(user_id))
+            await asyncio.gather(*(matcher.submit(ticker, engine.cancel_orders, user, ticker) for ticker in tickers))
+            await ledger.flush()
+        ledger.drop_user(user_id)
+        user_data = await db_pool.write(db_fnc.delete_user, str(user_id))
+        #On the event loop, like every other use of the cache
+        auth_cache.invalidate_user(str(user_id))
         user = User(
             id=user_data['id'],
             name=user_data['name'],
@@ -291,7 +543,14 @@ async def create_instrument(create_request: InstrumentCreate):
             name = create_request.name,
             ticker = create_request.ticker
         )
-        db_fnc.create_instrument(instrument.name, instrument.ticker)
+        #Rejects sizes whose cash leg would not be a whole number of RUB lots
+        spec = InstrumentSpec(instrument.ticker, create_request.tick_size, create_request.lot_size,
+                              get_spec(CASH_TICKER).lot_size)
+        await db_pool.write(db_fnc.create_instrument, instrument.name, instrument.ticker,
+                            create_request.tick_size, create_request.lot_size)
+        set_spec(spec)
+        if SHARD_COUNT:
+            await shard_client.request(instrument.ticker, 'set_spec', spec)
         return Ok()
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
@@ -299,7 +558,10 @@ async def create_instrument(create_request: InstrumentCreate):
 @admin_router.delete("/instrument/{ticker}", response_model=Ok)
 async def delete_instrument(ticker: str):
     try:
-        db_fnc.delete_instrument(ticker)
+        await db_pool.write(db_fnc.delete_instrument, ticker)
+        drop_spec(ticker)
+        if SHARD_COUNT:
+            await shard_client.request(ticker, 'drop_spec')
         return Ok()
     except Exception as e:
         raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
@@ -307,10 +569,11 @@ async def delete_instrument(ticker: str):
 
 @admin_router.post("/balance/deposit", response_model=Ok, tags=["admin", "balance"])
 async def update_balance(request: AlterBalanceRequest):
-    if not db_fnc.lookup('Users', 'id', str(request.user_id)):
+    if not await db_pool.read(db_fnc.lookup, 'Users', 'id', str(request.user_id)):
         raise HTTPException(status_code=422, detail='User not found')
     try:
-        db_fnc.update_balance(request.user_id, request.ticker, request.amount, False)
+        amount = get_spec(request.ticker).lots(request.amount)
+        await ledger.update(request.user_id, request.ticker, amount)
         return Ok()
     except Exception as e:
         if isinstance(e, ValueError):
@@ -324,9 +587,54 @@ async def admin_withdraw(request: AlterBalanceRequest):
     request.amount *= -1
     return await update_balance(request)
 
+#Serializers of the export: one chunk per batch of rows, iterated by StreamingResponse on a worker thread
+def ndjson_chunks(batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(row)) + '\n' for row in rows)
+
+
+def csv_chunks(batches, columns: list):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+#Streams a whole table for back-office jobs: orders, transactions or balances as newline-delimited JSON,
+#or CSV with format=csv, optionally only rows with since <= timestamp < until. Rows are read with fetchmany
+#on a dedicated read-only connection off the event loop, so memory stays at one batch and order entry
+#keeps running. Amounts are raw ticks and lots, see the tick and lot sizes of the instruments
+@admin_router.get("/export/{table}", tags=["admin"])
+async def export_table(table: str, format: str = 'ndjson', since: Optional[datetime] = None,
+                       until: Optional[datetime] = None):
+    try:
+        if format not in ('ndjson', 'csv'):
+            raise ValueError(f'Unknown format {format}, expected ndjson or csv')
+        batches = db_fnc.export_rows(table, str(since) if since else None, str(until) if until else None)
+    except Exception as e:
+        raise HTTPException(status_code=422, detail=f"Validation Error: {e}")
+    headers = {'Content-Disposition': f'attachment; filename="{table}.{format}"'}
+    if format == 'csv':
+        columns = db_fnc.EXPORT_TABLES[table][1].split(', ')
+        return StreamingResponse(csv_chunks(batches, columns), media_type='text/csv', headers=headers)
+    return StreamingResponse(ndjson_chunks(batches), media_type='application/x-ndjson', headers=headers)
+
+
+#Queue depth and wait time of the per-ticker matching workers (of every shard)
+@admin_router.get("/sequencer", tags=["admin"])
+async def get_sequencer_stats():
+    return await shard_client.stats() if SHARD_COUNT else sequencer.stats()
+
 app.include_router(admin_router)
 
 
 
 if __name__ == "__main__":
+    setup_logging()
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,139 @@
+import asyncio
+import json
+import logging
+import os
+
+from aaabirzha.orderbook import OrderBook, books, BUY, SELL
+from aaabirzha.instruments import InstrumentSpec, get_spec
+from aaabirzha.schemas import L2OrderBook, Level
+
+logger = logging.getLogger(__name__)
+
+#Messages buffered per subscriber before it is considered slow
+SUBSCRIBER_BUFFER = 256
+#Deepest order book a client may ask for, in price levels per side
+MAX_DEPTH = int(os.environ.get('AAABIRZHA_MAX_DEPTH', 100))
+
+
+#[[ticks, lots], ...] book levels as [[price, qty], ...] API amounts
+def api_levels(spec: InstrumentSpec, levels) -> list:
+    return [[spec.price(price), spec.qty(qty)] for price, qty in levels]
+
+
+class Subscription:
+    __slots__ = ('ticker', 'queue', 'conflations')
+
+    def __init__(self, ticker: str, maxsize: int):
+        self.ticker = ticker
+        self.queue = asyncio.Queue(maxsize)
+        self.conflations = 0
+
+    async def get(self) -> str:
+        return await self.queue.get()
+
+
+#Fans book deltas and trade prints out to streaming subscribers.
+#Every message of a ticker carries a sequence number. A subscriber first receives a snapshot and then
+#applies the deltas with a greater seq. Publishing never waits: when a subscriber's buffer is full its
+#backlog is conflated into a fresh snapshot, so a slow client only costs itself and never the matcher
+class MarketDataHub:
+    def __init__(self, buffer: int = SUBSCRIBER_BUFFER):
+        self.buffer = buffer
+        self.subscribers = {}
+        self.seq = {}
+
+    def subscribe(self, ticker: str) -> Subscription:
+        subscription = Subscription(ticker, self.buffer)
+        subscription.queue.put_nowait(self.snapshot(ticker))
+        self.attach(subscription)
+        return subscription
+
+    #Adds a subscription without queueing a snapshot for it
+    def attach(self, subscription: Subscription):
+        self.subscribers.setdefault(subscription.ticker, set()).add(subscription)
+        logger.info('Market data subscriber added for %s', subscription.ticker)
+
+    def unsubscribe(self, subscription: Subscription):
+        subscribers = self.subscribers.get(subscription.ticker)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscribers[subscription.ticker]
+
+    def snapshot(self, ticker: str) -> str:
+        book = books.get(ticker)
+        spec = get_spec(ticker) if book else None
+        return json.dumps({
+            'type': 'snapshot',
+            'ticker': ticker,
+            'seq': self.seq.get(ticker, 0),
+            'bids': api_levels(spec, book.depth(BUY, len(book.keys[BUY]))) if book else [],
+            'asks': api_levels(spec, book.depth(SELL, len(book.keys[SELL]))) if book else []
+        })
+
+    #Publishes the levels changed since the last call and the trades of one matching step.
+    #trades are (ticks, lots, taker direction, timestamp) tuples
+    def publish(self, book: OrderBook, trades=()):
+        changes = book.drain_changes()
+        subscribers = self.subscribers.get(book.ticker)
+        if not subscribers:
+            return
+        spec = get_spec(book.ticker)
+        for price, qty, direction, timestamp in trades:
+            self._send(book.ticker, subscribers, {
+                'type': 'trade', 'price': spec.price(price), 'qty': spec.qty(qty), 'side': direction,
+                'timestamp': str(timestamp)
+            })
+        if changes[BUY] or changes[SELL]:
+            self._send(book.ticker, subscribers, {
+                'type': 'delta', 'bids': api_levels(spec, changes[BUY]), 'asks': api_levels(spec, changes[SELL])
+            })
+
+    def _send(self, ticker: str, subscribers, message: dict):
+        seq = self.seq[ticker] = self.seq.get(ticker, 0) + 1
+        message['ticker'] = ticker
+        message['seq'] = seq
+        payload = json.dumps(message)
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                self._conflate(subscription)
+
+    def _conflate(self, subscription: Subscription):
+        queue = subscription.queue
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(self.snapshot(subscription.ticker))
+        subscription.conflations += 1
+        if subscription.conflations == 1 or subscription.conflations % 100 == 0:
+            logger.warning('Slow market data subscriber on %s conflated %s times',
+                           subscription.ticker, subscription.conflations)
+
+
+market_data = MarketDataHub()
+
+#ticker -> (book version, {limit: serialized L2OrderBook}). A response is reused until the book changes.
+#Only tickers with a book are cached and limit is at most MAX_DEPTH, so clients cannot grow it at will
+orderbook_cache = {}
+EMPTY_ORDERBOOK = L2OrderBook(bid_levels=[], ask_levels=[]).model_dump_json()
+
+
+#Top limit levels of each side of the resting book as a serialized L2OrderBook, SQLite is not touched
+def orderbook_json(ticker: str, limit: int) -> str:
+    book = books.get(ticker)
+    if book is None:
+        return EMPTY_ORDERBOOK
+    limit = min(max(limit, 1), MAX_DEPTH)
+    cached = orderbook_cache.get(ticker)
+    if cached is None or cached[0] != book.version:
+        cached = orderbook_cache[ticker] = (book.version, {})
+    content = cached[1].get(limit)
+    if content is None:
+        spec = get_spec(ticker)
+        orderbook = L2OrderBook(
+            bid_levels=[Level(price=spec.price(price), qty=spec.qty(qty)) for price, qty in book.depth(BUY, limit)],
+            ask_levels=[Level(price=spec.price(price), qty=spec.qty(qty)) for price, qty in book.depth(SELL, limit)]
+        )
+        content = cached[1][limit] = orderbook.model_dump_json()
+    return content
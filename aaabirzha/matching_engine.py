@@ -1,138 +1,228 @@
-from aaabirzha.schemas import LimitOrderBody, OrderStatus
-from aaabirzha.schemas import (MarketOrder, LimitOrder, Direction,
-                     TransactionBody, Transaction, User)
+from aaabirzha.schemas import MarketOrder, LimitOrder, Direction, OrderStatus, User
 import aaabirzha.database as db_fnc
+import aaabirzha.db_pool as db_pool
+from aaabirzha.orderbook import BookOrder, OrderBook, get_book, BUY
+from aaabirzha.instruments import get_spec
+from aaabirzha.market_data import market_data
+from aaabirzha.trade_tape import trade_tape
+from aaabirzha.candles import candles
+from aaabirzha.ledger import ledger
+from aaabirzha.risk import risk
+from aaabirzha.recovery import journal
+from aaabirzha.metrics import fills as fill_counters
 from datetime import datetime
 import logging
 
 logger = logging.getLogger(__name__)
+#Per order and per fill progress, sampled by logging_config
+fill_logger = logging.getLogger(__name__ + '.fills')
 
-async def execute_market_order(order: MarketOrder, user: User):
-    counter_direction = Direction.BUY if order.body.direction == "SELL" else Direction.SELL
-    offers, total_qty = db_fnc.get_offers_by_ticker(order.body.ticker, counter_direction)
-    remaining_qty = order.body.qty
-    if total_qty['value'] < remaining_qty:
-        logger.info(f'Failed to execute order {order.id}: not enough standing orders! ({total_qty}/{remaining_qty})')
-        return None
+
+#One execution of an incoming order against a resting one. Only built and read inside the engine,
+#so it is a plain __slots__ record instead of a validated Transaction model
+class Fill:
+    __slots__ = ('price', 'qty', 'direction', 'timestamp', 'maker_order_id')
+
+    def __init__(self, price, qty, direction, timestamp, maker_order_id):
+        self.price = price
+        self.qty = qty
+        self.direction = direction
+        self.timestamp = timestamp
+        self.maker_order_id = maker_order_id
+
+    def __repr__(self):
+        return f'Fill({self.direction} {self.qty}@{self.price} against {self.maker_order_id})'
+
+
+#Orders reach the engine with qty in lots and price in ticks of their instrument, all arithmetic here is on ints.
+#Walks the counter side of the book from the best price while the incoming order still has quantity
+#and the price is within the limit (no limit for market orders). Settled trades are appended to fills.
+#taker_price is the price the order's funds were reserved at by the pre-trade checks, None if they were not.
+#All fills of one incoming order share its execution timestamp. Returns the quantity left unmatched
+async def match_against_book(order, user: User, book: OrderBook, side: int, fills: list,
+                             limit_price=None, taker_order_id=None, taker_price=None):
+    counter_side = 1 - side
     remaining_qty = order.body.qty
-    transactions = []
-    for offer in offers:
-        try:
-            offer_order = LimitOrder(
-                id = offer['id'],
-                status = OrderStatus.from_int(offer['status']),
-                user_id = offer['user_id'],
-                body = {
-                    'direction': Direction.from_int(offer['direction']),
-                    'ticker': offer['ticker'],
-                    'qty': offer['qty'],
-                    'price': offer['price']
-                },
-                timestamp = offer['timestamp'],
-                filled = offer['filled']
-            )
-            transaction = Transaction(
-                user_id = user.id,
-                init_order = order.id,
-                target_order = offer['id'],
-                direction = order.body.direction,
-                body = {
-                    'ticker': order.body.ticker,
-                    'qty': min(offer['qty'], remaining_qty),
-                    'price': offer['price'],
-                    'timestamp': datetime.now()
-                }
-            )
-        except Exception as e:
-            logger.error(e)
-        peer_id = db_fnc.lookup('Users', 'id', offer['user_id'])['id']
-        buy_sell_ids = (user.id, peer_id) if order.body.direction == 'SELL' else (peer_id, user.id)
-        if offer['qty'] - offer['filled'] <= remaining_qty:
-            logger.info(f'Order {offer_order.id} executed completely')
-            new_status = OrderStatus.EXECUTED
-            amount = offer_order.body.qty - offer['filled']
+    direction = order.body.direction
+    timestamp = datetime.now()
+    cash_per_lot_tick = get_spec(book.ticker).cash_per_lot_tick
+    fill_counter = fill_counters.labels(book.ticker)
+    while remaining_qty > 0:
+        offer = book.best(counter_side)
+        if offer is None:
+            break
+        if limit_price is not None and (offer.price > limit_price if side == BUY else offer.price < limit_price):
+            fill_logger.info('No more offers within price margin of %s', limit_price)
+            break
+        buy_sell_ids = (offer.user_id, user.id) if side else (user.id, offer.user_id)
+        buy_sell_orders = (offer.id, order.id) if side else (order.id, offer.id)
+        if offer.remaining <= remaining_qty:
+            fill_logger.info('Order %s executed completely', offer.id)
+            amount = offer.remaining
         else:
-            logger.info(f'Order {offer_order.id} executed partially: the new order is fulfilled')
-            new_status = OrderStatus.PART_EXECUTED
+            fill_logger.info('Order %s executed partially: the new order is fulfilled', offer.id)
             amount = remaining_qty
-        logger.info(f'Last transaction: {amount} units executed using order {offer_order.id}. Left to execute: {remaining_qty}')
-        db_fnc.fill_order(offer_order, amount)
-        db_fnc.update_order_status(offer_order, new_status)
+        await ledger.settle(buy_sell_ids[0], buy_sell_ids[1], book.ticker, offer.price, amount,
+                            offer.id, offer.direction, offer.price, taker_order_id, cash_per_lot_tick, taker_price)
+        risk.record(book.ticker, offer.price)
+        trade_tape.record(book.ticker, offer.price, amount, timestamp,
+                          buy_sell_ids[0], buy_sell_orders[0], buy_sell_ids[1], buy_sell_orders[1])
+        candles.record(book.ticker, offer.price, amount, timestamp)
+        book.fill(offer, amount)
+        journal.fill(book.ticker, offer.id, amount)
         remaining_qty -= amount
+        fills.append(Fill(offer.price, amount, direction, timestamp, offer.id))
+        fill_counter.inc()
+        fill_logger.info('Last transaction: %s units executed using order %s. Left to execute: %s',
+                    amount, offer.id, remaining_qty)
 
-        db_fnc.exchange_balance(buy_sell_ids[0], buy_sell_ids[1], order.body.ticker, offer['price'], amount)
-        transactions.append(transaction)
+    return remaining_qty
 
-        if remaining_qty <= 0:
-            logger.info('Order executed completely')
-            break
 
-    logger.info(f'Immediate order execution complete. Remaining qty: {remaining_qty}')
+#Streams the book levels and trades changed by one matching step
+def publish_market_data(book: OrderBook, fills: list):
+    market_data.publish(book, [(f.price, f.qty, f.direction, f.timestamp) for f in fills])
+
+
+def unfilled(order, fills: list) -> int:
+    return order.body.qty - sum(fill.qty for fill in fills)
+
+
+#A market order with reserved funds sweeps no further than the price they were reserved at, whatever it
+#did not fill is released
+async def execute_market_order(order: MarketOrder, user: User):
+    side = int(Direction.to_int(order.body.direction))
+    book = get_book(order.body.ticker)
+    reserved_price = risk.take(order)
+    available_qty = book.volume[1 - side]
+    if available_qty < order.body.qty:
+        fill_logger.info('Failed to execute order %s: not enough standing orders! (%s/%s)',
+                    order.id, available_qty, order.body.qty)
+        if reserved_price is not None:
+            risk.release(order, user, order.body.qty, reserved_price)
+        return None
+    fills = []
+    try:
+        remaining_qty = await match_against_book(order, user, book, side, fills, reserved_price,
+                                                 taker_price=reserved_price)
+    finally:
+        if reserved_price is not None:
+            risk.release(order, user, unfilled(order, fills), reserved_price)
+        publish_market_data(book, fills)
+    fill_logger.info('Immediate order execution complete. Remaining qty: %s', remaining_qty)
     return True
 
 
-async def execute_limit_order(order: LimitOrder, user: User):
-    counter_direction = Direction.BUY if order.body.direction.name == "SELL" else Direction.SELL
-    offers, total_qty = db_fnc.get_offers_by_ticker(order.body.ticker, counter_direction)
-    remaining_qty = order.body.qty
-    transactions = []
-    if not offers:
-        logger.info('No offers within price margin')
+#The limit order's row is committed before it is matched. If matching fails the order is cancelled, after
+#the fills it already got, so neither the API nor a restart finds it open while it is not in the book.
+#An order that made it into the book holds its funds frozen as a resting order and is cancelled as one
+async def abandon_limit_order(order: LimitOrder, user: User, book: OrderBook, fills: list, reserved_price):
+    resting = book.remove(str(order.id)) if book is not None else None
+    if resting is not None:
+        if ledger.loaded:
+            ledger.cancel(user.id, book.ticker, [resting], get_spec(book.ticker).cash_per_lot_tick)
+        else:
+            await db_pool.write(db_fnc.cancel_order, str(order.id), user, get_spec(book.ticker).cash_per_lot_tick)
+        return
+    if reserved_price is not None:
+        risk.release(order, user, unfilled(order, fills), reserved_price)
+    if ledger.loaded:
+        ledger.close(order.id)
     else:
-        logger.info(f'Commencing immediate partial execution\nStart qty: {order.body.qty} at price {order.body.price}')
-        db_fnc.update_order_status(order, OrderStatus.PART_EXECUTED)
-        for offer in offers:
-            offer_order = LimitOrder(
-                id=offer['id'],
-                status=OrderStatus.from_int(offer['status']),
-                user_id=offer['user_id'],
-                body = {
-                        'direction': Direction.from_int(offer['direction']),
-                        'ticker': offer['ticker'],
-                        'qty': offer['qty'],
-                        'price': offer['price']
-                    },
-                timestamp=offer['timestamp'],
-                filled=offer['filled']
-            )
-            transaction = Transaction(
-                user_id=user.id,
-                init_order=order.id,
-                target_order=offer['id'],
-                direction=order.body.direction,
-                body= {
-                    'ticker': order.body.ticker,
-                    'qty': min(offer['qty'], remaining_qty),
-                    'price': offer['price'],
-                    'timestamp': datetime.now()
-                }
-            )
-            peer_id = db_fnc.lookup('Users', 'id', offer['user_id'])['id']
-            buy_sell_ids = (user.id, peer_id) if order.body.direction == 'SELL' else (peer_id, user.id)
-            if offer['qty'] - offer['filled'] <= remaining_qty:
-                logger.info(f'Order {offer_order.id} executed completely')
-                new_status = OrderStatus.EXECUTED
-                amount = offer_order.body.qty - offer['filled']
+        await db_pool.write(db_fnc.update_order_status, order, OrderStatus.CANCELLED)
+
+
+async def execute_limit_order(order: LimitOrder, user: User):
+    side = int(Direction.to_int(order.body.direction))
+    fill_logger.info('Commencing immediate partial execution\nStart qty: %s at price %s', order.body.qty, order.body.price)
+    reserved_price = risk.take(order)
+    book = None
+    fills = []
+    try:
+        book = get_book(order.body.ticker)
+        remaining_qty = await match_against_book(order, user, book, side, fills, order.body.price, order.id,
+                                                 reserved_price)
+        filled = order.body.qty - remaining_qty
+        if remaining_qty <= 0:
+            fill_logger.info('Order executed completely')
+            return True
+
+        to_freeze = get_spec(book.ticker).cash(remaining_qty, order.body.price) if side == BUY else remaining_qty
+        freeze_ticker = 'RUB' if order.body.direction == Direction.BUY else order.body.ticker
+        #A reserved order already holds exactly this much frozen
+        if reserved_price is None:
+            await ledger.update(user.id, freeze_ticker, to_freeze, is_freeze=True)
+        resting = BookOrder(order.id, user.id, side, order.body.price, order.body.qty, filled, order.timestamp)
+        book.add(resting)
+        journal.add(book.ticker, resting)
+    except Exception:
+        await abandon_limit_order(order, user, book, fills, reserved_price)
+        raise
+    finally:
+        if book is not None:
+            publish_market_data(book, fills)
+    fill_logger.info('Immediate order execution complete. Remaining qty: %s/%s\n'
+                '%s of %s frozen for the %s units of %s at %s a unit',
+                remaining_qty, order.body.qty, to_freeze, freeze_ticker, remaining_qty, order.body.ticker,
+                order.body.price)
+    return True
+
+
+#Runs the orders of one batch for a single ticker on that ticker's worker, in submission order. The book is
+#loaded before the limit orders are inserted (one executemany for all of them), so none of them can rest in
+#it before its own turn. Returns one result per order: True, None (market order not executed) or the exception
+async def execute_batch(orders: list, user: User):
+    get_book(orders[0].body.ticker)
+    limit_orders = [order for order in orders if isinstance(order, LimitOrder)]
+    if limit_orders:
+        await db_pool.write(db_fnc.create_limit_orders, limit_orders, str(user.id))
+    results = []
+    for order in orders:
+        try:
+            if isinstance(order, LimitOrder):
+                results.append(await execute_limit_order(order, user))
             else:
-                logger.info(f'Order {offer_order.id} executed partially: the new order is fulfilled')
-                new_status = OrderStatus.PART_EXECUTED
-                amount = remaining_qty
-            logger.info(f'Last transaction: {amount} units executed using order {offer_order.id}. Left to execute: {remaining_qty}')
-            db_fnc.fill_order(offer_order, amount)
-            db_fnc.update_order_status(offer_order, new_status)
-            remaining_qty -= amount
-
-            db_fnc.exchange_balance(buy_sell_ids[0], buy_sell_ids[1], order.body.ticker, offer['price'], amount)
-            transactions.append(transaction)
-
-            if remaining_qty <= 0:
-                logger.info('Order executed completely')
-                db_fnc.update_order_status(order, OrderStatus.EXECUTED)
-                break
-
-    to_freeze = remaining_qty*order.body.price if order.body.direction == Direction.BUY else remaining_qty
-    freeze_ticker = 'RUB' if order.body.direction == Direction.BUY else order.body.ticker
-    db_fnc.update_balance(user.id, freeze_ticker, to_freeze, is_freeze=True)
-    logger.info(f'''Immediate order execution complete. Remaining qty: {remaining_qty}/{order.body.qty}
-{to_freeze} of RUB frozen for the {remaining_qty} units of {order.body.ticker} at {order.body.price} a unit''')
-    return True
\ No newline at end of file
+                results.append(await execute_market_order(order, user))
+        except Exception as e:
+            logger.error('Batch order %s failed: %s', order.id, e)
+            results.append(e)
+    return results
+
+
+#Cancels an order and drops it from the resting book of its ticker. With the balance ledger loaded the book
+#tells what is still frozen (the DB may lack fills not written yet) and the cancellation is written behind
+async def cancel_order(order_id: str, user: User, ticker: str):
+    book = get_book(ticker)
+    if ledger.loaded:
+        order = book.orders.get(order_id)
+        if order is None:
+            raise ValueError(f'Order {order_id} is not open')
+        if order.user_id != str(user.id):
+            raise ValueError('You can only cancel your own orders!')
+        ledger.cancel(user.id, ticker, [order], get_spec(ticker).cash_per_lot_tick)
+    else:
+        await db_pool.write(db_fnc.cancel_order, order_id, user, get_spec(ticker).cash_per_lot_tick)
+    book.remove(order_id)
+    journal.remove(book.ticker, [order_id])
+    publish_market_data(book, [])
+    return True
+
+
+#Cancels the user's open orders in one ticker, optionally only one side (BUY/SELL encoding of the book),
+#with one DB transaction (one ledger change when it is loaded) and one bulk removal from the book.
+#Returns the cancelled order ids
+async def cancel_orders(user: User, ticker: str, side: int = None):
+    if ledger.loaded:
+        user_id = str(user.id)
+        orders = [order for order in get_book(ticker).orders.values()
+                  if order.user_id == user_id and (side is None or order.direction == side)]
+        ledger.cancel(user.id, ticker, orders, get_spec(ticker).cash_per_lot_tick)
+        order_ids = [order.id for order in orders]
+    else:
+        order_ids = await db_pool.write(db_fnc.cancel_orders, user.id, ticker, side, get_spec(ticker).cash_per_lot_tick)
+    if order_ids:
+        book = get_book(ticker)
+        book.remove_many(order_ids)
+        journal.remove(ticker, order_ids)
+        publish_market_data(book, [])
+    return order_ids
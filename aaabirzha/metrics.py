@@ -0,0 +1,172 @@
+from bisect import bisect_left
+import asyncio
+import time
+
+#Latency buckets in seconds, 50us to 10s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+#How often the event loop lag probe wakes up (seconds)
+LAG_PROBE_INTERVAL = 0.5
+
+
+class Counter:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name: str, labels: str):
+        yield f'{name}{labels} {self.value}'
+
+
+class Gauge(Counter):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+
+#Fixed buckets allocated up front: observe() is one bisect and two additions
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name: str, labels: str):
+        cumulative = 0
+        prefix = f'{labels[1:-1]},' if labels else ''
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+        cumulative += self.counts[-1]
+        yield f'{name}_bucket{{{prefix}le="+Inf"}} {cumulative}'
+        yield f'{name}_sum{labels} {self.sum}'
+        yield f'{name}_count{labels} {cumulative}'
+
+
+#A named metric with one child per combination of label values. Children are created on first use and
+#kept, so hot paths resolve their child once (or look it up in a dict) and never allocate per call
+class Family:
+    def __init__(self, name: str, help: str, kind: str, label_names=(), factory=Counter):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = label_names
+        self.factory = factory
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = self.factory()
+        return child
+
+    def render(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for values, child in self.children.items():
+            labels = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, values))
+            yield from child.samples(self.name, f'{{{labels}}}' if labels else '')
+
+
+class Registry:
+    def __init__(self):
+        self.families = []
+        #Callables run at scrape time for values that are cheaper to read than to maintain
+        self.collectors = []
+
+    def counter(self, name: str, help: str, label_names=()) -> Family:
+        return self.add(Family(name, help, 'counter', label_names, Counter))
+
+    def gauge(self, name: str, help: str, label_names=()) -> Family:
+        return self.add(Family(name, help, 'gauge', label_names, Gauge))
+
+    def histogram(self, name: str, help: str, label_names=(), bounds=LATENCY_BUCKETS) -> Family:
+        return self.add(Family(name, help, 'histogram', label_names, lambda: Histogram(bounds)))
+
+    def add(self, family: Family) -> Family:
+        self.families.append(family)
+        return family
+
+    #Text exposition format 0.0.4
+    def render(self) -> str:
+        for collect in self.collectors:
+            collect()
+        return '\n'.join(line for family in self.families for line in family.render()) + '\n'
+
+
+registry = Registry()
+
+http_latency = registry.histogram('http_request_duration_seconds',
+                                  'Time to the start of the response by route', ('method', 'route', 'status'))
+matching_latency = registry.histogram('matching_duration_seconds',
+                                      'Time a matching job runs on its ticker worker', ('ticker',))
+matching_wait = registry.histogram('matching_queue_wait_seconds',
+                                   'Time a matching job waits in its ticker queue', ('ticker',))
+fills = registry.counter('fills_total', 'Executed fills', ('ticker',))
+db_latency = registry.histogram('db_call_duration_seconds',
+                                'Time from submitting a database function to its pool to its result', ('function', 'pool'))
+db_commits = registry.counter('db_commits_total', 'Commits on the writer connection').labels()
+loop_lag = registry.histogram('event_loop_lag_seconds', 'Delay of the event loop lag probe wake-ups').labels()
+open_orders = registry.gauge('open_orders', 'Resting orders in the in-memory book', ('ticker',))
+
+
+#Pure ASGI middleware: the route template is known once the router has matched, so label cardinality
+#stays bounded by the number of routes. Streams are timed to their first byte
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        observed = False
+
+        async def timed_send(message):
+            nonlocal observed
+            if message['type'] == 'http.response.start' and not observed:
+                observed = True
+                route = scope.get('route')
+                http_latency.labels(scope['method'], route.path if route else 'unmatched',
+                                    message['status']).observe(time.perf_counter() - start)
+            await send(message)
+
+        await self.app(scope, receive, timed_send)
+
+
+#Sleeps LAG_PROBE_INTERVAL at a time and records how late every wake-up is
+async def probe_loop_lag(interval: float = LAG_PROBE_INTERVAL):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        loop_lag.observe(max(0.0, time.perf_counter() - start - interval))
+
+
+class LagProbe:
+    def __init__(self):
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(probe_loop_lag(), name='event-loop-lag')
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+lag_probe = LagProbe()
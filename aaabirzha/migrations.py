@@ -0,0 +1,182 @@
+import logging
+import sqlite3 as sql
+from datetime import datetime
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+#Tables, trigger and seed rows every database starts from, read next to this module instead of the CWD
+BASELINE_PATH = Path(__file__).with_name('Fresh_create_DB.sql')
+
+#Schema changes in order, starting with the baseline. Every applied version is recorded in schema_version,
+#so each script runs exactly once per database
+MIGRATIONS = [
+    (0, 'Baseline schema, RUB and the admin user', BASELINE_PATH.read_text()),
+    (1, 'Indexes for the matching, order list, auth and transaction history access patterns', '''
+--Resting book: get_offers_by_ticker, get_orders_for_ticker, get_open_orders. Partial, so it only grows
+--with the open orders and not with the EXECUTED/CANCELLED history
+CREATE INDEX IF NOT EXISTS idx_orders_open_book
+ON Orders (ticker, direction, price, timestamp, qty, filled)
+WHERE status IN (0, 2);
+--get_orders_for_user
+CREATE INDEX IF NOT EXISTS idx_orders_user ON Orders (user_id, ticker, timestamp);
+--get_user_by_api_key, covering the columns it selects
+CREATE INDEX IF NOT EXISTS idx_users_api_key_hashed ON Users (api_key_hashed, id, name, role);
+--get_transactions_by_user
+CREATE INDEX IF NOT EXISTS idx_transactions_user ON Transactions (user_id, ticker, timestamp);
+'''),
+    (2, 'Order ids of both sides on Transactions rows', '''
+ALTER TABLE Transactions ADD COLUMN order_id TEXT;
+ALTER TABLE Transactions ADD COLUMN counter_order_id TEXT;
+'''),
+    (3, 'Integer ticks and lots: per-instrument tick and lot size, INTEGER prices, quantities and balances', '''
+ALTER TABLE Instruments ADD COLUMN tick_size TEXT NOT NULL DEFAULT '1';
+ALTER TABLE Instruments ADD COLUMN lot_size TEXT NOT NULL DEFAULT '1';
+--Existing amounts are whole API units, which are ticks and lots of the default sizes of 1
+CREATE TABLE "Orders_v3" (
+	"id"	TEXT,
+	"status"	INTEGER NOT NULL CHECK("status" >= 0 AND "status" < 5),
+	"user_id"	TEXT NOT NULL,
+	"timestamp"	REAL NOT NULL,
+	"direction"	INTEGER NOT NULL CHECK("direction" IN (0, 1)),
+	"ticker"	TEXT NOT NULL,
+	"qty"	INTEGER NOT NULL CHECK("qty" > 0),
+	"price"	INTEGER CHECK("price" > 0),
+	"filled"	INTEGER DEFAULT 0 CHECK("filled" <= "qty"),
+	"type"	INTEGER NOT NULL CHECK("type" IN (0, 1)),
+	PRIMARY KEY("id"),
+	CONSTRAINT "FK_order_instrument" FOREIGN KEY("ticker") REFERENCES "Instruments"("ticker") ON DELETE CASCADE,
+	CONSTRAINT "FK_order_user" FOREIGN KEY("user_id") REFERENCES "Users"("id") ON DELETE CASCADE
+);
+INSERT INTO Orders_v3 (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+SELECT id, status, user_id, timestamp, direction, ticker,
+       CAST(round(qty) AS INTEGER), CAST(round(price) AS INTEGER), CAST(round(filled) AS INTEGER), type
+FROM Orders;
+DROP TABLE Orders;
+ALTER TABLE Orders_v3 RENAME TO Orders;
+CREATE TABLE "Transactions_v3" (
+	"id"	INTEGER,
+	"user_id"	TEXT NOT NULL,
+	"ticker"	TEXT NOT NULL,
+	"direction"	INTEGER NOT NULL CHECK("direction" IN (0, 1)),
+	"amount"	INTEGER NOT NULL CHECK("amount" > 0),
+	"price"	INTEGER NOT NULL CHECK("price" > 0),
+	"timestamp"	TEXT NOT NULL,
+	"order_id"	TEXT,
+	"counter_order_id"	TEXT,
+	PRIMARY KEY("id"),
+	CONSTRAINT "FK_transaction_instrument" FOREIGN KEY("ticker") REFERENCES "Instruments"("ticker"),
+	CONSTRAINT "FK_transaction_user" FOREIGN KEY("user_id") REFERENCES "Users"("id")
+);
+INSERT INTO Transactions_v3 (id, user_id, ticker, direction, amount, price, timestamp, order_id, counter_order_id)
+SELECT id, user_id, ticker, direction, CAST(round(amount) AS INTEGER), CAST(round(price) AS INTEGER),
+       timestamp, order_id, counter_order_id
+FROM Transactions;
+DROP TABLE Transactions;
+ALTER TABLE Transactions_v3 RENAME TO Transactions;
+CREATE TABLE "UserBalance_v3" (
+	"user_id"	TEXT,
+	"ticker"	TEXT,
+	"balance"	INTEGER DEFAULT 0,
+	"frozen"	INTEGER DEFAULT 0 CHECK("frozen" <= "balance"),
+	PRIMARY KEY("user_id","ticker"),
+	CONSTRAINT "fk_userbalance_ticker" FOREIGN KEY("ticker") REFERENCES "Instruments"("ticker"),
+	CONSTRAINT "fk_userbalance_user" FOREIGN KEY("user_id") REFERENCES "Users"("id") ON DELETE CASCADE
+);
+INSERT INTO UserBalance_v3 (user_id, ticker, balance, frozen)
+SELECT user_id, ticker, CAST(round(balance) AS INTEGER), CAST(round(frozen) AS INTEGER)
+FROM UserBalance;
+DROP TABLE UserBalance;
+ALTER TABLE UserBalance_v3 RENAME TO UserBalance;
+--Dropped together with the old tables
+CREATE INDEX IF NOT EXISTS idx_orders_open_book
+ON Orders (ticker, direction, price, timestamp, qty, filled)
+WHERE status IN (0, 2);
+CREATE INDEX IF NOT EXISTS idx_orders_user ON Orders (user_id, ticker, timestamp);
+CREATE INDEX IF NOT EXISTS idx_transactions_user ON Transactions (user_id, ticker, timestamp);
+CREATE TRIGGER IF NOT EXISTS order_status_on_fill AFTER UPDATE OF filled ON Orders
+BEGIN
+UPDATE Orders SET status = IIF(old.status != 3, IIF(new.filled > 0, IIF(new.filled == new.qty, 1, 2),0), old.status)
+WHERE id = new.id;
+END;
+'''),
+    (4, 'Correct api_key_hashed of the seeded admin user', '''
+--The baseline used to store a 70 character value that is no SHA-256 of the admin key
+UPDATE Users SET api_key_hashed = '9111818d82c7f4e94d3690da57542d0bf50c21d1497e0a7bff08dc5ed5365cd3'
+WHERE id = '641f541b-4fcc-4a5b-aa97-107b422ff5fd'
+AND api_key_hashed = '9111818d82c7f4e94d3690da57542d0bf50c21d1497e0a7bff08dc5ed8dc5ed5365cd3';
+'''),
+    (5, 'Keyset pagination of the order and transaction history', '''
+--get_orders_for_user pages in (timestamp, id) order, with and without a ticker. Orders.id is not the rowid,
+--so it is part of the key
+DROP INDEX IF EXISTS idx_orders_user;
+CREATE INDEX IF NOT EXISTS idx_orders_user ON Orders (user_id, ticker, timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_orders_user_time ON Orders (user_id, timestamp, id);
+--get_transactions_by_user: Transactions.id is the rowid, which every index already ends with
+CREATE INDEX IF NOT EXISTS idx_transactions_user_time ON Transactions (user_id, timestamp);
+'''),
+    (6, 'OHLCV candles', '''
+--One bar per ticker, interval (seconds) and window start (epoch seconds of the trade wall-clock time). Prices
+--are ticks, volume lots. WITHOUT ROWID: the primary key is the table, no second copy of the key
+CREATE TABLE IF NOT EXISTS "Candles" (
+	"ticker"	TEXT NOT NULL,
+	"interval"	INTEGER NOT NULL,
+	"start"	INTEGER NOT NULL,
+	"open"	INTEGER NOT NULL,
+	"high"	INTEGER NOT NULL,
+	"low"	INTEGER NOT NULL,
+	"close"	INTEGER NOT NULL,
+	"volume"	INTEGER NOT NULL,
+	"trades"	INTEGER NOT NULL,
+	PRIMARY KEY("ticker","interval","start")
+) WITHOUT ROWID;
+--backfill_candles catching up from the last stored bars
+CREATE INDEX IF NOT EXISTS idx_transactions_time ON Transactions (timestamp);
+'''),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+schema_version_query = '''
+CREATE TABLE IF NOT EXISTS "schema_version" (
+	"version"	INTEGER,
+	"description"	TEXT NOT NULL,
+	"applied_at"	TEXT NOT NULL,
+	PRIMARY KEY("version")
+)'''
+
+
+#-1 for a database without any applied version, including ones created before schema_version existed
+def current_version(conn: sql.Connection) -> int:
+    conn.execute(schema_version_query)
+    version = conn.execute('SELECT max(version) FROM schema_version').fetchone()[0]
+    return -1 if version is None else version
+
+
+#Brings the database up to the latest version. A current database costs one query. Every migration runs in
+#its own write-locked transaction together with its schema_version row, so a failed script leaves the
+#previous version in place. Workers starting together race for each migration: the loser's script fails or
+#its schema_version row conflicts, and it moves on once it sees the version applied by the winner
+def apply_migrations(conn: sql.Connection, target: int = None) -> int:
+    version = current_version(conn)
+    conn.commit()
+    for number, description, script in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        logger.info('Applying schema migration %s: %s', number, description)
+        description = description.replace("'", "''")
+        try:
+            conn.executescript(f'''BEGIN IMMEDIATE;
+{script}
+INSERT INTO schema_version (version, description, applied_at)
+VALUES ({number}, '{description}', '{datetime.now().isoformat(' ')}');
+COMMIT;''')
+        except sql.DatabaseError as e:
+            conn.rollback()
+            if current_version(conn) >= number:
+                logger.info('Schema migration %s was applied by another connection', number)
+            else:
+                logger.error('DBError: Schema migration %s failed\n%s', number, e)
+                raise e
+        version = number
+    return version
@@ -0,0 +1,234 @@
+from bisect import bisect_left, insort
+from collections import OrderedDict
+import logging
+
+import aaabirzha.database as db_fnc
+
+logger = logging.getLogger(__name__)
+
+#Sides use the same integer encoding as the Orders.direction column
+BUY = 0
+SELL = 1
+
+
+#A resting limit order as held by the in-memory book
+class BookOrder:
+    __slots__ = ('id', 'user_id', 'direction', 'price', 'qty', 'filled', 'timestamp')
+
+    def __init__(self, id, user_id, direction, price, qty, filled=0, timestamp=None):
+        self.id = str(id)
+        self.user_id = str(user_id)
+        self.direction = int(direction)
+        self.price = price
+        self.qty = qty
+        self.filled = filled
+        self.timestamp = timestamp
+
+    @property
+    def remaining(self):
+        return self.qty - self.filled
+
+    def __repr__(self):
+        return f'BookOrder({self.id}, {"SELL" if self.direction else "BUY"} {self.remaining}@{self.price})'
+
+
+#Price-time priority book for a single ticker.
+#Every side keeps a dict of price -> FIFO queue (OrderedDict keyed by order id) and a sorted list of
+#level keys with the best level at the end: bids are keyed by price, asks by -price.
+#That gives O(log n) level lookup on insert, O(1) best bid/ask and O(1) cancel by order id.
+#level_qty holds the L2 aggregate (total remaining qty per level key) and is updated on every change,
+#version is bumped on every change so readers can tell whether a cached view is still current,
+#changed collects the level keys touched since the last drain_changes for market data deltas
+class OrderBook:
+    def __init__(self, ticker: str):
+        self.ticker = ticker
+        self.levels = ({}, {})
+        self.keys = ([], [])
+        self.level_qty = ({}, {})
+        self.changed = (set(), set())
+        self.volume = [0, 0]
+        self.orders = {}
+        self.version = 0
+
+    @staticmethod
+    def _key(side, price):
+        return price if side == BUY else -price
+
+    def __len__(self):
+        return len(self.orders)
+
+    def __contains__(self, order_id):
+        return str(order_id) in self.orders
+
+    def add(self, order: BookOrder):
+        #Adding an order already in the book replaces it. A book lazily loaded by get_book already holds
+        #the incoming limit order, which is stored before it reaches the engine
+        if order.id in self.orders:
+            self.remove(order.id)
+        side = order.direction
+        key = self._key(side, order.price)
+        level = self.levels[side].get(key)
+        if level is None:
+            level = self.levels[side][key] = OrderedDict()
+            insort(self.keys[side], key)
+        level[order.id] = order
+        self.orders[order.id] = order
+        self.level_qty[side][key] = self.level_qty[side].get(key, 0) + order.remaining
+        self.changed[side].add(key)
+        self.volume[side] += order.remaining
+        self.version += 1
+
+    def remove(self, order_id) -> BookOrder:
+        order = self.orders.pop(str(order_id), None)
+        if order is None:
+            return None
+        side = order.direction
+        key = self._key(side, order.price)
+        level = self.levels[side][key]
+        del level[order.id]
+        self.level_qty[side][key] -= order.remaining
+        self.changed[side].add(key)
+        self.volume[side] -= order.remaining
+        self.version += 1
+        if not level:
+            self._drop_level(side, key)
+        return order
+
+    #Bulk cancel: removes the orders with one version bump and rebuilds the level key lists once instead of
+    #bisecting them for every emptied level. Ids not in the book are skipped. Returns the removed orders
+    def remove_many(self, order_ids) -> list:
+        removed = []
+        emptied = (set(), set())
+        for order_id in order_ids:
+            order = self.orders.pop(str(order_id), None)
+            if order is None:
+                continue
+            side = order.direction
+            key = self._key(side, order.price)
+            level = self.levels[side][key]
+            del level[order.id]
+            self.level_qty[side][key] -= order.remaining
+            self.changed[side].add(key)
+            self.volume[side] -= order.remaining
+            if not level:
+                emptied[side].add(key)
+            removed.append(order)
+        for side in (BUY, SELL):
+            if emptied[side]:
+                for key in emptied[side]:
+                    del self.levels[side][key]
+                    del self.level_qty[side][key]
+                self.keys[side][:] = [key for key in self.keys[side] if key not in emptied[side]]
+        if removed:
+            self.version += 1
+        return removed
+
+    def _drop_level(self, side, key):
+        del self.levels[side][key]
+        del self.level_qty[side][key]
+        keys = self.keys[side]
+        if keys[-1] == key:
+            keys.pop()
+        else:
+            del keys[bisect_left(keys, key)]
+
+    def best(self, side) -> BookOrder:
+        #Oldest order at the best price of the given side, or None if the side is empty
+        keys = self.keys[side]
+        if not keys:
+            return None
+        return next(iter(self.levels[side][keys[-1]].values()))
+
+    def best_price(self, side):
+        keys = self.keys[side]
+        if not keys:
+            return None
+        return self._key(side, keys[-1])
+
+    def fill(self, order: BookOrder, amount):
+        #Applies a fill to a resting order, removing it from the book once it is complete
+        order.filled += amount
+        level_key = self._key(order.direction, order.price)
+        self.level_qty[order.direction][level_key] -= amount
+        self.changed[order.direction].add(level_key)
+        self.volume[order.direction] -= amount
+        self.version += 1
+        if order.remaining <= 0:
+            level = self.levels[order.direction][level_key]
+            del level[order.id]
+            del self.orders[order.id]
+            if not level:
+                self._drop_level(order.direction, level_key)
+
+    #Worst price reached by taking qty from a side, walking its levels from the best one, or None if the
+    #side holds less than qty. O(levels walked)
+    def sweep_price(self, side, qty):
+        if self.volume[side] < qty:
+            return None
+        level_qty = self.level_qty[side]
+        for key in reversed(self.keys[side]):
+            qty -= level_qty[key]
+            if qty <= 0:
+                return self._key(side, key)
+        return None
+
+    #Up to limit aggregated (price, qty) levels of a side, best price first. O(limit)
+    def depth(self, side, limit: int) -> list:
+        keys = self.keys[side]
+        level_qty = self.level_qty[side]
+        return [(self._key(side, key), level_qty[key]) for key in keys[:-limit - 1:-1]] if limit > 0 else []
+
+    #[price, qty] of every level changed since the previous call, per side. qty 0 means the level is gone
+    def drain_changes(self) -> tuple:
+        changes = ([], [])
+        for side in (BUY, SELL):
+            changed = self.changed[side]
+            if changed:
+                level_qty = self.level_qty[side]
+                changes[side].extend([self._key(side, key), level_qty.get(key, 0)] for key in changed)
+                changed.clear()
+        return changes
+
+
+books = {}
+#Set once books holds every open order of the tickers this process matches (load_books, journal recovery):
+#a missing book then has no open orders and is created empty, without a DB read on the caller's thread.
+#Before that, e.g. in tools, a missing book is read from the DB
+books_loaded = False
+
+
+def mark_books_loaded():
+    global books_loaded
+    books_loaded = True
+
+
+def book_from_rows(ticker, rows) -> OrderBook:
+    book = OrderBook(ticker)
+    for row in rows:
+        book.add(BookOrder(row['id'], row['user_id'], row['direction'], row['price'],
+                           row['qty'], row['filled'], row['timestamp']))
+    return book
+
+
+def get_book(ticker: str) -> OrderBook:
+    book = books.get(ticker)
+    if book is None:
+        if books_loaded:
+            return books.setdefault(ticker, OrderBook(ticker))
+        book = books[ticker] = book_from_rows(ticker, db_fnc.get_open_orders(ticker))
+        logger.info('Order book for %s loaded: %s resting orders', ticker, len(book))
+    return book
+
+
+#Builds every book from the open orders in the DB. Rows come in timestamp order, so FIFO queues are
+#restored in their original priority. owns(ticker) limits the books to the tickers this process matches
+def load_books(owns=None):
+    books.clear()
+    by_ticker = {}
+    for row in db_fnc.get_open_orders():
+        if owns is None or owns(row['ticker']):
+            by_ticker.setdefault(row['ticker'], []).append(row)
+    for ticker, rows in by_ticker.items():
+        books[ticker] = book_from_rows(ticker, rows)
+    mark_books_loaded()
+    logger.info('Order books loaded for %s tickers', len(books))
@@ -0,0 +1,351 @@
+import asyncio
+import logging
+import os
+import struct
+import zlib
+from pathlib import Path
+
+import aaabirzha.database as db_fnc
+from aaabirzha.orderbook import OrderBook, BookOrder, books, book_from_rows, load_books, mark_books_loaded
+
+logger = logging.getLogger(__name__)
+
+#Snapshot and journal files live next to the database unless configured otherwise
+RECOVERY_DIR = os.environ.get('AAABIRZHA_RECOVERY_DIR', f'{db_fnc.DB_PATH}.recovery')
+#Seconds between periodic snapshots (0 disables them, a snapshot is still written on shutdown)
+SNAPSHOT_INTERVAL = float(os.environ.get('AAABIRZHA_SNAPSHOT_INTERVAL', 300))
+#Longest a journal record waits in memory before it is written to the file (seconds)
+FLUSH_INTERVAL = 0.05
+
+SNAPSHOT_MAGIC = b'ABSN'
+JOURNAL_MAGIC = b'ABJL'
+FORMAT_VERSION = 1
+
+#Journal events
+ADD = 1
+FILL = 2
+REMOVE = 3
+
+HEADER = struct.Struct('<4sHQ')  #magic, format version, generation
+FRAME = struct.Struct('<II')  #payload length, crc32 of the payload
+ORDER = struct.Struct('<Bqqq')  #direction, price, qty, filled
+EVENT = struct.Struct('<B')
+COUNT = struct.Struct('<I')
+AMOUNT = struct.Struct('<q')
+LENGTH = struct.Struct('<H')
+
+
+def put_str(out: bytearray, value: str):
+    data = value.encode()
+    out += LENGTH.pack(len(data))
+    out += data
+
+
+def put_order(out: bytearray, order: BookOrder):
+    put_str(out, order.id)
+    put_str(out, order.user_id)
+    put_str(out, '' if order.timestamp is None else str(order.timestamp))
+    out += ORDER.pack(order.direction, order.price, order.qty, order.filled)
+
+
+def frame(payload) -> bytes:
+    return FRAME.pack(len(payload), zlib.crc32(payload)) + bytes(payload)
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def unpack(self, fmt: struct.Struct) -> tuple:
+        values = fmt.unpack_from(self.data, self.pos)
+        self.pos += fmt.size
+        return values
+
+    def str(self) -> str:
+        size, = self.unpack(LENGTH)
+        value = bytes(self.data[self.pos:self.pos + size]).decode()
+        self.pos += size
+        return value
+
+    def order(self) -> BookOrder:
+        order_id, user_id, timestamp = self.str(), self.str(), self.str()
+        direction, price, qty, filled = self.unpack(ORDER)
+        return BookOrder(order_id, user_id, direction, price, qty, filled, timestamp or None)
+
+
+#Payloads of the complete, checksummed frames from pos on. Stops at the first short or corrupt frame,
+#which is the torn tail of a crash; complete tells whether the data ended cleanly
+def read_frames(data, pos: int) -> tuple:
+    payloads = []
+    while pos < len(data):
+        if pos + FRAME.size > len(data):
+            return payloads, False
+        size, crc = FRAME.unpack_from(data, pos)
+        payload = data[pos + FRAME.size:pos + FRAME.size + size]
+        if len(payload) != size or zlib.crc32(payload) != crc:
+            return payloads, False
+        payloads.append(payload)
+        pos += FRAME.size + size
+    return payloads, True
+
+
+def read_header(data, magic: bytes) -> int:
+    if len(data) < HEADER.size:
+        raise ValueError('File is shorter than its header')
+    file_magic, version, generation = HEADER.unpack_from(data, 0)
+    if file_magic != magic or version != FORMAT_VERSION:
+        raise ValueError(f'Unknown format {file_magic} version {version}')
+    return generation
+
+
+#Snapshot: header, then one frame holding every book: ticker, order count and the orders in FIFO order per level
+def encode_snapshot(generation: int, snapshot_books: dict) -> bytes:
+    payload = bytearray(COUNT.pack(len(snapshot_books)))
+    for ticker, book in snapshot_books.items():
+        put_str(payload, ticker)
+        payload += COUNT.pack(len(book))
+        for side in (0, 1):
+            for key in reversed(book.keys[side]):
+                for order in book.levels[side][key].values():
+                    put_order(payload, order)
+    return HEADER.pack(SNAPSHOT_MAGIC, FORMAT_VERSION, generation) + frame(payload)
+
+
+def read_snapshot(path) -> tuple:
+    data = Path(path).read_bytes()
+    generation = read_header(data, SNAPSHOT_MAGIC)
+    payloads, complete = read_frames(data, HEADER.size)
+    if not complete or len(payloads) != 1:
+        raise ValueError(f'Snapshot {path} failed its checksum')
+    reader = Reader(payloads[0])
+    snapshot_books = {}
+    for _ in range(reader.unpack(COUNT)[0]):
+        ticker = reader.str()
+        book = snapshot_books[ticker] = OrderBook(ticker)
+        for _ in range(reader.unpack(COUNT)[0]):
+            book.add(reader.order())
+    return generation, snapshot_books
+
+
+#Applies the events of one journal file to the recovered books. Events of tickers without a recovered book
+#are skipped: those books are loaded from the DB. Returns the number of events and whether the file ended cleanly
+def replay_journal(path, recovered: dict) -> tuple:
+    data = Path(path).read_bytes()
+    read_header(data, JOURNAL_MAGIC)
+    payloads, complete = read_frames(data, HEADER.size)
+    for payload in payloads:
+        reader = Reader(payload)
+        event, = reader.unpack(EVENT)
+        book = recovered.get(reader.str())
+        if book is None:
+            continue
+        if event == ADD:
+            book.add(reader.order())
+        elif event == FILL:
+            order = book.orders.get(reader.str())
+            amount, = reader.unpack(AMOUNT)
+            if order is not None:
+                book.fill(order, amount)
+        elif event == REMOVE:
+            book.remove_many([reader.str() for _ in range(reader.unpack(COUNT)[0])])
+    return len(payloads), complete
+
+
+#{side: (orders, volume, notional)} of the non-empty sides, the same shape as the DB totals
+def book_totals(book: OrderBook) -> dict:
+    totals = {}
+    for side in (0, 1):
+        if book.volume[side] or book.levels[side]:
+            level_qty = book.level_qty[side]
+            totals[side] = (sum(len(level) for level in book.levels[side].values()), book.volume[side],
+                            sum(book._key(side, key) * qty for key, qty in level_qty.items()))
+    return totals
+
+
+#Append-only journal of the book events since the last snapshot. Recording an event only encodes it into a
+#memory buffer, a background task writes the buffer every FLUSH_INTERVAL seconds and takes a snapshot every
+#snapshot_interval seconds. Each snapshot starts a new journal generation, so recovery loads the snapshot of
+#generation G and replays journals G, G+1, ... Every record carries a crc32, a torn tail ends the replay.
+#owns(ticker) limits recovery to the tickers matched by this process, None recovers all of them.
+#Balances are not snapshotted. The balance ledger writes behind and the DB stays their source of truth:
+#a snapshot could hold balances ahead of the DB, from fills whose order rows and trades were never
+#written, and there would be nothing to check them against. ledger.load rebuilds them with two queries
+#(balances, frozen amounts of the open orders), which is what checking a snapshot would take anyway
+class BookJournal:
+    def __init__(self, directory: str = RECOVERY_DIR, snapshot_interval: float = SNAPSHOT_INTERVAL,
+                 flush_interval: float = FLUSH_INTERVAL, owns=None):
+        self.directory = Path(directory)
+        self.owns = owns
+        self.snapshot_interval = snapshot_interval
+        self.flush_interval = flush_interval
+        self.generation = 0
+        self.file = None
+        self.buffer = bytearray()
+        self.task = None
+
+    @property
+    def snapshot_path(self) -> Path:
+        return self.directory / 'snapshot.bin'
+
+    def journal_path(self, generation: int) -> Path:
+        return self.directory / f'journal-{generation:012d}.log'
+
+    def journal_generations(self) -> list:
+        return sorted(int(path.stem.split('-')[1]) for path in self.directory.glob('journal-*.log'))
+
+    #Nothing is recorded before recover() opened a journal, e.g. when the engine runs without the app lifespan
+    def _record(self, payload: bytearray):
+        if self.file is not None:
+            self.buffer += frame(payload)
+
+    def add(self, ticker: str, order: BookOrder):
+        payload = bytearray(EVENT.pack(ADD))
+        put_str(payload, ticker)
+        put_order(payload, order)
+        self._record(payload)
+
+    def fill(self, ticker: str, order_id: str, amount: int):
+        payload = bytearray(EVENT.pack(FILL))
+        put_str(payload, ticker)
+        put_str(payload, str(order_id))
+        payload += AMOUNT.pack(amount)
+        self._record(payload)
+
+    def remove(self, ticker: str, order_ids):
+        order_ids = [str(order_id) for order_id in order_ids]
+        payload = bytearray(EVENT.pack(REMOVE))
+        put_str(payload, ticker)
+        payload += COUNT.pack(len(order_ids))
+        for order_id in order_ids:
+            put_str(payload, order_id)
+        self._record(payload)
+
+    def flush(self):
+        if self.buffer and self.file is not None:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer.clear()
+
+    #Closes the current journal and opens the next generation. Runs on the event loop between two book
+    #changes, so every event lands either in the snapshot taken with it or in the new journal
+    def _rotate(self) -> int:
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+        self.generation += 1
+        self.file = open(self.journal_path(self.generation), 'ab')
+        self.file.write(HEADER.pack(JOURNAL_MAGIC, FORMAT_VERSION, self.generation))
+        self.file.flush()
+        return self.generation
+
+    #The snapshot is written to a temp file, fsynced and renamed over the previous one. Journals older than
+    #it are deleted only afterwards, so a crash at any point leaves a snapshot plus every journal after it
+    def _write_snapshot(self, generation: int, data: bytes):
+        temp = self.snapshot_path.with_suffix('.tmp')
+        with open(temp, 'wb') as snapshot:
+            snapshot.write(data)
+            snapshot.flush()
+            os.fsync(snapshot.fileno())
+        os.replace(temp, self.snapshot_path)
+        for old in self.journal_generations():
+            if old < generation:
+                self.journal_path(old).unlink(missing_ok=True)
+
+    def _take_snapshot(self) -> tuple:
+        generation = self._rotate()
+        return generation, encode_snapshot(generation, books)
+
+    def snapshot(self):
+        self._write_snapshot(*self._take_snapshot())
+
+    async def snapshot_async(self):
+        generation, data = self._take_snapshot()
+        await asyncio.to_thread(self._write_snapshot, generation, data)
+
+    #Rebuilds books from the snapshot and the journal tail, then checks them against the open order totals
+    #of the DB (one aggregate query). Tickers that disagree, e.g. after events lost in a crash, are
+    #loaded from the DB, which stays the source of truth. Without a usable snapshot every book is loaded
+    #from the DB. Finishes with a fresh snapshot, so the next start replays nothing
+    def recover(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        generations = self.journal_generations()
+        generation = 0
+        try:
+            generation, recovered = read_snapshot(self.snapshot_path)
+        except FileNotFoundError:
+            recovered = None
+            logger.info('No book snapshot in %s, loading books from the DB', self.directory)
+        except (ValueError, struct.error, UnicodeDecodeError) as e:
+            recovered = None
+            logger.warning('Book snapshot unusable, loading books from the DB: %s', e)
+
+        if recovered is None:
+            load_books(self.owns)
+        else:
+            events = 0
+            for expected, journal_generation in enumerate((g for g in generations if g >= generation), generation):
+                if journal_generation != expected:
+                    logger.warning('Journal generation %s is missing, replay stopped', expected)
+                    break
+                replayed, complete = replay_journal(self.journal_path(journal_generation), recovered)
+                events += replayed
+                if not complete:
+                    logger.warning('Journal %s has a torn tail after %s events, replay stopped',
+                                   journal_generation, replayed)
+                    break
+            reloaded = self.verify(recovered)
+            books.clear()
+            books.update(recovered)
+            mark_books_loaded()
+            logger.info('Books recovered from snapshot %s and %s journal events, %s of %s tickers reloaded from the DB',
+                        generation, events, len(reloaded), len(books))
+
+        self.generation = max([generation, *generations])
+        self.snapshot()
+
+    def verify(self, recovered: dict) -> list:
+        expected = {}
+        for row in db_fnc.get_open_book_totals():
+            expected.setdefault(row['ticker'], {})[row['direction']] = (row['orders'], row['volume'], row['notional'])
+        reloaded = []
+        for ticker in set(expected) | set(recovered):
+            if self.owns is not None and not self.owns(ticker):
+                recovered.pop(ticker, None)
+                continue
+            book = recovered.get(ticker)
+            if book is None or book_totals(book) != expected.get(ticker, {}):
+                recovered[ticker] = book_from_rows(ticker, db_fnc.get_open_orders(ticker))
+                reloaded.append(ticker)
+        return reloaded
+
+    async def _run(self):
+        elapsed = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+            elapsed += self.flush_interval
+            if self.snapshot_interval and elapsed >= self.snapshot_interval:
+                elapsed = 0.0
+                try:
+                    await self.snapshot_async()
+                except OSError as e:
+                    logger.error('Failed to write the book snapshot\n%s', e)
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(), name='book-journal')
+
+    #Called once the matching workers are stopped: the final snapshot holds every book change
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        if self.file is not None:
+            self.snapshot()
+            self.file.close()
+            self.file = None
+
+
+journal = BookJournal()
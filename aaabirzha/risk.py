@@ -0,0 +1,97 @@
+import logging
+import os
+
+from aaabirzha.instruments import CASH_TICKER, get_spec
+from aaabirzha.ledger import ledger
+from aaabirzha.orderbook import books, BUY, SELL
+from aaabirzha.schemas import Direction, LimitOrder
+
+logger = logging.getLogger(__name__)
+
+#Largest order accepted, in lots of its instrument
+MAX_ORDER_QTY = int(os.environ.get('AAABIRZHA_MAX_ORDER_QTY', 10 ** 9))
+#Widest distance from the reference price an order may trade or rest at, as a fraction of that price
+#(0 disables the band). The reference is the last trade of the ticker, or the book before its first trade
+PRICE_BAND = float(os.environ.get('AAABIRZHA_PRICE_BAND', 0.5))
+
+
+#Pre-trade checks, run by the API before an order is stored or queued for matching. They read only
+#in-memory state, the book and the balance ledger, so a rejected order costs no DB write or matcher job.
+#An accepted order has all the funds it can use reserved (frozen) at once: a limit order at its price, a
+#market order at the worst price the book needs to fill it, which also caps its sweep. The engine settles
+#the order's trades out of that reservation and releases what the order did not use, so a taker can no
+#longer run out of funds halfway through a sweep. Balance checks need the ledger: with matching shards
+#only the order size is checked here and the engine settles in SQLite as before
+class PreTradeRisk:
+    def __init__(self, max_order_qty: int = MAX_ORDER_QTY, price_band: float = PRICE_BAND):
+        self.max_order_qty = max_order_qty
+        self.price_band = price_band
+        self.last_price = {}
+        self.reservations = {}
+
+    #Called by the engine for every trade
+    def record(self, ticker: str, price: int):
+        self.last_price[ticker] = price
+
+    def reference_price(self, ticker: str):
+        price = self.last_price.get(ticker)
+        if price is None and ticker in books:
+            bid, ask = books[ticker].best_price(BUY), books[ticker].best_price(SELL)
+            price = (bid + ask) // 2 if bid is not None and ask is not None else bid or ask
+        return price
+
+    #(lowest, highest) price in ticks an order of the ticker may have, None without a reference price
+    def band(self, ticker: str):
+        reference = self.reference_price(ticker)
+        if not self.price_band or reference is None:
+            return None
+        width = int(reference * self.price_band)
+        return reference - width, reference + width
+
+    #Validates the order and reserves its funds, or raises ValueError having changed nothing
+    def check(self, order, user):
+        ticker, qty = order.body.ticker, order.body.qty
+        if qty > self.max_order_qty:
+            raise ValueError(f'Order quantity of {qty} lots is above the limit of {self.max_order_qty}')
+        if not ledger.loaded:
+            return
+        side = int(Direction.to_int(order.body.direction))
+        if isinstance(order, LimitOrder):
+            price = order.body.price
+        else:
+            book = books.get(ticker)
+            price = book.sweep_price(1 - side, qty) if book is not None else None
+            #Not enough standing orders: the engine does not execute it, nothing to reserve
+            if price is None:
+                return
+        band = self.band(ticker)
+        if band is not None and not band[0] <= price <= band[1]:
+            raise ValueError(f'Price {price} is outside the band {band[0]}-{band[1]} of {ticker}')
+        if side == BUY:
+            ledger.reserve(user.id, CASH_TICKER, get_spec(ticker).cash(qty, price))
+        else:
+            ledger.reserve(user.id, ticker, qty)
+        self.reservations[str(order.id)] = price
+
+    #Hands the order's reservation to the engine: the price its funds were reserved at, None if it has none
+    def take(self, order):
+        return self.reservations.pop(str(order.id), None)
+
+    #Releases the reservation of qty lots at price for an order the engine is done with
+    def release(self, order, user, qty: int, price: int):
+        if qty <= 0:
+            return
+        ticker = order.body.ticker
+        if order.body.direction == Direction.BUY:
+            ledger.release(user.id, CASH_TICKER, get_spec(ticker).cash(qty, price))
+        else:
+            ledger.release(user.id, ticker, qty)
+
+    #Releases the whole reservation of an order that never reached the engine, e.g. when storing it failed
+    def discard(self, order, user):
+        price = self.take(order)
+        if price is not None:
+            self.release(order, user, order.body.qty, price)
+
+
+risk = PreTradeRisk()
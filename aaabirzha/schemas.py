@@ -1,4 +1,5 @@
-from typing import List
+from typing import List, Union
+from decimal import Decimal
 
 from pydantic import BaseModel, field_validator
 from enum import Enum, IntEnum, StrEnum
@@ -7,6 +8,10 @@ from uuid import UUID
 from re import fullmatch
 
 
+#Decimal API amount. Whole amounts stay ints, so instruments with tick and lot size 1 look as before.
+#Past the API they are converted to integer ticks and lots (see instruments.InstrumentSpec)
+Number = Union[int, float]
+
 # Enums
 class Direction(StrEnum):
     BUY = "BUY"
@@ -64,6 +69,8 @@ class User(BaseModel):
 class InstrumentCreate(BaseModel):
     name: str
     ticker: str
+    tick_size: Decimal = Decimal(1)
+    lot_size: Decimal = Decimal(1)
 
     @field_validator('ticker')
     def check_ticker(cls, value):
@@ -71,6 +78,12 @@ class InstrumentCreate(BaseModel):
             raise ValueError(f'Invalid ticker "{value}"')
         return value
 
+    @field_validator('tick_size', 'lot_size')
+    def check_size(cls, value):
+        if value <= 0:
+            raise ValueError('Tick and lot size must be positive')
+        return value
+
 
 class Instrument(BaseModel):
     name: str
@@ -81,14 +94,14 @@ class Instrument(BaseModel):
 class MarketOrderBody(BaseModel):
     direction: Direction
     ticker: str
-    qty: int
+    qty: Number
 
     model_config = {"union_mode": "smart"}
 
     @field_validator('qty')
     def check_qty(cls, value):
-        if value < 1:
-            raise ValueError('Order quantity may not be less than 1')
+        if value <= 0:
+            raise ValueError('Order quantity must be positive')
         return value
 
     # @field_validator('direction', mode="before")
@@ -110,16 +123,16 @@ class MarketOrder(BaseModel):
 class LimitOrderBody(BaseModel):
     direction: Direction
     ticker: str
-    qty: int
-    price: int
+    qty: Number
+    price: Number
 
     model_config = {"union_mode": "smart"}
 
     @field_validator('qty')
     @classmethod
     def check_qty(cls, value):
-        if value < 1:
-            raise ValueError('Order quantity may not be less than 1')
+        if value <= 0:
+            raise ValueError('Order quantity must be positive')
         return value
 
     @field_validator('price')
@@ -142,7 +155,7 @@ class LimitOrder(BaseModel):
     user_id: UUID
     body: LimitOrderBody
     timestamp: datetime
-    filled: int = 0
+    filled: Number = 0
 
     class Config:
         from_attributes = True
@@ -162,7 +175,7 @@ class OrderType(StrEnum):
 
 class TransactionBody(BaseModel):
     ticker: str
-    qty: int
+    qty: Number
     price: float
     timestamp: datetime
 
@@ -182,11 +195,11 @@ class Ok(BaseModel):
 class AlterBalanceRequest(BaseModel):
     user_id: UUID
     ticker: str
-    amount: int
+    amount: Number
 
     @field_validator('amount')
     @classmethod
-    def is_non_negative(cls, amount: int) -> int:
+    def is_non_negative(cls, amount: Number) -> Number:
         if amount < 0:
             raise ValueError('Amount may not be negative')
         return amount
@@ -198,4 +211,15 @@ class Level(BaseModel):
 
 class L2OrderBook(BaseModel):
     bid_levels: List[Level]
-    ask_levels: List[Level]
\ No newline at end of file
+    ask_levels: List[Level]
+
+
+#OHLCV bar of one window, timestamp is the window start
+class Candle(BaseModel):
+    timestamp: str
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: float
+    trades: int
\ No newline at end of file
@@ -0,0 +1,93 @@
+import asyncio
+import inspect
+import logging
+import time
+
+from aaabirzha.metrics import matching_latency, matching_wait
+
+logger = logging.getLogger(__name__)
+
+
+class TickerStats:
+    __slots__ = ('processed', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, wait: float):
+        self.processed += 1
+        self.wait_total += wait
+        if wait > self.wait_max:
+            self.wait_max = wait
+
+
+#Single-writer sequencer: every ticker gets its own asyncio queue drained by a dedicated worker task,
+#so matching jobs for one ticker run strictly one after another in arrival order, while the workers
+#of different tickers interleave freely on the event loop
+class MatchingSequencer:
+    def __init__(self):
+        self.queues = {}
+        self.workers = {}
+        self.ticker_stats = {}
+
+    def _start_worker(self, ticker: str) -> asyncio.Queue:
+        queue = self.queues[ticker] = asyncio.Queue()
+        self.ticker_stats[ticker] = TickerStats()
+        self.workers[ticker] = asyncio.create_task(self._worker(ticker, queue), name=f'matching-{ticker}')
+        logger.info('Matching worker for %s started', ticker)
+        return queue
+
+    #Enqueues fn(*args) for the ticker and waits for its result. fn may be a plain function or a coroutine function
+    async def submit(self, ticker: str, fn, *args):
+        queue = self.queues.get(ticker) or self._start_worker(ticker)
+        future = asyncio.get_running_loop().create_future()
+        queue.put_nowait((fn, args, future, time.perf_counter()))
+        return await future
+
+    async def _worker(self, ticker: str, queue: asyncio.Queue):
+        stats = self.ticker_stats[ticker]
+        wait_histogram = matching_wait.labels(ticker)
+        run_histogram = matching_latency.labels(ticker)
+        while True:
+            fn, args, future, enqueued_at = await queue.get()
+            started_at = time.perf_counter()
+            stats.record_wait(started_at - enqueued_at)
+            wait_histogram.observe(started_at - enqueued_at)
+            try:
+                if future.cancelled():
+                    continue
+                result = fn(*args)
+                if inspect.isawaitable(result):
+                    result = await result
+                run_histogram.observe(time.perf_counter() - started_at)
+                if not future.done():
+                    future.set_result(result)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                queue.task_done()
+
+    def stats(self) -> dict:
+        return {
+            ticker: {
+                'queue_depth': self.queues[ticker].qsize(),
+                'processed': stats.processed,
+                'avg_wait_ms': stats.wait_total / stats.processed * 1000 if stats.processed else 0.0,
+                'max_wait_ms': stats.wait_max * 1000
+            }
+            for ticker, stats in self.ticker_stats.items()
+        }
+
+    async def shutdown(self):
+        for worker in self.workers.values():
+            worker.cancel()
+        await asyncio.gather(*self.workers.values(), return_exceptions=True)
+        self.queues.clear()
+        self.workers.clear()
+        self.ticker_stats.clear()
+
+
+sequencer = MatchingSequencer()
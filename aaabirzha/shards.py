@@ -0,0 +1,449 @@
+import argparse
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import pickle
+import signal
+import struct
+import zlib
+from pathlib import Path
+
+import aaabirzha.database as db_fnc
+import aaabirzha.matching_engine as engine
+from aaabirzha.instruments import set_spec, drop_spec, load_specs
+from aaabirzha.market_data import Subscription, SUBSCRIBER_BUFFER, market_data, orderbook_json
+from aaabirzha.recovery import RECOVERY_DIR, journal
+from aaabirzha.sequencer import sequencer
+from aaabirzha.trade_tape import trade_tape
+from aaabirzha.candles import candles
+from aaabirzha.logging_config import setup_logging
+
+logger = logging.getLogger(__name__)
+
+#Number of matching processes. 0 keeps matching inside every API worker process
+SHARD_COUNT = int(os.environ.get('AAABIRZHA_SHARDS', 0))
+#Directory of the shard sockets, only the owner of the process may connect
+SOCKET_DIR = os.environ.get('AAABIRZHA_SHARD_DIR', f'{db_fnc.DB_PATH}.shards')
+#Seconds an API worker keeps retrying to connect to a shard that is not listening yet
+CONNECT_TIMEOUT = float(os.environ.get('AAABIRZHA_SHARD_CONNECT_TIMEOUT', 10))
+RECONNECT_INTERVAL = 1.0
+#Bytes of market data waiting to be written to one API worker before its stream is conflated
+FORWARD_BUFFER = 1 << 20
+
+LENGTH = struct.Struct('>I')
+
+#Matching jobs a shard runs on its sequencer, by name
+ENGINE_OPERATIONS = {fn.__name__: fn for fn in (engine.execute_market_order, engine.execute_limit_order,
+                                                 engine.execute_batch, engine.cancel_order, engine.cancel_orders)}
+#Requests a shard answers right away on its event loop, called with the ticker and the request args
+LOCAL_OPERATIONS = {
+    'snapshot': lambda ticker: market_data.snapshot(ticker),
+    'orderbook': orderbook_json,
+    'set_spec': lambda ticker, spec: set_spec(spec),
+    'drop_spec': drop_spec,
+    'stats': lambda ticker: sequencer.stats(),
+    'candles': candles.bars,
+}
+
+
+#Stable across processes and restarts, unlike hash() of a str
+def shard_of(ticker: str, count: int = SHARD_COUNT) -> int:
+    return zlib.crc32(ticker.encode()) % count
+
+
+def socket_path(shard: int, directory: str = SOCKET_DIR) -> Path:
+    return Path(directory) / f'shard-{shard}.sock'
+
+
+#Messages are length-prefixed pickles. Requests are (request_id, op, ticker, args), replies
+#(request_id, ok, result or exception). Request id 0 asks for no reply, a reply with id 0 is a market data
+#message (ticker, payload) pushed by the shard
+def encode(message) -> bytes:
+    try:
+        payload = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    except (pickle.PicklingError, TypeError, AttributeError) as e:
+        request_id, ok, value = message
+        payload = pickle.dumps((request_id, False, RuntimeError(f'{value!r} could not be sent: {e}')))
+    return LENGTH.pack(len(payload)) + payload
+
+
+async def read_message(reader: asyncio.StreamReader):
+    length, = LENGTH.unpack(await reader.readexactly(LENGTH.size))
+    return pickle.loads(await reader.readexactly(length))
+
+
+def reply(writer: asyncio.StreamWriter, request_id: int, ok: bool, value):
+    if request_id and not writer.is_closing():
+        writer.write(encode((request_id, ok, value)))
+
+
+#Stands in for the queue of a subscription held by an API worker: published messages are written to its
+#connection right away, so they reach it in publish order and in order with the replies to its snapshot
+#requests. While the connection has FORWARD_BUFFER bytes unwritten messages are dropped, the next one is
+#replaced by a snapshot covering them
+class ForwardQueue:
+    def __init__(self, writer: asyncio.StreamWriter, ticker: str):
+        self.writer = writer
+        self.ticker = ticker
+        self.stale = False
+
+    def put_nowait(self, payload: str):
+        if self.writer.is_closing():
+            return
+        if self.writer.transport.get_write_buffer_size() > FORWARD_BUFFER:
+            if not self.stale:
+                logger.warning('Market data of %s conflated for a slow API worker', self.ticker)
+            self.stale = True
+            return
+        if self.stale:
+            self.stale = False
+            payload = market_data.snapshot(self.ticker)
+        self.writer.write(encode((0, True, (self.ticker, payload))))
+
+
+async def run_operation(writer: asyncio.StreamWriter, request_id: int, op: str, ticker: str, args: tuple):
+    try:
+        result = True, await sequencer.submit(ticker, ENGINE_OPERATIONS[op], *args)
+    except Exception as e:
+        result = False, e
+    reply(writer, request_id, *result)
+
+
+#One connection per API worker. Matching jobs are queued on the sequencer and answered when they finish,
+#every other request is answered before the next one is read
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    forwarded = {}
+    jobs = set()
+    try:
+        while True:
+            request_id, op, ticker, args = await read_message(reader)
+            if op in ENGINE_OPERATIONS:
+                job = asyncio.create_task(run_operation(writer, request_id, op, ticker, args))
+                jobs.add(job)
+                job.add_done_callback(jobs.discard)
+            elif op == 'subscribe':
+                if ticker not in forwarded:
+                    subscription = forwarded[ticker] = Subscription(ticker, 1)
+                    subscription.queue = ForwardQueue(writer, ticker)
+                    market_data.attach(subscription)
+            elif op == 'unsubscribe':
+                if ticker in forwarded:
+                    market_data.unsubscribe(forwarded.pop(ticker))
+            elif op in LOCAL_OPERATIONS:
+                try:
+                    reply(writer, request_id, True, LOCAL_OPERATIONS[op](ticker, *args))
+                except Exception as e:
+                    reply(writer, request_id, False, e)
+            else:
+                reply(writer, request_id, False, ValueError(f'Unknown shard operation {op}'))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        for subscription in forwarded.values():
+            market_data.unsubscribe(subscription)
+        writer.close()
+
+
+#Body of one shard process: recovers the books of its tickers from its own snapshot and journal directory,
+#then serves matching jobs until SIGTERM or SIGINT
+async def serve(shard: int, count: int, directory: str = SOCKET_DIR):
+    db_fnc.init_db()
+    load_specs()
+    journal.directory = Path(RECOVERY_DIR) / f'shard-{shard}'
+    journal.owns = lambda ticker: shard_of(ticker, count) == shard
+    journal.recover()
+    journal.start()
+    candles.load([row['ticker'] for row in db_fnc.get_all_instruments() if journal.owns(row['ticker'])])
+
+    path = socket_path(shard, directory)
+    path.unlink(missing_ok=True)
+    server = await asyncio.start_unix_server(handle_connection, path)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop.set)
+    logger.info('Shard %s of %s listening on %s', shard, count, path)
+    try:
+        await stop.wait()
+    finally:
+        server.close()
+        await sequencer.shutdown()
+        await journal.stop()
+        await trade_tape.stop()
+        await candles.stop()
+        db_fnc.close_db()
+        path.unlink(missing_ok=True)
+        logger.info('Shard %s stopped', shard)
+
+
+def run_shard(shard: int, count: int, directory: str):
+    setup_logging()
+    asyncio.run(serve(shard, count, directory))
+
+
+#API worker side of the market data streams when matching runs in shard processes. Each ticker has one
+#upstream subscription on the connection to its shard, fanned out to the local subscribers with the seq of
+#the shard. A new or conflated subscriber waits for a snapshot requested on that same connection: the shard
+#writes the reply in order with the published messages, so everything after it has a greater seq
+class MarketDataRelay:
+    def __init__(self, client, buffer: int = SUBSCRIBER_BUFFER):
+        self.client = client
+        self.buffer = buffer
+        self.subscribers = {}
+        self.waiting = set()
+        self.tasks = set()
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def subscribe(self, ticker: str) -> Subscription:
+        subscription = Subscription(ticker, self.buffer)
+        upstream = ticker not in self.subscribers
+        self.subscribers.setdefault(ticker, set()).add(subscription)
+        self._spawn(self._attach(ticker, [subscription], upstream))
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.waiting.discard(subscription)
+        subscribers = self.subscribers.get(subscription.ticker)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self.subscribers[subscription.ticker]
+                self._spawn(self._detach(subscription.ticker))
+
+    async def _attach(self, ticker: str, subscriptions: list, upstream: bool):
+        self.waiting.update(subscriptions)
+        try:
+            if upstream:
+                await self.client.send(ticker, 'subscribe')
+            for subscription in subscriptions:
+                await self.client.send(ticker, 'snapshot', callback=lambda ok, payload, subscription=subscription:
+                                       self._snapshot(subscription, ok, payload))
+        except OSError as e:
+            logger.error('Failed to subscribe to the market data of %s\n%s', ticker, e)
+
+    async def _detach(self, ticker: str):
+        try:
+            if ticker not in self.subscribers:
+                await self.client.send(ticker, 'unsubscribe')
+        except OSError:
+            pass
+
+    #Runs on the connection reader before the next message is read
+    def _snapshot(self, subscription: Subscription, ok: bool, payload):
+        if subscription not in self.waiting:
+            return
+        if not ok:
+            logger.error('Market data snapshot of %s failed: %s', subscription.ticker, payload)
+            return
+        self.waiting.discard(subscription)
+        subscription.queue.put_nowait(payload)
+
+    def publish(self, ticker: str, payload: str):
+        for subscription in self.subscribers.get(ticker, ()):
+            if subscription in self.waiting:
+                continue
+            try:
+                subscription.queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                self._conflate(subscription)
+
+    def _conflate(self, subscription: Subscription):
+        queue = subscription.queue
+        while not queue.empty():
+            queue.get_nowait()
+        subscription.conflations += 1
+        if subscription.conflations == 1 or subscription.conflations % 100 == 0:
+            logger.warning('Slow market data subscriber on %s conflated %s times',
+                           subscription.ticker, subscription.conflations)
+        self._spawn(self._attach(subscription.ticker, [subscription], False))
+
+    def _tickers(self, shard: int) -> list:
+        return [ticker for ticker in self.subscribers if shard_of(ticker, self.client.count) == shard]
+
+    #A new connection to the shard has no upstream subscriptions yet
+    def connected(self, shard: int):
+        for ticker in self._tickers(shard):
+            self._spawn(self._attach(ticker, list(self.subscribers[ticker]), True))
+
+    def disconnected(self, shard: int):
+        tickers = self._tickers(shard)
+        for ticker in tickers:
+            self.waiting.update(self.subscribers[ticker])
+        if tickers:
+            self._spawn(self._reconnect(shard))
+
+    async def _reconnect(self, shard: int):
+        while self._tickers(shard):
+            try:
+                await self.client.connection(shard)
+                return
+            except OSError as e:
+                logger.warning('Shard %s unreachable, retrying\n%s', shard, e)
+                await asyncio.sleep(RECONNECT_INTERVAL)
+
+
+#Used by the API workers in place of the sequencer: matching jobs are sent to the shard owning the ticker,
+#over one connection per shard shared by all concurrent requests of the worker
+class ShardClient:
+    def __init__(self, count: int = SHARD_COUNT, directory: str = SOCKET_DIR, connect_timeout: float = CONNECT_TIMEOUT):
+        self.count = count
+        self.directory = directory
+        self.connect_timeout = connect_timeout
+        self.writers = {}
+        self.readers = {}
+        self.locks = {}
+        self.pending = {}
+        self.ids = itertools.count(1)
+        self.market_data = MarketDataRelay(self)
+
+    async def connect(self):
+        await asyncio.gather(*(self.connection(shard) for shard in range(self.count)))
+
+    #The writer of the shard connection, connecting first if needed. Retries until connect_timeout while
+    #the shard process is still starting
+    async def connection(self, shard: int) -> asyncio.StreamWriter:
+        writer = self.writers.get(shard)
+        if writer is not None:
+            return writer
+        async with self.locks.setdefault(shard, asyncio.Lock()):
+            if shard in self.writers:
+                return self.writers[shard]
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.connect_timeout
+            while True:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(socket_path(shard, self.directory))
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if loop.time() >= deadline:
+                        raise
+                    await asyncio.sleep(0.1)
+            self.writers[shard] = writer
+            self.readers[shard] = asyncio.create_task(self._read(shard, reader), name=f'shard-{shard}')
+            logger.info('Connected to shard %s', shard)
+        self.market_data.connected(shard)
+        return writer
+
+    async def _read(self, shard: int, reader: asyncio.StreamReader):
+        try:
+            while True:
+                request_id, ok, value = await read_message(reader)
+                if not request_id:
+                    self.market_data.publish(*value)
+                    continue
+                _, waiter = self.pending.pop(request_id, (None, None))
+                if isinstance(waiter, asyncio.Future):
+                    if not waiter.done():
+                        if ok:
+                            waiter.set_result(value)
+                        else:
+                            waiter.set_exception(value)
+                elif waiter is not None:
+                    waiter(ok, value)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logger.error('Connection to shard %s lost: %s', shard, e)
+        finally:
+            writer = self.writers.pop(shard, None)
+            if writer is not None:
+                writer.close()
+            self.readers.pop(shard, None)
+            for request_id, (owner, waiter) in list(self.pending.items()):
+                if owner == shard:
+                    del self.pending[request_id]
+                    if isinstance(waiter, asyncio.Future) and not waiter.done():
+                        waiter.set_exception(ConnectionError(f'Connection to shard {shard} lost'))
+            self.market_data.disconnected(shard)
+
+    #Sends a request. callback(ok, value) is run with the reply by the connection reader, without one no
+    #reply is asked for
+    async def send(self, ticker: str, op: str, *args, shard: int = None, callback=None):
+        shard = shard_of(ticker, self.count) if shard is None else shard
+        writer = await self.connection(shard)
+        request_id = 0
+        if callback is not None:
+            request_id = next(self.ids)
+            self.pending[request_id] = (shard, callback)
+        writer.write(encode((request_id, op, ticker, args)))
+
+    #Sends a request to the shard of the ticker (or to the given shard) and waits for the reply
+    async def request(self, ticker: str, op: str, *args, shard: int = None):
+        shard = shard_of(ticker, self.count) if shard is None else shard
+        writer = await self.connection(shard)
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = (shard, future)
+        writer.write(encode((request_id, op, ticker, args)))
+        try:
+            return await future
+        finally:
+            self.pending.pop(request_id, None)
+
+    #Same contract as MatchingSequencer.submit, fn is one of the ENGINE_OPERATIONS
+    async def submit(self, ticker: str, fn, *args):
+        if ENGINE_OPERATIONS.get(fn.__name__) is not fn:
+            raise ValueError(f'{fn.__name__} cannot run on a shard')
+        return await self.request(ticker, fn.__name__, *args)
+
+    #Matching worker stats of every shard, merged (every ticker lives on exactly one shard)
+    async def stats(self) -> dict:
+        merged = {}
+        for shard_stats in await asyncio.gather(*(self.request(None, 'stats', shard=shard) for shard in range(self.count))):
+            merged.update(shard_stats)
+        return merged
+
+    async def close(self):
+        #Without subscribers a lost connection is not reconnected
+        self.market_data.subscribers.clear()
+        tasks = [*self.readers.values(), *self.market_data.tasks]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+
+
+shard_client = ShardClient()
+
+
+#Starts one process per shard and waits for them. The API workers are started separately with the same
+#AAABIRZHA_SHARDS, e.g. uvicorn aaabirzha.main:app --workers 4
+#Usage: AAABIRZHA_SHARDS=4 python -m aaabirzha.shards
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shards', type=int, default=SHARD_COUNT)
+    parser.add_argument('--socket-dir', default=SOCKET_DIR)
+    args = parser.parse_args()
+    if args.shards < 1:
+        parser.error('set AAABIRZHA_SHARDS or --shards to the number of matching processes')
+    setup_logging()
+    os.makedirs(args.socket_dir, mode=0o700, exist_ok=True)
+    os.chmod(args.socket_dir, 0o700)
+    #Creates and migrates the database once, before the shards open it
+    db_fnc.init_db()
+    db_fnc.close_db()
+
+    #The target comes from the imported module rather than __main__, so shard processes log as aaabirzha.shards
+    from aaabirzha.shards import run_shard
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_shard, args=(shard, args.shards, args.socket_dir), name=f'shard-{shard}')
+                 for shard in range(args.shards)]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: [process.terminate() for process in processes])
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -124,4 +124,124 @@ class TestUserRegistration:
 
             assert "id" in user_response
             assert "name" in user_response
-            assert user_response["name"] == "structure_test_user"
\ No newline at end of file
+            assert user_response["name"] == "structure_test_user"
+
+class TestBatchOrders:
+    def test_batch_is_grouped_by_ticker_and_answered_per_order(self):
+        from uuid import uuid4
+        from aaabirzha.instruments import InstrumentSpec
+        from aaabirzha.schemas import User, UserRole
+
+        user = User(id=uuid4(), name='maker', role=UserRole.USER, api_key='key-maker')
+        submitted = {}
+
+        async def submit(ticker, fn, orders, current_user):
+            submitted[ticker] = orders
+            if ticker == 'BBB':
+                raise ValueError('book unavailable')
+            return [True, ValueError('not enough RUB')][:len(orders)]
+
+        def get_spec(ticker):
+            if ticker == 'NOPE':
+                raise ValueError('Instrument NOPE not found')
+            return InstrumentSpec(ticker)
+
+        batch = [
+            {'direction': 'BUY', 'ticker': 'AAA', 'qty': 1, 'price': 10},
+            {'direction': 'SELL', 'ticker': 'BBB', 'qty': 2},
+            {'direction': 'BUY', 'ticker': 'NOPE', 'qty': 1, 'price': 10},
+            {'direction': 'SELL', 'ticker': 'AAA', 'qty': 3, 'price': 11},
+        ]
+        app.dependency_overrides[main_module.get_current_user] = lambda: user
+        try:
+            with patch.object(main_module, 'get_spec', get_spec), \
+                    patch.object(main_module.sequencer, 'submit', submit):
+                response = client.post('/api/v1/order/batch', json=batch)
+        finally:
+            app.dependency_overrides.clear()
+
+        assert response.status_code == 200
+        results = response.json()
+        assert [result['success'] for result in results] == [True, False, False, False]
+        assert [order.body.price for order in submitted['AAA']] == [10, 11]
+        assert [str(order.id) for order in submitted['AAA']] == [results[0]['order_id'], results[3]['order_id']]
+        assert 'book unavailable' in results[1]['detail']
+        assert 'NOPE' in results[2]['detail'] and 'order_id' not in results[2]
+        assert 'not enough RUB' in results[3]['detail']
+
+
+class TestHistoryPages:
+    def test_orders_are_paged_by_cursor_and_filtered_in_sql(self):
+        import sqlite3 as sql
+        from uuid import uuid4
+        from aaabirzha.migrations import apply_migrations
+        from aaabirzha.schemas import User, UserRole
+
+        user = User(id=uuid4(), name='trader', role=UserRole.USER, api_key='key-trader')
+        conn = sql.connect(':memory:', check_same_thread=False)
+        conn.row_factory = sql.Row
+        apply_migrations(conn)
+        conn.execute("INSERT INTO Instruments (name, ticker) VALUES ('Memcoin', 'MEMC')")
+        conn.execute("INSERT INTO Users (id, name, role, api_key_hashed) VALUES (?, 'trader', 0, 'hash')", (str(user.id),))
+        #Five orders share a timestamp, so pages have to continue inside it by id
+        conn.executemany('''
+INSERT INTO Orders (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+VALUES (?, ?, ?, ?, 0, 'MEMC', 1, 10, 0, 1)''',
+                         [(f'order-{n}', 3 if n % 2 else 0, str(user.id), f'2026-01-01 10:00:0{n // 5}') for n in range(7)])
+
+        async def read(fn, *args, **kwargs):
+            return fn(*args, **kwargs)
+
+        app.dependency_overrides[main_module.get_current_user] = lambda: user
+        pages, cursor = [], None
+        try:
+            with patch.object(main_module.db_fnc, 'conn', conn), patch.object(main_module.db_pool, 'read', read):
+                while True:
+                    response = client.get('/api/v1/order/', params={'limit': 3, **({'after': cursor} if cursor else {})})
+                    pages.append([order['id'] for order in response.json()])
+                    cursor = response.headers.get('X-Next-Cursor')
+                    if cursor is None:
+                        break
+                cancelled = client.get('/api/v1/order/', params={'status': 'CANCELLED'}).json()
+        finally:
+            app.dependency_overrides.clear()
+
+        assert pages == [['order-0', 'order-1', 'order-2'], ['order-3', 'order-4', 'order-5'], ['order-6']]
+        assert [order['id'] for order in cancelled] == ['order-1', 'order-3', 'order-5']
+
+
+class TestExport:
+    def test_tables_stream_as_ndjson_and_csv_with_time_filters(self, tmp_path):
+        import csv
+        import json
+        import sqlite3 as sql
+        from uuid import uuid4
+        from aaabirzha.migrations import apply_migrations
+        from aaabirzha.schemas import User, UserRole
+
+        path = tmp_path / 'export.db'
+        conn = sql.connect(path)
+        apply_migrations(conn)
+        conn.execute("INSERT INTO Instruments (name, ticker) VALUES ('Memcoin', 'MEMC')")
+        conn.execute("INSERT INTO Users (id, name, role, api_key_hashed) VALUES ('u1', 'trader', 0, 'hash')")
+        conn.executemany('''
+INSERT INTO Transactions (user_id, ticker, direction, amount, price, timestamp) VALUES ('u1', 'MEMC', 0, ?, 10, ?)''',
+                         [(n + 1, f'2026-01-0{n + 1} 12:00:00') for n in range(5)])
+        conn.commit()
+        conn.close()
+
+        admin = User(id=uuid4(), name='admin', role=UserRole.ADMIN, api_key='key-admin')
+        app.dependency_overrides[main_module.get_current_user] = lambda: admin
+        try:
+            with patch.object(main_module.db_fnc, 'db_path', str(path)):
+                ndjson = client.get('/api/v1/admin/export/transactions',
+                                    params={'since': '2026-01-02T00:00:00', 'until': '2026-01-05T00:00:00'})
+                balances = client.get('/api/v1/admin/export/balances', params={'format': 'csv'})
+                rejected = client.get('/api/v1/admin/export/balances', params={'since': '2026-01-02T00:00:00'})
+        finally:
+            app.dependency_overrides.clear()
+
+        assert ndjson.headers['content-type'] == 'application/x-ndjson'
+        assert [json.loads(line)['amount'] for line in ndjson.text.splitlines()] == [2, 3, 4]
+        assert list(csv.reader(balances.text.splitlines())) == [['user_id', 'ticker', 'balance', 'frozen']]
+        assert rejected.status_code == 422
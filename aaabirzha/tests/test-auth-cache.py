@@ -0,0 +1,44 @@
+from unittest.mock import patch
+
+from aaabirzha.auth_cache import AuthCache
+
+
+class TestAuthCache:
+    def test_hit_and_miss(self):
+        cache = AuthCache()
+        cache.put('hash-1', 'user-1', 'alice')
+
+        assert cache.get('hash-1') == 'alice'
+        assert cache.get('hash-2') is None
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = AuthCache(maxsize=2)
+        cache.put('hash-1', 'user-1', 'alice')
+        cache.put('hash-2', 'user-2', 'bob')
+        cache.get('hash-1')
+        cache.put('hash-3', 'user-3', 'carol')
+
+        assert cache.get('hash-2') is None
+        assert cache.get('hash-1') == 'alice'
+        assert cache.get('hash-3') == 'carol'
+        assert len(cache) == 2
+
+    def test_entries_expire(self):
+        cache = AuthCache(ttl=10)
+        with patch('aaabirzha.auth_cache.time.monotonic', return_value=100.0):
+            cache.put('hash-1', 'user-1', 'alice')
+        with patch('aaabirzha.auth_cache.time.monotonic', return_value=105.0):
+            assert cache.get('hash-1') == 'alice'
+        with patch('aaabirzha.auth_cache.time.monotonic', return_value=111.0):
+            assert cache.get('hash-1') is None
+        assert len(cache) == 0
+
+    def test_invalidate_user(self):
+        cache = AuthCache()
+        cache.put('hash-1', 'user-1', 'alice')
+        cache.put('hash-2', 'user-2', 'bob')
+
+        cache.invalidate_user('user-1')
+
+        assert cache.get('hash-1') is None
+        assert cache.get('hash-2') == 'bob'
@@ -0,0 +1,19 @@
+from aaabirzha.benchmarks.report import latency, regressions
+
+
+def test_latency_percentiles():
+    result = latency([i / 1e6 for i in range(1, 1001)])
+
+    assert result == {'p50_us': 500.5, 'p99_us': 991.0, 'p999_us': 1000.0}
+
+
+def test_regressions_compare_matching_cases_only():
+    baseline = [{'benchmark': 'engine', 'depth': 10, 'p50_us': 100.0, 'orders_per_s': 1000.0},
+                {'benchmark': 'engine', 'depth': 100, 'p50_us': 100.0, 'orders_per_s': 1000.0}]
+    current = [{'benchmark': 'engine', 'depth': 10, 'p50_us': 130.0, 'orders_per_s': 700.0},
+               {'benchmark': 'engine', 'depth': 100, 'p50_us': 110.0, 'orders_per_s': 950.0},
+               {'benchmark': 'engine', 'depth': 1000, 'p50_us': 900.0, 'orders_per_s': 10.0}]
+
+    found = regressions(baseline, current, threshold=0.2)
+
+    assert [(case['depth'], metric) for case, metric, old, new in found] == [(10, 'p50_us'), (10, 'orders_per_s')]
@@ -0,0 +1,69 @@
+import asyncio
+import sqlite3 as sql
+from datetime import datetime
+from unittest.mock import patch
+
+import pytest
+
+from aaabirzha.candles import CandleAggregator, bar_time
+from aaabirzha.database import backfill_candles
+from aaabirzha.migrations import apply_migrations
+
+TRADES = [
+    (datetime(2026, 1, 1, 10, 0, 0, 500000), 100, 2),
+    (datetime(2026, 1, 1, 10, 0, 0, 900000), 103, 1),
+    (datetime(2026, 1, 1, 10, 0, 1, 200000), 99, 4),
+    (datetime(2026, 1, 1, 10, 1, 5), 101, 3),
+]
+
+
+def aggregate(trades) -> CandleAggregator:
+    async def run():
+        aggregator = CandleAggregator(history=10)
+        for timestamp, price, qty in trades:
+            aggregator.record('MEMC', price, qty, timestamp)
+        aggregator.task.cancel()
+        return aggregator
+
+    return asyncio.run(run())
+
+
+def ohlcv(bar) -> tuple:
+    return bar_time(bar.start), bar.open, bar.high, bar.low, bar.close, bar.volume, bar.trades
+
+
+class TestCandles:
+    def test_trades_update_the_bars_of_every_interval(self):
+        aggregator = aggregate(TRADES)
+
+        assert [ohlcv(bar) for bar in aggregator.bars('MEMC', '1s', 10)] == [
+            ('2026-01-01 10:00:00', 100, 103, 100, 103, 3, 2),
+            ('2026-01-01 10:00:01', 99, 99, 99, 99, 4, 1),
+            ('2026-01-01 10:01:05', 101, 101, 101, 101, 3, 1),
+        ]
+        assert [ohlcv(bar) for bar in aggregator.bars('MEMC', '1m', 1)] == [('2026-01-01 10:01:00', 101, 101, 101, 101, 3, 1)]
+        assert [ohlcv(bar) for bar in aggregator.bars('MEMC', '1d', 10)] == [('2026-01-01 00:00:00', 100, 103, 99, 101, 10, 4)]
+        assert len(aggregator.pending) == 3
+        with pytest.raises(ValueError):
+            aggregator.bars('MEMC', '5m', 10)
+
+    def test_backfill_builds_the_same_bars_from_transactions(self):
+        conn = sql.connect(':memory:')
+        apply_migrations(conn)
+        #Each trade is stored once per side, the SELL rows must not count twice
+        conn.executemany('''
+INSERT INTO Transactions (user_id, ticker, direction, amount, price, timestamp) VALUES ('u', 'MEMC', ?, ?, ?, ?)''',
+                         [(direction, qty, price, str(timestamp)) for timestamp, price, qty in TRADES for direction in (0, 1)])
+        with patch('aaabirzha.database.conn', conn):
+            backfill_candles([1, 60])
+            conn.execute("UPDATE Candles SET close = 0 WHERE start < strftime('%s', '2026-01-01 10:01:00')")
+            backfill_candles([1, 60], since='2026-01-01 10:01:00')
+            stale = conn.execute('SELECT count(*) FROM Candles WHERE close = 0').fetchone()[0]
+            backfill_candles([1, 60], since='2026-01-01 10:00:00')
+
+        aggregator = aggregate(TRADES)
+        seconds = [bar.row('MEMC', 1) for bar in aggregator.bars('MEMC', '1s', 10)]
+        minutes = [bar.row('MEMC', 60) for bar in aggregator.bars('MEMC', '1m', 10)]
+        #A catch-up leaves the bars before since alone
+        assert stale == 3
+        assert conn.execute('SELECT * FROM Candles ORDER BY interval, start').fetchall() == seconds + minutes
@@ -0,0 +1,56 @@
+import sqlite3 as sql
+from unittest.mock import patch
+
+import pytest
+
+from aaabirzha.instruments import InstrumentSpec, spec_or_units
+from aaabirzha.migrations import apply_migrations
+
+
+class TestInstrumentSpec:
+    def test_api_amounts_round_trip_through_ticks_and_lots(self):
+        spec = InstrumentSpec('MEMC', tick_size='0.01', lot_size=10, cash_lot_size='0.01')
+        assert spec.ticks(12.34) == 1234
+        assert spec.lots(50) == 5
+        assert spec.price(1234) == 12.34
+        assert spec.qty(5) == 50
+        assert isinstance(spec.qty(5), int)
+
+    def test_off_grid_amounts_are_rejected(self):
+        spec = InstrumentSpec('MEMC', tick_size='0.05', lot_size=10, cash_lot_size='0.01')
+        with pytest.raises(ValueError):
+            spec.ticks(1.01)
+        with pytest.raises(ValueError):
+            spec.lots(15)
+
+    def test_cash_leg_is_whole_cash_lots(self):
+        spec = InstrumentSpec('MEMC', tick_size='0.01', lot_size=10, cash_lot_size='0.1')
+        assert spec.cash_per_lot_tick == 1
+        assert spec.cash(3, 250) == 750
+        with pytest.raises(ValueError):
+            InstrumentSpec('MEMC', tick_size='0.01', lot_size=1, cash_lot_size='0.1')
+
+    def test_deleted_instrument_is_shown_in_unit_sizes(self):
+        with patch('aaabirzha.instruments.specs', {'MEMC': InstrumentSpec('MEMC', lot_size=10)}), \
+                patch('aaabirzha.instruments.db_fnc.get_instrument', return_value=None):
+            assert spec_or_units('MEMC').qty(3) == 30
+            assert spec_or_units('OTH').qty(3) == 3
+
+
+def test_migration_converts_amounts_to_integers():
+    conn = sql.connect(':memory:')
+    apply_migrations(conn, target=2)
+    conn.execute("INSERT INTO Instruments (name, ticker) VALUES ('Memcoin', 'MEMC')")
+    conn.execute('''INSERT INTO Orders (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+VALUES ('o1', 2, 'u1', '2025-01-01 00:00:00', 0, 'MEMC', 15.0, 55.0, 10.0, 1)''')
+    conn.execute("INSERT INTO UserBalance (user_id, ticker, balance, frozen) VALUES ('u1', 'RUB', 9200.0, 275.0)")
+    conn.commit()
+
+    apply_migrations(conn)
+
+    assert conn.execute('SELECT typeof(qty), typeof(price), qty, price, filled FROM Orders').fetchone() == \
+        ('integer', 'integer', 15, 55, 10)
+    assert conn.execute('SELECT balance, frozen FROM UserBalance').fetchone() == (9200, 275)
+    assert conn.execute("SELECT tick_size, lot_size FROM Instruments WHERE ticker = 'MEMC'").fetchone() == ('1', '1')
+    conn.execute("UPDATE Orders SET filled = 15 WHERE id = 'o1'")
+    assert conn.execute('SELECT status FROM Orders').fetchone() == (1,)
@@ -0,0 +1,92 @@
+import asyncio
+import sqlite3 as sql
+from unittest.mock import patch
+
+import pytest
+
+import aaabirzha.database as db_fnc
+from aaabirzha.instruments import InstrumentSpec
+from aaabirzha.ledger import BalanceLedger
+from aaabirzha.migrations import apply_migrations
+from aaabirzha.orderbook import BookOrder, BUY, SELL
+
+
+def make_db(balances: list, orders: list) -> sql.Connection:
+    conn = sql.connect(':memory:', check_same_thread=False)
+    conn.row_factory = sql.Row
+    apply_migrations(conn)
+    conn.execute("INSERT INTO Instruments (name, ticker) VALUES ('Memcoin', 'MEMC')")
+    conn.executemany('INSERT INTO UserBalance (user_id, ticker, balance, frozen) VALUES (?, ?, ?, ?)', balances)
+    conn.executemany('''
+INSERT INTO Orders (id, status, user_id, timestamp, direction, ticker, qty, price, filled, type)
+VALUES (?, 0, ?, '2026-01-01 10:00:00', ?, 'MEMC', ?, ?, 0, 1)''', orders)
+    conn.commit()
+    return conn
+
+
+def stored(conn: sql.Connection) -> list:
+    return [tuple(row) for row in conn.execute('SELECT user_id, ticker, balance, frozen FROM UserBalance ORDER BY 1, 2')]
+
+
+class TestBalanceLedger:
+    def test_matches_and_cancels_are_checked_in_memory_and_written_together(self):
+        conn = make_db([('buyer', 'RUB', 1000, 0), ('seller', 'MEMC', 50, 20)], [('s1', 'seller', SELL, 20, 10)])
+
+        async def run():
+            ledger = BalanceLedger()
+            ledger.load()
+            await ledger.settle('buyer', 'seller', 'MEMC', 10, 5, 's1', SELL, 10)
+            #A failed guard leaves every balance as it was
+            with pytest.raises(ValueError, match='does not have 150 MEMC frozen'):
+                await ledger.settle('buyer', 'seller', 'MEMC', 10, 150, 's1', SELL, 10)
+            with pytest.raises(ValueError, match='Cannot withdraw 2000 RUB, only 950 available'):
+                await ledger.update('buyer', 'RUB', -2000)
+            assert stored(conn)[0] == ('buyer', 'RUB', 1000, 0)
+            ledger.cancel('seller', 'MEMC', [BookOrder('s1', 'seller', SELL, 10, 20, 5)])
+            balances = await ledger.balances('buyer')
+            await ledger.stop()
+            return balances
+
+        with patch('aaabirzha.database.conn', conn):
+            balances = asyncio.run(run())
+
+        assert balances == {'RUB': 950, 'MEMC': 5}
+        assert stored(conn) == [('buyer', 'MEMC', 5, 0), ('buyer', 'RUB', 950, 0),
+                                ('seller', 'MEMC', 45, 0), ('seller', 'RUB', 50, 0)]
+        assert tuple(conn.execute("SELECT filled, status FROM Orders WHERE id = 's1'").fetchone()) == (5, 3)
+
+    def test_load_rebuilds_frozen_amounts_from_open_orders(self):
+        #The buy order was committed but its freeze was lost, the seller has nothing left on the book
+        conn = make_db([('buyer', 'RUB', 1000, 0), ('seller', 'MEMC', 50, 20)], [('b1', 'buyer', BUY, 3, 7)])
+        ledger = BalanceLedger()
+        with patch('aaabirzha.database.conn', conn), \
+                patch('aaabirzha.ledger.get_spec', return_value=InstrumentSpec('MEMC', tick_size=2)):
+            ledger.load()
+
+        assert ledger.accounts['buyer']['RUB'].frozen == 42
+        assert stored(conn) == [('buyer', 'RUB', 1000, 42), ('seller', 'MEMC', 50, 0)]
+
+    def test_frozen_funds_cannot_be_withdrawn_and_a_bad_batch_does_not_block_later_ones(self):
+        conn = make_db([('buyer', 'RUB', 1000, 500), ('seller', 'MEMC', 50, 0)], [('b1', 'buyer', BUY, 50, 10)])
+
+        async def run():
+            ledger = BalanceLedger()
+            ledger.load()
+            with pytest.raises(ValueError, match='Cannot withdraw 600 RUB, only 500 available'):
+                await ledger.update('buyer', 'RUB', -600)
+            with pytest.raises(ValueError, match='Cannot freeze 600 RUB, only 500 available'):
+                await ledger.update('buyer', 'RUB', 600, is_freeze=True)
+            with pytest.raises(ValueError, match='Cannot unfreeze 5 MEMC, only 0 frozen'):
+                await ledger.update('buyer', 'MEMC', -5, is_freeze=True)
+            await ledger.update('buyer', 'RUB', -500)
+            #A change the DB refuses is dropped with its batch written around it
+            ledger.order_updates.append((db_fnc.ledger_fill_query, (99, 'b1')))
+            await ledger.flush()
+            await ledger.update('seller', 'MEMC', 5)
+            await ledger.stop()
+
+        with patch('aaabirzha.database.conn', conn):
+            asyncio.run(run())
+
+        assert stored(conn) == [('buyer', 'RUB', 500, 500), ('seller', 'MEMC', 55, 0)]
+        assert conn.execute("SELECT filled FROM Orders WHERE id = 'b1'").fetchone()[0] == 0
@@ -0,0 +1,40 @@
+import logging
+import queue
+
+from aaabirzha.logging_config import SamplingFilter, DeferredQueueHandler
+
+
+def record(level: int, msg: str, *args) -> logging.LogRecord:
+    return logging.LogRecord('aaabirzha.test', level, __file__, 1, msg, args, None)
+
+
+def test_sampling_keeps_one_per_template_and_all_warnings():
+    sampler = SamplingFilter(3)
+    fills = [sampler.filter(record(logging.INFO, 'Fill %s', n)) for n in range(7)]
+    other = sampler.filter(record(logging.INFO, 'Order %s queued', 1))
+    warnings = [sampler.filter(record(logging.WARNING, 'Fill %s', n)) for n in range(3)]
+
+    assert fills == [True, False, False, True, False, False, True]
+    assert other
+    assert warnings == [True, True, True]
+
+
+def test_handler_enqueues_records_unformatted():
+    records = queue.SimpleQueue()
+    handler = DeferredQueueHandler(records)
+    original = record(logging.INFO, 'Fill %s at %s', 5, 100)
+    handler.emit(original)
+
+    queued = records.get_nowait()
+    assert queued is original
+    assert queued.msg == 'Fill %s at %s' and queued.args == (5, 100)
+    assert queued.getMessage() == 'Fill 5 at 100'
+
+
+def test_mutable_args_are_logged_as_they_were():
+    records = queue.SimpleQueue()
+    levels = [[100, 5]]
+    DeferredQueueHandler(records).emit(record(logging.INFO, 'Levels %s of %s', levels, 'MEMC'))
+    levels.append([101, 2])
+
+    assert records.get_nowait().getMessage() == 'Levels [[100, 5]] of MEMC'
@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+from aaabirzha.market_data import MarketDataHub, EMPTY_ORDERBOOK, MAX_DEPTH, orderbook_cache, orderbook_json
+from aaabirzha.orderbook import OrderBook, BookOrder, books, BUY, SELL
+from aaabirzha.instruments import InstrumentSpec, specs
+
+
+def drain(subscription):
+    messages = []
+    while not subscription.queue.empty():
+        messages.append(json.loads(subscription.queue.get_nowait()))
+    return messages
+
+
+class TestMarketDataHub:
+    def setup_method(self):
+        specs['MDTEST'] = InstrumentSpec('MDTEST')
+        self.book = books['MDTEST'] = OrderBook('MDTEST')
+        self.book.add(BookOrder('a1', 'user', SELL, 101, 5))
+
+    def teardown_method(self):
+        books.pop('MDTEST', None)
+        specs.pop('MDTEST', None)
+
+    def test_snapshot_then_sequenced_deltas(self):
+        async def run():
+            hub = MarketDataHub()
+            self.book.drain_changes()
+            subscription = hub.subscribe('MDTEST')
+            self.book.add(BookOrder('b1', 'user', BUY, 99, 3))
+            hub.publish(self.book, [(101, 2, 'BUY', '2025-01-01 00:00:00')])
+            return drain(subscription)
+
+        snapshot, trade, delta = asyncio.run(run())
+
+        assert snapshot['type'] == 'snapshot'
+        assert snapshot['asks'] == [[101, 5]]
+        assert trade['type'] == 'trade' and trade['seq'] == snapshot['seq'] + 1
+        assert delta['type'] == 'delta' and delta['seq'] == trade['seq'] + 1
+        assert delta['bids'] == [[99, 3]]
+
+    def test_slow_subscriber_is_conflated_to_a_snapshot(self):
+        async def run():
+            hub = MarketDataHub(buffer=2)
+            subscription = hub.subscribe('MDTEST')
+            for i in range(5):
+                self.book.add(BookOrder(f'b{i}', 'user', BUY, 90 + i, 1))
+                hub.publish(self.book)
+            return drain(subscription), subscription.conflations
+
+        messages, conflations = asyncio.run(run())
+
+        snapshot, delta = messages
+        assert conflations == 2
+        assert snapshot['type'] == 'snapshot'
+        assert snapshot['bids'][0] == [93, 1]
+        assert delta['bids'] == [[94, 1]] and delta['seq'] == snapshot['seq'] + 1
+
+    def test_levels_are_published_in_api_units(self):
+        specs['MDTEST'] = InstrumentSpec('MDTEST', tick_size='0.5', lot_size=10)
+        hub = MarketDataHub()
+        snapshot = json.loads(hub.snapshot('MDTEST'))
+        assert snapshot['asks'] == [[50.5, 50]]
+
+
+def test_orderbook_cache_holds_only_existing_books():
+    specs['MDTEST'] = InstrumentSpec('MDTEST')
+    books['MDTEST'] = OrderBook('MDTEST')
+    try:
+        assert orderbook_json('NO-SUCH-TICKER', 5) == EMPTY_ORDERBOOK
+        assert 'NO-SUCH-TICKER' not in orderbook_cache
+        orderbook_json('MDTEST', 10 ** 6)
+        orderbook_json('MDTEST', -5)
+        assert set(orderbook_cache['MDTEST'][1]) == {MAX_DEPTH, 1}
+    finally:
+        books.pop('MDTEST', None)
+        specs.pop('MDTEST', None)
+        orderbook_cache.pop('MDTEST', None)
@@ -0,0 +1,30 @@
+from aaabirzha.metrics import Registry
+
+
+def test_histogram_exposition_is_cumulative():
+    registry = Registry()
+    latency = registry.histogram('op_seconds', 'Op latency', ('op',), bounds=(0.1, 1.0))
+    child = latency.labels('read')
+    for value in (0.05, 0.5, 0.5, 5.0):
+        child.observe(value)
+
+    lines = registry.render().splitlines()
+
+    assert lines[:2] == ['# HELP op_seconds Op latency', '# TYPE op_seconds histogram']
+    assert lines[2:5] == ['op_seconds_bucket{op="read",le="0.1"} 1', 'op_seconds_bucket{op="read",le="1.0"} 3',
+                          'op_seconds_bucket{op="read",le="+Inf"} 4']
+    assert lines[5:] == ['op_seconds_sum{op="read"} 6.05', 'op_seconds_count{op="read"} 4']
+
+
+def test_children_are_reused_and_collectors_run_on_render():
+    registry = Registry()
+    commits = registry.counter('commits_total', 'Commits')
+    depth = registry.gauge('depth', 'Depth', ('ticker',))
+    registry.collectors.append(lambda: depth.labels('MEMC').set(7))
+    assert commits.labels() is commits.labels()
+    commits.labels().inc()
+    commits.labels().inc(2)
+
+    assert registry.render().splitlines() == ['# HELP commits_total Commits', '# TYPE commits_total counter',
+                                              'commits_total 3', '# HELP depth Depth', '# TYPE depth gauge',
+                                              'depth{ticker="MEMC"} 7']
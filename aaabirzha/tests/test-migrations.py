@@ -0,0 +1,37 @@
+import hashlib
+import sqlite3 as sql
+
+from aaabirzha.migrations import apply_migrations, current_version, BASELINE_PATH, LATEST_VERSION
+
+ADMIN_KEY = 'key-27feaacf537015b8824942ad6f50789b'
+
+
+def test_fresh_database_gets_baseline_and_seed_rows():
+    conn = sql.connect(':memory:')
+
+    assert apply_migrations(conn) == LATEST_VERSION
+    assert conn.execute("SELECT ticker FROM Instruments").fetchall() == [('RUB',)]
+    assert conn.execute('SELECT api_key_hashed FROM Users WHERE api_key = ?', (ADMIN_KEY,)).fetchone() == \
+        (hashlib.sha256(ADMIN_KEY.encode()).hexdigest(),)
+
+
+def test_rerun_is_a_no_op_and_keeps_seed_rows():
+    conn = sql.connect(':memory:')
+    apply_migrations(conn)
+    conn.execute("UPDATE Instruments SET lot_size = '0.01' WHERE ticker = 'RUB'")
+    conn.commit()
+
+    assert apply_migrations(conn) == LATEST_VERSION
+    assert conn.execute("SELECT lot_size FROM Instruments WHERE ticker = 'RUB'").fetchone() == ('0.01',)
+    assert conn.execute('SELECT count(*) FROM schema_version').fetchone() == (LATEST_VERSION + 1,)
+
+
+def test_database_without_schema_version_is_adopted():
+    conn = sql.connect(':memory:')
+    conn.executescript(BASELINE_PATH.read_text())
+    conn.execute("INSERT INTO Instruments (name, ticker) VALUES ('Memcoin', 'MEMC')")
+    conn.commit()
+    assert current_version(conn) == -1
+
+    assert apply_migrations(conn) == LATEST_VERSION
+    assert conn.execute('SELECT ticker FROM Instruments ORDER BY ticker').fetchall() == [('MEMC',), ('RUB',)]
@@ -0,0 +1,124 @@
+from unittest.mock import patch
+
+from aaabirzha.orderbook import OrderBook, BookOrder, BUY, SELL, get_book
+
+
+def make_order(id, direction, price, qty, filled=0):
+    return BookOrder(id, 'user', direction, price, qty, filled)
+
+
+class TestOrderBook:
+    def test_best_bid_and_ask(self):
+        book = OrderBook('AAPL')
+        book.add(make_order('b1', BUY, 100, 5))
+        book.add(make_order('b2', BUY, 101, 5))
+        book.add(make_order('a1', SELL, 105, 5))
+        book.add(make_order('a2', SELL, 103, 5))
+
+        assert book.best_price(BUY) == 101
+        assert book.best_price(SELL) == 103
+        assert book.best(BUY).id == 'b2'
+        assert book.best(SELL).id == 'a2'
+
+    def test_time_priority_within_level(self):
+        book = OrderBook('AAPL')
+        book.add(make_order('first', SELL, 100, 1))
+        book.add(make_order('second', SELL, 100, 1))
+
+        assert book.best(SELL).id == 'first'
+        book.fill(book.best(SELL), 1)
+        assert book.best(SELL).id == 'second'
+
+    def test_partial_fill_keeps_order(self):
+        book = OrderBook('AAPL')
+        order = make_order('a1', SELL, 100, 10)
+        book.add(order)
+
+        book.fill(order, 4)
+
+        assert 'a1' in book
+        assert order.remaining == 6
+        assert book.volume[SELL] == 6
+
+    def test_cancel_drops_empty_level(self):
+        book = OrderBook('AAPL')
+        book.add(make_order('a1', SELL, 100, 1))
+        book.add(make_order('a2', SELL, 101, 2, filled=1))
+
+        assert book.remove('a1').id == 'a1'
+        assert book.best_price(SELL) == 101
+        assert book.volume[SELL] == 1
+        assert book.remove('a1') is None
+
+        book.remove('a2')
+        assert book.best(SELL) is None
+        assert len(book) == 0
+        assert book.volume[SELL] == 0
+
+    def test_depth_aggregates_levels(self):
+        book = OrderBook('AAPL')
+        book.add(make_order('b1', BUY, 100, 5))
+        book.add(make_order('b2', BUY, 100, 3, filled=1))
+        book.add(make_order('b3', BUY, 99, 4))
+        book.add(make_order('b4', BUY, 98, 1))
+        book.add(make_order('a1', SELL, 101, 2))
+        book.add(make_order('a2', SELL, 102, 6))
+
+        assert book.depth(BUY, 2) == [(100, 7), (99, 4)]
+        assert book.depth(SELL, 10) == [(101, 2), (102, 6)]
+        assert book.depth(BUY, 0) == []
+
+    def test_depth_follows_fills_and_cancels(self):
+        book = OrderBook('AAPL')
+        book.add(make_order('a1', SELL, 101, 2))
+        book.add(make_order('a2', SELL, 101, 6))
+        version = book.version
+
+        book.fill(book.best(SELL), 2)
+        book.remove('a2')
+
+        assert book.depth(SELL, 5) == []
+        assert book.version > version
+
+    def test_re_adding_an_order_replaces_it(self):
+        book = OrderBook('AAPL')
+        book.add(make_order('a1', SELL, 100, 4))
+        book.add(make_order('a1', SELL, 100, 4, filled=1))
+
+        assert len(book) == 1
+        assert book.depth(SELL, 10) == [(100, 3)]
+        assert book.volume[SELL] == 3
+
+    def test_remove_many_drops_levels_once(self):
+        book = OrderBook('AAPL')
+        book.add(make_order('b1', BUY, 99, 3))
+        book.add(make_order('b2', BUY, 98, 2))
+        book.add(make_order('b3', BUY, 98, 1))
+        book.add(make_order('a1', SELL, 101, 4))
+        version = book.version
+
+        removed = book.remove_many(['b2', 'b3', 'a1', 'missing'])
+
+        assert [order.id for order in removed] == ['b2', 'b3', 'a1']
+        assert book.version == version + 1
+        assert book.depth(BUY, 10) == [(99, 3)]
+        assert book.best(SELL) is None
+        assert book.volume == [3, 0]
+        assert book.keys == ([99], [])
+
+    def test_sweep_price_is_the_worst_level_reached(self):
+        book = OrderBook('AAPL')
+        book.add(make_order('a1', SELL, 100, 5))
+        book.add(make_order('a2', SELL, 102, 5, filled=2))
+
+        assert book.sweep_price(SELL, 5) == 100
+        assert book.sweep_price(SELL, 8) == 102
+        assert book.sweep_price(SELL, 9) is None
+        assert book.sweep_price(BUY, 1) is None
+
+    def test_missing_book_is_empty_once_books_are_loaded(self):
+        with patch('aaabirzha.orderbook.books', {}), patch('aaabirzha.orderbook.books_loaded', True), \
+                patch('aaabirzha.orderbook.db_fnc.get_open_orders', side_effect=AssertionError('DB read')):
+            book = get_book('AAPL')
+            assert len(book) == 0
+            assert get_book('AAPL') is book
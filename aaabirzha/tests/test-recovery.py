@@ -0,0 +1,74 @@
+from unittest.mock import patch
+
+from aaabirzha.orderbook import OrderBook, BookOrder, books, BUY, SELL
+from aaabirzha.recovery import BookJournal, book_totals
+
+
+def totals_rows(live: dict) -> list:
+    return [{'ticker': ticker, 'direction': side, 'orders': orders, 'volume': volume, 'notional': notional}
+            for ticker, book in live.items() for side, (orders, volume, notional) in book_totals(book).items()]
+
+
+def run_session(directory) -> BookJournal:
+    journal = BookJournal(directory, snapshot_interval=0)
+    with patch('aaabirzha.recovery.db_fnc.get_open_orders', return_value=[]), \
+            patch('aaabirzha.recovery.db_fnc.get_open_book_totals', return_value=[]):
+        journal.recover()
+    book = books['MEMC'] = OrderBook('MEMC')
+    for order in (BookOrder('b1', 'u1', BUY, 99, 5), BookOrder('b2', 'u2', BUY, 99, 3), BookOrder('a1', 'u1', SELL, 101, 4)):
+        book.add(order)
+    journal.snapshot()
+
+    added = BookOrder('a2', 'u2', SELL, 102, 6, timestamp='2026-01-01 10:00:00')
+    book.add(added)
+    journal.add('MEMC', added)
+    book.fill(book.orders['b1'], 2)
+    journal.fill('MEMC', 'b1', 2)
+    book.remove_many(['a1'])
+    journal.remove('MEMC', ['a1'])
+    journal.flush()
+    return journal
+
+
+def book_state(book: OrderBook) -> tuple:
+    return book.depth(BUY, 10), book.depth(SELL, 10), [(o.id, o.filled, o.timestamp) for o in book.orders.values()]
+
+
+class TestBookJournal:
+    def test_snapshot_and_journal_tail_restore_the_books(self, tmp_path):
+        try:
+            journal = run_session(tmp_path)
+            expected = book_state(books['MEMC'])
+            rows = totals_rows(books)
+            journal.file.close()
+            books.clear()
+
+            with patch('aaabirzha.recovery.db_fnc.get_open_book_totals', return_value=rows), \
+                    patch('aaabirzha.recovery.db_fnc.get_open_orders', side_effect=AssertionError('DB reload')):
+                BookJournal(tmp_path, snapshot_interval=0).recover()
+
+            assert book_state(books['MEMC']) == expected
+            assert sorted(books['MEMC'].levels[BUY][99]) == ['b1', 'b2']
+        finally:
+            books.clear()
+
+    def test_torn_journal_tail_reloads_the_ticker_from_the_db(self, tmp_path):
+        try:
+            journal = run_session(tmp_path)
+            rows = totals_rows(books)
+            db_rows = [{'id': o.id, 'user_id': o.user_id, 'direction': o.direction, 'price': o.price, 'qty': o.qty,
+                        'filled': o.filled, 'timestamp': o.timestamp} for o in books['MEMC'].orders.values()]
+            journal.file.close()
+            path = journal.journal_path(journal.generation)
+            path.write_bytes(path.read_bytes()[:-3])
+            books.clear()
+
+            with patch('aaabirzha.recovery.db_fnc.get_open_book_totals', return_value=rows), \
+                    patch('aaabirzha.recovery.db_fnc.get_open_orders', return_value=db_rows) as reload:
+                BookJournal(tmp_path, snapshot_interval=0).recover()
+
+            reload.assert_called_once_with('MEMC')
+            assert books['MEMC'].depth(SELL, 10) == [(102, 6)]
+            assert books['MEMC'].depth(BUY, 10) == [(99, 6)]
+        finally:
+            books.clear()
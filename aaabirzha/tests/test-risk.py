@@ -0,0 +1,88 @@
+import asyncio
+import sqlite3 as sql
+from datetime import datetime
+from unittest.mock import patch
+from uuid import uuid4
+
+import pytest
+
+from aaabirzha.instruments import InstrumentSpec
+from aaabirzha.ledger import Account, BalanceLedger
+from aaabirzha.migrations import apply_migrations
+from aaabirzha.orderbook import OrderBook, BookOrder, BUY, SELL
+from aaabirzha.risk import PreTradeRisk
+from aaabirzha.schemas import LimitOrder, MarketOrder, OrderStatus, User
+
+
+def make_order(direction: str, qty: int, price: int = None):
+    body = {'direction': direction, 'ticker': 'MEMC', 'qty': qty}
+    if price is None:
+        return MarketOrder(id=uuid4(), status=OrderStatus.NEW, user_id=uuid4(), body=body, timestamp=datetime.now())
+    return LimitOrder(id=uuid4(), status=OrderStatus.NEW, user_id=uuid4(), body={**body, 'price': price},
+                      timestamp=datetime.now())
+
+
+def make_ledger(user: User, balances: dict) -> BalanceLedger:
+    ledger = BalanceLedger()
+    ledger.accounts[str(user.id)] = {ticker: Account(balance) for ticker, balance in balances.items()}
+    ledger.loaded = True
+    return ledger
+
+
+def make_book() -> OrderBook:
+    book = OrderBook('MEMC')
+    book.add(BookOrder('a1', 'maker', SELL, 100, 5))
+    book.add(BookOrder('a2', 'maker', SELL, 104, 5))
+    book.add(BookOrder('b1', 'maker', BUY, 96, 5))
+    return book
+
+
+user = User(id=uuid4(), name='trader', api_key='key')
+
+
+class TestPreTradeRisk:
+    def test_rejected_orders_change_nothing(self):
+        risk = PreTradeRisk(max_order_qty=50, price_band=0.1)
+        ledger = make_ledger(user, {'RUB': 1000, 'MEMC': 3})
+        with patch('aaabirzha.risk.ledger', ledger), patch('aaabirzha.risk.books', {'MEMC': make_book()}), \
+                patch('aaabirzha.risk.get_spec', return_value=InstrumentSpec('MEMC', tick_size=2)):
+            with pytest.raises(ValueError, match='above the limit of 50'):
+                risk.check(make_order('BUY', 51, 98), user)
+            #No trade yet: the band is 10% around the mid of the book, 98
+            with pytest.raises(ValueError, match='outside the band 89-107'):
+                risk.check(make_order('BUY', 1, 108), user)
+            with pytest.raises(ValueError, match='2000 needed, 1000 available'):
+                risk.check(make_order('BUY', 10, 100), user)
+            with pytest.raises(ValueError, match='4 needed, 3 available'):
+                risk.check(make_order('SELL', 4, 99), user)
+
+        assert [(account.balance, account.frozen) for account in ledger.accounts[str(user.id)].values()] == [(1000, 0), (3, 0)]
+        assert risk.reservations == {}
+        assert ledger.dirty == set()
+
+    def test_market_order_reserves_at_the_sweep_price_and_releases_the_rest(self):
+        conn = sql.connect(':memory:', check_same_thread=False)
+        apply_migrations(conn)
+        risk = PreTradeRisk(price_band=0.1)
+        ledger = make_ledger(user, {'RUB': 1000})
+        ledger.accounts['maker'] = {'MEMC': Account(10, 10)}
+        order = make_order('BUY', 7)
+
+        async def run():
+            risk.check(order, user)
+            #7 lots reach the second level, the whole order is reserved at its price
+            assert ledger.accounts[str(user.id)]['RUB'].frozen == 7 * 104
+            price = risk.take(order)
+            await ledger.settle(user.id, 'maker', 'MEMC', 100, 5, 'a1', SELL, 100, cash_per_lot_tick=1, taker_price=price)
+            risk.release(order, user, 2, price)
+            await ledger.stop()
+
+        with patch('aaabirzha.risk.ledger', ledger), patch('aaabirzha.risk.books', {'MEMC': make_book()}), \
+                patch('aaabirzha.risk.get_spec', return_value=InstrumentSpec('MEMC')), \
+                patch('aaabirzha.database.conn', conn):
+            asyncio.run(run())
+
+        assert (ledger.accounts[str(user.id)]['RUB'].balance, ledger.accounts[str(user.id)]['RUB'].frozen) == (500, 0)
+        assert ledger.accounts[str(user.id)]['MEMC'].balance == 5
+        assert (ledger.accounts['maker']['MEMC'].balance, ledger.accounts['maker']['MEMC'].frozen) == (5, 5)
+        assert risk.reservations == {}
@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+from aaabirzha.sequencer import MatchingSequencer
+
+
+class TestMatchingSequencer:
+    def test_jobs_for_one_ticker_run_in_order(self):
+        log = []
+
+        async def job(n):
+            log.append(('start', n))
+            await asyncio.sleep(0)
+            log.append(('end', n))
+            return n
+
+        async def run():
+            sequencer = MatchingSequencer()
+            results = await asyncio.gather(*(sequencer.submit('AAPL', job, n) for n in range(3)))
+            stats = sequencer.stats()
+            await sequencer.shutdown()
+            return results, stats
+
+        results, stats = asyncio.run(run())
+
+        assert results == [0, 1, 2]
+        assert log == [('start', 0), ('end', 0), ('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+        assert stats['AAPL']['processed'] == 3
+        assert stats['AAPL']['queue_depth'] == 0
+
+    def test_tickers_do_not_block_each_other(self):
+        async def run():
+            sequencer = MatchingSequencer()
+            gate = asyncio.Event()
+
+            async def blocked():
+                await gate.wait()
+                return 'AAPL'
+
+            slow = asyncio.create_task(sequencer.submit('AAPL', blocked))
+            fast = await sequencer.submit('MSFT', lambda: 'MSFT')
+            gate.set()
+            result = (fast, await slow)
+            await sequencer.shutdown()
+            return result
+
+        assert asyncio.run(run()) == ('MSFT', 'AAPL')
+
+    def test_job_errors_reach_the_caller(self):
+        def failing():
+            raise ValueError('Not enough funds')
+
+        async def run():
+            sequencer = MatchingSequencer()
+            try:
+                await sequencer.submit('AAPL', failing)
+            finally:
+                await sequencer.shutdown()
+
+        with pytest.raises(ValueError):
+            asyncio.run(run())
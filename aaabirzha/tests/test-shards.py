@@ -0,0 +1,56 @@
+import asyncio
+import json
+from unittest.mock import patch
+
+import pytest
+
+from aaabirzha.instruments import InstrumentSpec
+from aaabirzha.market_data import market_data
+from aaabirzha.orderbook import OrderBook, BookOrder, SELL
+from aaabirzha.sequencer import sequencer
+from aaabirzha.shards import ShardClient, ENGINE_OPERATIONS, handle_connection, shard_of, socket_path
+
+
+def double(value):
+    return value * 2
+
+
+def fail():
+    raise ValueError('Not enough RUB')
+
+
+class TestShards:
+    def test_tickers_map_to_a_stable_shard(self):
+        assert shard_of('MEMC', 4) == shard_of('MEMC', 4) == 1
+        assert {shard_of(f'T{n}', 4) for n in range(100)} == {0, 1, 2, 3}
+
+    def test_jobs_and_market_data_go_through_the_shard_socket(self, tmp_path):
+        async def run():
+            server = await asyncio.start_unix_server(handle_connection, socket_path(0, tmp_path))
+            client = ShardClient(1, tmp_path, connect_timeout=1)
+            try:
+                subscription = client.market_data.subscribe('SHRD')
+                await asyncio.sleep(0.1)
+                book = OrderBook('SHRD')
+                book.add(BookOrder('a1', 'u1', SELL, 101, 4))
+                market_data.publish(book)
+                result = await client.submit('SHRD', double, 21)
+                with pytest.raises(ValueError, match='Not enough RUB'):
+                    await client.submit('SHRD', fail)
+                messages = [json.loads(await subscription.get()) for _ in range(2)]
+                client.market_data.unsubscribe(subscription)
+                await asyncio.sleep(0.1)
+                return result, messages
+            finally:
+                await client.close()
+                server.close()
+                await sequencer.shutdown()
+
+        with patch.dict(ENGINE_OPERATIONS, {'double': double, 'fail': fail}), \
+                patch('aaabirzha.market_data.get_spec', return_value=InstrumentSpec('SHRD')):
+            result, messages = asyncio.run(run())
+
+        assert result == 42
+        assert [(m['type'], m['seq']) for m in messages] == [('snapshot', 0), ('delta', 1)]
+        assert messages[1]['asks'] == [[101, 4]]
+        assert 'SHRD' not in market_data.subscribers
@@ -0,0 +1,76 @@
+import asyncio
+import logging
+
+import aaabirzha.database as db_fnc
+import aaabirzha.db_pool as db_pool
+from aaabirzha.ledger import ledger
+
+logger = logging.getLogger(__name__)
+
+#Rows buffered before an early flush is requested, and the longest a row waits for its flush (seconds)
+FLUSH_SIZE = 512
+FLUSH_INTERVAL = 0.05
+
+BUY = 0
+SELL = 1
+
+
+#Buffered writer for the Transactions table. The match path only appends rows to a list, a background
+#task writes them with one executemany and one commit when FLUSH_SIZE rows are pending or every
+#FLUSH_INTERVAL seconds, so recording a trade costs no commit on the matching critical path
+class TradeTape:
+    def __init__(self, flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.flusher = None
+        self.wakeup = None
+
+    #Records both sides of one trade: a BUY row for the buyer and a SELL row for the seller
+    def record(self, ticker: str, price, qty, timestamp, buyer_id, buy_order_id, seller_id, sell_order_id):
+        timestamp = str(timestamp)
+        self.buffer.append((str(buyer_id), ticker, BUY, qty, price, timestamp, str(buy_order_id), str(sell_order_id)))
+        self.buffer.append((str(seller_id), ticker, SELL, qty, price, timestamp, str(sell_order_id), str(buy_order_id)))
+        if self.flusher is None:
+            self.start()
+        if len(self.buffer) >= self.flush_size:
+            self.wakeup.set()
+
+    async def flush(self):
+        if not self.buffer:
+            return 0
+        rows, self.buffer = self.buffer, []
+        try:
+            #The balance changes of these trades go first, a trade is never stored without them
+            await ledger.flush()
+            await db_pool.write(db_fnc.insert_transactions, rows)
+        except Exception as e:
+            #Keep the rows for the next attempt instead of losing the trade history
+            self.buffer[:0] = rows
+            logger.error('Failed to flush %s trade rows\n%s', len(rows), e)
+            return 0
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    def start(self):
+        if self.flusher is None:
+            self.wakeup = asyncio.Event()
+            self.flusher = asyncio.create_task(self._run(), name='trade-tape')
+
+    async def stop(self):
+        if self.flusher is not None:
+            self.flusher.cancel()
+            await asyncio.gather(self.flusher, return_exceptions=True)
+            self.flusher = None
+        await self.flush()
+
+
+trade_tape = TradeTape()